@@ -8,9 +8,11 @@ def mat2vec(Sigma):
     """Return vector of independent elements in 4x4 symmetric matrix Sigma.
     
     The order is by row in the upper triangular elements: [<xx>, <xx'>,
-    <xy>, <xy'>, <x'x'>, <yx'>, <x'y'>, <yy>, <yy'>, <y'y'>].
+    <xy>, <xy'>, <x'x'>, <yx'>, <x'y'>, <yy>, <yy'>, <y'y'>]. Sigma can also
+    have shape (..., 4, 4).
     """
-    return Sigma[np.triu_indices(4)]
+    i, j = np.triu_indices(4)
+    return np.asarray(Sigma)[..., i, j]
 
 
 def get_shape_factors(sig11, sig33, sig13):
@@ -101,85 +103,11 @@ def perturbed_derivs(yp, s, y0, Q, ext_foc):
 
 
 def jacobian(yp, s, y0, Q, ext_foc):
-    """Return Jacobian matrix."""
-    sig11, sig12, sig13, sig14, sig22, sig23, sig24, sig33, sig34, sig44 = y0
-    S0, Sx, Sy, D = get_shape_factors(sig11, sig33, sig13)
-    qxx, qyy, qxy = Sy/D, Sx/D, -sig13/D
-
-    kxx_ext, kyy_ext, kxy_ext = ext_foc(s)
-    kxx0 = kxx_ext - 2 * Q * qxx
-    kyy0 = kyy_ext - 2 * Q * qyy
-    kxy0 = kxy_ext + 2 * Q * qxy
-        
-    dxx = (sig33 / (2 * S0**2)) + qxx
-    dyy = (sig11 / (2 * S0**2)) + qyy
-    dxy = (-sig13 / S0**2) + 2*qxy
-    
-    a1 = qxx * ((sig33 / (2 * S0 * Sy)) - dxx) # dqxx_dsig11
-    b1 = qxx * ((-sig13 / (S0 * Sy)) - dxy) # dqxx_dsig13
-    c1 = qxx * (((1 + sig11/(2*S0)) / Sy) - dyy) # dqxx_dsig33
-    a2 = qyy * (((1 + sig33/(2*S0)) / Sx) - dxx) # dqyy_dsig11
-    b2 = qyy * ((-sig13 / (S0 * Sx)) - dxy) # dqyy_dsig13
-    c2 = qyy * ((sig11 / (2 * S0 * Sx)) - dyy) # dqyy_dsig33
-    a3 = -qxy * dxx # dqxy_dsig11
-    if sig13 != 0:
-        b3 = qxy * ((1 / sig13) - dxy) # dqxy_dsig13
-    else:
-        b3 = 0.0
-    c3 = -qxy * dyy # dqxy_dsig33
-    
-    J = np.zeros((10, 10))
-    
-    J[0, 1] = 2.0
-    
-    J[1, 0] = kxx0 + 2*Q*(a1*sig11 + a2*sig13)
-    J[1, 2] = kxy0 + 2*Q*(b1*sig11 + b2*sig13)
-    J[1, 4] = 1.0
-    J[1, 7] = 2*Q*(c1*sig11 + c2*sig13)
-    
-    J[2, 3] = J[2, 5] = 1.0
-    
-    J[3, 0] = kxy0 + 2*Q*(a2*sig11 + a3*sig13)
-    J[3, 2] = kyy0 + 2*Q*(b2*sig11 + b3*sig13)
-    J[3, 6] = 1.0
-    J[3, 7] = 2*Q*(c2*sig11 + c3*sig13)
-    
-    J[4, 0] = 4*Q*(a1*sig12 + a2*sig23)
-    J[4, 1] = 2*kxx0
-    J[4, 2] = 4*Q*(b1*sig12 + b2*sig23)
-    J[4, 5] = 2*kxy0
-    J[4, 7] = 4*Q*(c1*sig12 + c2*sig23)
-    
-    J[5, 0] = 2*Q*(a1*sig13 + a2*sig33)
-    J[5, 2] = kxx0 + 2*Q*(b1*sig13 + b2*sig33)
-    J[5, 6] = 1.0
-    J[5, 7] = kxy0 + 2*Q*(c1*sig13 + c2*sig33)
-    
-    J[6, 0] = 2*Q*(a1*sig14 + a3*sig23 + a2*(sig12 + sig34))
-    J[6, 1] = kxy0
-    J[6, 2] = 2*Q*(b1*sig14 + b3*sig23 + b2*(sig12 + sig34))
-    J[6, 3] = kxx0
-    J[6, 5] = kyy0
-    J[6, 7] = 2*Q*(c1*sig14 + c3*sig23 + c2*(sig12 + sig34))
-    J[6, 8] = kxy0
-    
-    J[7, 8] = 2.0
-    
-    J[8, 0] = 2*Q*(a2*sig13 + a3*sig33)
-    J[8, 2] = kxy0 + 2*Q*(b2*sig13 + b3*sig33)
-    J[8, 7] = kyy0 + 2*Q*(c2*sig13 + c3*sig33)
-    J[8, 9] = 1.0
-    
-    J[9, 0] = 4*Q*(a2*sig14 + a3*sig23)
-    J[9, 2] = 4*Q*(b2*sig14 + b3*sig23)
-    J[9, 3] = 2*kxy0
-    J[9, 7] = 4*Q*(c2*sig14 + c3*sig23)
-    J[9, 8] = 2*kyy0
+    """Return Jacobian matrix of `derivs` at the matched moments y0.
     
-    return J
-
-
-
+    This is `jacobian_ensemble` for one beam.
+    """
+    return jacobian_ensemble(y0, Q, *ext_foc(s))[0]
 
 
 def track(y0, Q, ext_foc, positions):
@@ -200,3 +128,531 @@ def to_df(moments, positions):
     df['s'] = positions
     return df
 
+
+# Ensemble integration
+#------------------------------------------------------------------------------
+def derivs_ensemble(Y, Q, k0xx, k0yy, k0xy, out=None):
+    """Vectorised `derivs` for many moment vectors at one position.
+    
+    Parameters
+    ----------
+    Y : ndarray, shape (n_beams, 10)
+        Moment vectors (see `derivs`).
+    Q : float or ndarray, shape (n_beams,)
+        Dimensionless space charge perveance of each beam.
+    k0xx, k0yy, k0xy : float
+        External focusing strengths at this position.
+    out : ndarray, shape (n_beams, 10) (optional)
+        Array in which to place the result.
+        
+    Returns
+    -------
+    ndarray, shape (n_beams, 10)
+    """
+    if out is None:
+        out = np.empty_like(Y)
+    Q = np.asarray(Q, dtype=float)
+    sig11, sig12, sig13, sig14, sig22, sig23, sig24, sig33, sig34, sig44 = Y.T
+    S0, Sx, Sy, D = get_shape_factors(sig11, sig33, sig13)
+    kxx = k0xx - 2 * Q * Sy / D
+    kyy = k0yy - 2 * Q * Sx / D
+    kxy = k0xy - 2 * Q * sig13 / D
+    out[:, 0] = 2 * sig12
+    out[:, 1] = sig22 - kxx*sig11 + kxy*sig13
+    out[:, 2] = sig23 + sig14
+    out[:, 3] = sig24 + kxy*sig11 - kyy*sig13
+    out[:, 4] = -2*kxx*sig12 + 2*kxy*sig23
+    out[:, 5] = sig24 - kxx*sig13 + kxy*sig33
+    out[:, 6] = -kxx*sig14 + kxy*(sig34+sig12) - kyy*sig23
+    out[:, 7] = 2 * sig34
+    out[:, 8] = sig44 + kxy*sig13 - kyy*sig33
+    out[:, 9] = 2*kxy*sig14 - 2*kyy*sig34
+    return out
+
+
+def jacobian_ensemble(Y, Q, k0xx, k0yy, k0xy):
+    """Return the Jacobian of `derivs_ensemble` with respect to Y.
+    
+    Returns
+    -------
+    ndarray, shape (n_beams, 10, 10)
+    """
+    Y = np.atleast_2d(Y)
+    n_beams = len(Y)
+    Q = np.broadcast_to(Q, (n_beams,))
+    sig11, sig12, sig13, sig14, sig22, sig23, sig24, sig33, sig34, sig44 = Y.T
+    S0, Sx, Sy, D = get_shape_factors(sig11, sig33, sig13)
+    kxx = k0xx - 2 * Q * Sy / D
+    kyy = k0yy - 2 * Q * Sx / D
+    kxy = k0xy - 2 * Q * sig13 / D
+    
+    # Linear part (fixed focusing strength).
+    J = np.zeros((n_beams, 10, 10))
+    J[:, 0, 1] = 2.0
+    J[:, 1, 0], J[:, 1, 2], J[:, 1, 4] = -kxx, kxy, 1.0
+    J[:, 2, 3] = J[:, 2, 5] = 1.0
+    J[:, 3, 0], J[:, 3, 2], J[:, 3, 6] = kxy, -kyy, 1.0
+    J[:, 4, 1], J[:, 4, 5] = -2 * kxx, 2 * kxy
+    J[:, 5, 2], J[:, 5, 6], J[:, 5, 7] = -kxx, 1.0, kxy
+    J[:, 6, 1], J[:, 6, 3], J[:, 6, 5], J[:, 6, 8] = kxy, -kxx, -kyy, kxy
+    J[:, 7, 8] = 2.0
+    J[:, 8, 2], J[:, 8, 7], J[:, 8, 9] = kxy, -kyy, 1.0
+    J[:, 9, 3], J[:, 9, 8] = 2 * kxy, -2 * kyy
+    
+    # Derivatives of the focusing strengths with respect to [sig11, sig13,
+    # sig33] through the space charge terms.
+    zero, one = np.zeros(n_beams), np.ones(n_beams)
+    dS0 = np.array([sig33, -2 * sig13, sig11]) / (2 * S0)
+    dSx = dS0 + np.array([one, zero, zero])
+    dSy = dS0 + np.array([zero, zero, one])
+    dD = dS0 * (Sx + Sy) + S0 * (dSx + dSy)
+    dkxx = -2 * Q * (dSy / D - Sy * dD / D**2)
+    dkyy = -2 * Q * (dSx / D - Sx * dD / D**2)
+    dkxy = -2 * Q * (np.array([zero, one, zero]) / D - sig13 * dD / D**2)
+    # Derivatives of the right-hand side with respect to the strengths.
+    df_dkxx = np.array([zero, -sig11, zero, zero, -2 * sig12, -sig13, -sig14, 
+                        zero, zero, zero])
+    df_dkyy = np.array([zero, zero, zero, -sig13, zero, zero, -sig23, zero, 
+                        -sig33, -2 * sig34])
+    df_dkxy = np.array([zero, sig13, zero, sig11, 2 * sig23, sig33, 
+                        sig34 + sig12, zero, sig13, 2 * sig14])
+    for col, (a, b, c) in zip([0, 2, 7], zip(dkxx, dkxy, dkyy)):
+        J[:, :, col] += (df_dkxx * a + df_dkxy * b + df_dkyy * c).T
+    return J
+
+
+def _rk4_ensemble(Y0, Q, ext_foc, positions, ds):
+    """Fixed-step RK4; see `track_ensemble`."""
+    Y = np.array(Y0, dtype=float)
+    moments = np.empty((len(Y), len(positions), 10))
+    moments[:, 0] = Y
+    k1, k2, k3, k4, Ytmp = [np.empty_like(Y) for _ in range(5)]
+    for i in range(len(positions) - 1):
+        s0, s1 = positions[i], positions[i + 1]
+        n_steps = max(1, int(np.ceil(abs(s1 - s0) / ds)))
+        h = (s1 - s0) / n_steps
+        # Focusing strength at the start, middle and end of every step.
+        stage_positions = s0 + 0.5 * h * np.arange(2 * n_steps + 1)
+        foc = np.array([ext_foc(s) for s in stage_positions])
+        for j in range(n_steps):
+            f0, f_half, f1 = foc[2 * j], foc[2 * j + 1], foc[2 * j + 2]
+            derivs_ensemble(Y, Q, *f0, out=k1)
+            np.add(Y, 0.5 * h * k1, out=Ytmp)
+            derivs_ensemble(Ytmp, Q, *f_half, out=k2)
+            np.add(Y, 0.5 * h * k2, out=Ytmp)
+            derivs_ensemble(Ytmp, Q, *f_half, out=k3)
+            np.add(Y, h * k3, out=Ytmp)
+            derivs_ensemble(Ytmp, Q, *f1, out=k4)
+            Y += (h / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+        moments[:, i + 1] = Y
+    return moments
+
+
+# Dormand-Prince 5(4) coefficients.
+_DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+_DP_A = [
+    [],
+    [1/5],
+    [3/40, 9/40],
+    [44/45, -56/15, 32/9],
+    [19372/6561, -25360/2187, 64448/6561, -212/729],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84],
+]
+_DP_E = np.array([71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+
+
+def _dopri_ensemble(Y0, Q, ext_foc, positions, ds, rtol, atol):
+    """Adaptive Dormand-Prince 5(4); see `track_ensemble`."""
+    Y = np.array(Y0, dtype=float)
+    moments = np.empty((len(Y), len(positions), 10))
+    moments[:, 0] = Y
+    K = np.empty((7,) + Y.shape)
+    h = ds
+    h_min = 1e-10 * ds
+    s = positions[0]
+    for i in range(len(positions) - 1):
+        s_end = positions[i + 1]
+        while s < s_end:
+            h = min(h, s_end - s)
+            derivs_ensemble(Y, Q, *ext_foc(s), out=K[0])
+            for stage in range(1, 7):
+                Ytmp = Y + h * np.tensordot(_DP_A[stage], K[:stage], axes=1)
+                derivs_ensemble(Ytmp, Q, *ext_foc(s + _DP_C[stage] * h), 
+                                out=K[stage])
+            # Ytmp is the fifth-order solution.
+            err = h * np.tensordot(_DP_E, K, axes=1)
+            scale = atol + rtol * np.maximum(np.abs(Y), np.abs(Ytmp))
+            ratio = np.sqrt(np.mean((err / scale)**2, axis=1))
+            # Beams that are already NaN are left out of the error.
+            ratio[~np.all(np.isfinite(Y), axis=1)] = 0.0
+            blown_up = ~np.isfinite(ratio)
+            if np.any(blown_up) and h <= h_min:
+                # Beams that blow up even with the smallest step become NaN.
+                Ytmp[blown_up] = np.nan
+                ratio[blown_up] = 0.0
+                blown_up[:] = False
+            err_norm = np.inf if np.any(blown_up) else np.max(ratio)
+            if err_norm <= 1.0:
+                s += h
+                Y = Ytmp
+            elif h <= h_min:
+                raise RuntimeError('Step size fell below {:.3e} at s = {}.'
+                                   .format(h_min, s))
+            factor = 0.9 * err_norm**-0.2 if err_norm > 0 else 5.0
+            h *= min(5.0, max(0.2, factor))
+        moments[:, i + 1] = Y
+    return moments
+
+
+def track_ensemble(Y0, Q, ext_foc, positions, ds=0.01, adaptive=False, 
+                   rtol=1e-8, atol=1e-14):
+    """Integrate many moment vectors at once.
+    
+    All beams are advanced together with one vectorised right-hand side, so 
+    the cost of calling `ext_foc` does not depend on the number of beams.
+    
+    Parameters
+    ----------
+    Y0 : ndarray, shape (n_beams, 10)
+        Initial moment vectors (see `derivs`).
+    Q : float or ndarray, shape (n_beams,)
+        Dimensionless space charge perveance of each beam.
+    ext_foc : callable
+        See `derivs`.
+    positions : ndarray, shape (n_steps,)
+        Positions at which to return the moments; positions[0] is the start.
+    ds : float
+        Step size for fixed-step RK4 (rounded down so that every interval 
+        between output positions has a whole number of steps). In adaptive 
+        mode, this is the initial step.
+    adaptive : bool
+        If True, use the Dormand-Prince 5(4) method with a step size shared
+        by all beams and chosen from the largest error. Beams that still 
+        blow up with a step of 1e-10 * ds are set to NaN and left out of the
+        error; a RuntimeError is raised if the step size falls below this 
+        for any other reason.
+    rtol, atol : float
+        Error tolerances for the adaptive method.
+        
+    Returns
+    -------
+    ndarray, shape (n_beams, n_steps, 10)
+    """
+    Y0 = np.atleast_2d(Y0)
+    Q = np.broadcast_to(np.asarray(Q, dtype=float), (len(Y0),))
+    positions = np.asarray(positions, dtype=float)
+    if adaptive:
+        return _dopri_ensemble(Y0, Q, ext_foc, positions, ds, rtol, atol)
+    return _rk4_ensemble(Y0, Q, ext_foc, positions, ds)
+
+
+# Matching
+#------------------------------------------------------------------------------
+def vec2mat(Y):
+    """Inverse of `mat2vec`; Y can also have shape (..., 10)."""
+    Y = np.asarray(Y)
+    Sigma = np.zeros(Y.shape[:-1] + (4, 4))
+    i, j = np.triu_indices(4)
+    Sigma[..., i, j] = Y
+    Sigma[..., j, i] = Y
+    return Sigma
+
+
+def period_map(Y0, Q, ext_foc, length, ds=0.01):
+    """Track moment vectors over one period with the variational equations.
+    
+    The perturbation transfer matrix dY(L)/dY(0) is integrated alongside
+    the moments with the same RK4 steps as `track_ensemble`.
+    
+    Parameters
+    ----------
+    Y0 : ndarray, shape (n_beams, 10)
+        Initial moment vectors.
+    Q : float or ndarray, shape (n_beams,)
+        Dimensionless space charge perveance of each beam.
+    ext_foc : callable or `lattice.Lattice`
+        See `derivs`. If a `Lattice` is passed, its `period_map` is used, 
+        which steps to the element boundaries and is exact at zero current.
+    length : float
+        Period length [m]. Ignored if `ext_foc` is a `Lattice`.
+    ds : float
+        Maximum step size [m].
+        
+    Returns
+    -------
+    Y : ndarray, shape (n_beams, 10)
+        Moment vectors at the end of the period.
+    Phi : ndarray, shape (n_beams, 10, 10)
+        Perturbation transfer matrix of each beam.
+    """
+    if hasattr(ext_foc, 'period_map'):
+        return ext_foc.period_map(Y0, Q, ds)
+    Y = np.array(np.atleast_2d(Y0), dtype=float)
+    Phi = np.broadcast_to(np.identity(10), (len(Y), 10, 10)).copy()
+    n_steps = max(1, int(np.ceil(length / ds)))
+    h = length / n_steps
+    foc = np.array([ext_foc(s) for s in 0.5 * h * np.arange(2 * n_steps + 1)])
+    
+    def rhs(Y, Phi, f):
+        return (derivs_ensemble(Y, Q, *f), 
+                np.matmul(jacobian_ensemble(Y, Q, *f), Phi))
+    
+    for j in range(n_steps):
+        f0, f_half, f1 = foc[2 * j], foc[2 * j + 1], foc[2 * j + 2]
+        k1, l1 = rhs(Y, Phi, f0)
+        k2, l2 = rhs(Y + 0.5 * h * k1, Phi + 0.5 * h * l1, f_half)
+        k3, l3 = rhs(Y + 0.5 * h * k2, Phi + 0.5 * h * l2, f_half)
+        k4, l4 = rhs(Y + h * k3, Phi + h * l3, f1)
+        Y += (h / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+        Phi += (h / 6.0) * (l1 + 2.0 * l2 + 2.0 * l3 + l4)
+    return Y, Phi
+
+
+_U = np.array([[0, 1, 0, 0], [-1, 0, 0, 0], [0, 0, 0, 1], [0, 0, -1, 0]])
+
+
+def invariants(Y):
+    """Return the two invariants of the moment equations.
+    
+    These are sqrt(det(Sigma)) = e1 * e2 and -tr((Sigma U)^2) / 2 = 
+    e1^2 + e2^2, where e1 and e2 are the intrinsic emittances (in units of
+    the moments).
+    
+    Returns
+    -------
+    ndarray, shape (..., 2)
+    """
+    Sigma = vec2mat(Y)
+    SU = np.matmul(Sigma, _U)
+    trSU2 = np.trace(np.matmul(SU, SU), axis1=-2, axis2=-1)
+    return np.stack([np.sqrt(np.abs(np.linalg.det(Sigma))), -0.5 * trSU2], 
+                    axis=-1)
+
+
+def _is_positive_definite(Y):
+    """Return whether each moment matrix is positive definite."""
+    return np.all(np.linalg.eigvalsh(vec2mat(Y)) > 0.0, axis=-1)
+
+
+def _emittance_residual(Y, Y_ref, rtol=1e-6):
+    """Return the conditions that fix the intrinsic emittances to Y_ref's.
+    
+    If Y_ref has distinct emittances, the conditions are c(Y) / c(Y_ref) 
+    - 1 = 0, where c = [det(Sigma)^(1/4), sqrt(-tr((Sigma U)^2) / 2)] = 
+    [sqrt(e1 * e2), sqrt(e1^2 + e2^2)]. The gradients of c are parallel
+    when e1 = e2, so if |e1 - e2| < rtol * sqrt(e1^2 + e2^2) the conditions
+    are (Sigma U)^2 / e^2 + I = 0 instead.
+    
+    Returns
+    -------
+    R : ndarray, shape (n_beams, 16)
+        Residuals (unused rows are zero).
+    dR : ndarray, shape (n_beams, 16, 10)
+        Gradients with respect to the moment vector.
+    """
+    n_beams = len(Y)
+    Sigma = vec2mat(Y)
+    E = vec2mat(np.identity(10))
+    SU = np.matmul(Sigma, _U)
+    SU2 = np.matmul(SU, SU)
+    I1_ref, I2_ref = np.moveaxis(invariants(Y_ref), -1, 0)
+    equal = I2_ref - 2.0 * I1_ref <= rtol**2 * I2_ref
+    
+    R = np.zeros((n_beams, 16))
+    dR = np.zeros((n_beams, 16, 10))
+    # Distinct emittances
+    I1 = np.abs(np.linalg.det(Sigma))**0.25
+    I2 = -0.5 * np.trace(SU2, axis1=-2, axis2=-1)
+    c = np.stack([I1, np.sqrt(np.abs(I2))], axis=-1)
+    c_ref = np.stack([np.sqrt(I1_ref), np.sqrt(I2_ref)], axis=-1)
+    # d det / dY_k = det * tr(Sigma^-1 E_k)
+    d_log_det = np.einsum('nij,kji->nk', np.linalg.inv(Sigma), E)
+    dc1 = 0.25 * I1[:, None] * d_log_det
+    # d tr((Sigma U)^2) / dY_k = 2 tr(U Sigma U E_k)
+    dI2 = -np.einsum('nij,kji->nk', np.matmul(_U, SU), E)
+    dc2 = dI2 / (2.0 * c[:, 1:])
+    R[:, :2] = c / c_ref - 1.0
+    dR[:, :2] = np.stack([dc1, dc2], axis=1) / c_ref[:, :, None]
+    # Equal emittances
+    e_sq = 0.5 * I2_ref[:, None, None]
+    EU = np.matmul(E, _U)
+    dSU2 = (np.einsum('kij,njl->nkil', EU, SU) 
+            + np.einsum('nij,kjl->nkil', SU, EU))
+    R_equal = (SU2 / e_sq + np.identity(4)).reshape(n_beams, 16)
+    dR_equal = (dSU2 / e_sq[:, None]).reshape(n_beams, 10, 16)
+    dR_equal = np.swapaxes(dR_equal, 1, 2)
+    R[equal], dR[equal] = R_equal[equal], dR_equal[equal]
+    return R, dR
+
+
+def match(Y0, Q, ext_foc, length, ds=0.01, tol=1e-10, floor=0.0, 
+          max_iters=20, Y_ref=None, rcond=1e-9, verbose=False):
+    """Find periodic (matched) moment vectors.
+    
+    Solves Y(L) = Y(0) with Newton's method; the one-period Jacobian comes
+    from `period_map` in the same pass as the residual. The moment equations 
+    conserve two `invariants`, so the matched solutions form a family 
+    labelled by the two intrinsic emittances. These are fixed by adding the
+    conditions c(Y) = c(Y_ref), where c = [det(Sigma)^(1/4), 
+    sqrt(-tr((Sigma U)^2) / 2)], with their gradients as extra rows of the
+    Newton system (for equal emittances, (Sigma U)^2 = -e^2 I is used 
+    instead; see `_emittance_residual`). Directions that are still free 
+    (e.g., the betatron phase at zero current) are found from the singular
+    values of the augmented system and fixed by requiring that the 
+    projection of Y onto them equals that of `Y_ref`. All beams are solved
+    together.
+    
+    Parameters
+    ----------
+    Y0 : ndarray, shape (n_beams, 10) or (10,)
+        Initial guess, e.g., the zero-current matched moments.
+    Q : float or ndarray, shape (n_beams,)
+        Dimensionless space charge perveance of each beam.
+    ext_foc : callable or `lattice.Lattice`
+        See `period_map`.
+    length : float
+        Period length [m].
+    ds : float
+        Maximum step size [m].
+    tol : float
+        Convergence tolerance for max|Y(L) - Y(0)| / max|Y(0)| and for the
+        relative error in the invariants.
+    floor : float or ndarray, shape (n_beams,)
+        Relative integration error of the discrete period map (see 
+        `period_map_error`). The discrete map only conserves the invariants
+        approximately, so the residual cannot fall much below this value; 
+        a beam is converged when the residual is below max(tol, floor).
+        Beams whose moment matrix is not positive definite are never 
+        converged.
+    max_iters : int
+        Maximum number of Newton iterations.
+    Y_ref : ndarray, same shape as Y0 (optional)
+        Reference moments whose invariants are kept; defaults to Y0.
+    rcond : float
+        Relative cutoff for small singular values. Directions below it are
+        treated as free and fixed to `Y_ref` (see above).
+    verbose : bool
+        Whether to print the largest residual after each iteration.
+        
+    Returns
+    -------
+    Y : ndarray, same shape as Y0
+        Matched moment vectors.
+    converged : ndarray, shape (n_beams,)
+        Whether each beam converged.
+    """
+    single = np.ndim(Y0) == 1
+    Y = np.array(np.atleast_2d(Y0), dtype=float)
+    n_beams = len(Y)
+    Q = np.broadcast_to(Q, (n_beams,))
+    if Y_ref is None:
+        Y_ref = Y.copy()
+    Y_ref = np.broadcast_to(Y_ref, Y.shape)
+    scale = np.max(np.abs(Y), axis=1)
+    tol = np.maximum(tol, np.broadcast_to(floor, (n_beams,)))
+    converged = np.zeros(n_beams, dtype=bool)
+    failed = np.zeros(n_beams, dtype=bool)
+    for iteration in range(max_iters):
+        active = ~(converged | failed)
+        if not np.any(active):
+            break
+        Y_end, Phi = period_map(Y[active], Q[active], ext_foc, length, ds)
+        R = (Y_end - Y[active]) / scale[active, None]
+        # Stop iterating on beams whose envelope blew up or whose moment
+        # matrix is no longer positive definite.
+        bad = (~np.all(np.isfinite(R), axis=1)
+               | ~np.all(np.isfinite(Phi), axis=(1, 2)))
+        bad[~bad] = ~_is_positive_definite(Y[active][~bad])
+        R_inv = np.full((len(R), 16), np.nan)
+        dR_inv = np.zeros((len(R), 16, 10))
+        R_inv[~bad], dR_inv[~bad] = _emittance_residual(Y[active][~bad], 
+                                                        Y_ref[active][~bad])
+        err = np.maximum(np.max(np.abs(R), axis=1), 
+                         np.max(np.abs(R_inv), axis=1))
+        if verbose:
+            print('iteration {}: max residual = {:.3e}'.format(
+                iteration, np.max(err[~bad]) if np.any(~bad) else np.nan))
+        done = ~bad & (err < tol[active])
+        converged[np.where(active)[0][done]] = True
+        failed[np.where(active)[0][bad]] = True
+        if np.all(done | bad):
+            break
+        keep = ~(done | bad)
+        active[active] = keep
+        dR_inv = dR_inv[keep] * scale[active, None, None]
+        A = np.concatenate([Phi[keep] - np.identity(10), dR_inv], axis=1)
+        R = np.concatenate([R[keep], R_inv[keep]], axis=1)
+        # Directions left free by periodicity and the invariants.
+        _, sv, Vt = np.linalg.svd(A)
+        N = Vt * (sv <= rcond * sv[:, :1])[:, :, None]
+        R_gauge = np.einsum('nij,nj->ni', N, 
+                            (Y[active] - Y_ref[active]) / scale[active, None])
+        A = np.concatenate([A, N], axis=1)
+        R = np.concatenate([R, R_gauge], axis=1)
+        step = np.matmul(np.linalg.pinv(A, rcond=rcond), R[:, :, None])
+        step = step[:, :, 0]
+        Y[active] -= step * scale[active, None]
+    if single:
+        return Y[0], converged[0]
+    return Y, converged
+
+
+def period_map_error(Y0, Q, ext_foc, length, ds=0.01):
+    """Estimate the relative integration error of `period_map`.
+    
+    The map with step `ds` is compared with the map with step `ds / 2`;
+    the error of a fourth-order method is 16/15 of the difference.
+    
+    Returns
+    -------
+    ndarray, shape (n_beams,)
+        max|error| / max|Y0| for each beam.
+    """
+    Y0 = np.atleast_2d(Y0)
+    Y1 = period_map(Y0, Q, ext_foc, length, ds)[0]
+    Y2 = period_map(Y0, Q, ext_foc, length, 0.5 * ds)[0]
+    error = (16.0 / 15.0) * np.max(np.abs(Y1 - Y2), axis=1)
+    return error / np.max(np.abs(Y0), axis=1)
+
+
+def match_ramp(Y0, Q_values, ext_foc, length, verbose=False, **kws):
+    """Continue the matched solution along a sequence of perveances.
+    
+    Each solution starts from a linear extrapolation of the two previous 
+    converged solutions (or from the last one, or `Y0`, if there are fewer).
+    `Y0` is the reference moment vector (`Y_ref` in `match`) for every 
+    solution.
+    
+    Parameters
+    ----------
+    Y0 : ndarray, shape (10,)
+        Matched (or approximately matched) moments at Q_values[0].
+    Q_values : ndarray, shape (n,)
+        The perveances, ordered along the ramp.
+    **kws
+        Key word arguments for `match`.
+        
+    Returns
+    -------
+    Y : ndarray, shape (n, 10)
+        Matched moments at each perveance.
+    converged : ndarray, shape (n,)
+    """
+    Y = np.zeros((len(Q_values), 10))
+    converged = np.zeros(len(Q_values), dtype=bool)
+    for i, Q in enumerate(Q_values):
+        prev = np.where(converged[:i])[0][-2:]
+        if len(prev) == 0:
+            guess = Y0
+        elif len(prev) == 1:
+            guess = Y[prev[0]]
+        else:
+            j, k = prev
+            t = (Q - Q_values[k]) / (Q_values[k] - Q_values[j])
+            guess = Y[k] + t * (Y[k] - Y[j])
+        Y[i], converged[i] = match(guess, Q, ext_foc, length, 
+                                   Y_ref=Y0, **kws)
+        if verbose:
+            print('Q = {:.3e}, converged = {}'.format(Q, converged[i]))
+    return Y, converged
@@ -0,0 +1,404 @@
+"""
+This module tracks the Danilov envelope (a tilted, uniformly charged
+ellipse in x-y with linear space charge forces) through a `lattice.Lattice`.
+
+It follows `TiltEnvCalculator` in envelope/Holmes_env_solver_code/
+SC_TiltEnv.cc, but works on a batch of envelopes at once and does not need
+PyORBIT. The envelope is described by the parameter vector
+[a, b, a', b', e, f, e', f']; the beam edge is x = a cos(psi) + b sin(psi),
+y = e cos(psi) + f sin(psi) for 0 <= psi < 2 pi. Each element is split
+into steps of at most `ds`, and each step is a half step of the linear
+transfer matrix, a space charge kick, and another half step. Test
+particles can be tracked with the envelope; they feel the field of the
+uniform ellipse, inside and outside, plus the field of the charges induced
+on an optional conducting wall.
+
+In the C++ code the elliptic coordinates (u, theta) of a point outside the
+ellipse are found by bisection. Here the field and potential are written
+in terms of w + sqrt(w^2 - c^2), with w = x + iy and c the focal distance,
+which is the same thing in closed form.
+"""
+import warnings
+
+import numpy as np
+
+import lattice as lt
+
+
+def to_mat(V):
+    """Return the (..., 4, 2) matrix [[a, b], [a', b'], [e, f], [e', f']]."""
+    V = np.asarray(V)
+    return V.reshape(V.shape[:-1] + (4, 2))
+
+
+def to_vec(P):
+    """Inverse of `to_mat`."""
+    P = np.asarray(P)
+    return P.reshape(P.shape[:-2] + (8,))
+
+
+def ellipse_params(V):
+    """Return the tilt angle and squared semi-axes of the beam ellipse.
+
+    This is `_getEllipsDat`. The ellipse is aligned with the axes after
+    rotating the coordinates by `tilt` (see `_frame`).
+
+    Returns
+    -------
+    tilt, cxsq, cysq : ndarray, shape (...,)
+    """
+    a, b, ap, bp, e, f, ep, fp = np.moveaxis(np.asarray(V, dtype=float), -1, 0)
+    arg1 = a * e + b * f
+    arg2 = a * a + b * b
+    arg3 = e * e + f * f
+    arg4 = a * f - b * e
+    tilt = 0.5 * np.arctan2(-2.0 * arg1, arg2 - arg3)
+    cs, sn = np.cos(tilt), np.sin(tilt)
+    cs2, sn2, cssn = cs * cs, sn * sn, cs * sn
+    cxsq = arg4**2 / (arg3 * cs2 + arg2 * sn2 + 2.0 * arg1 * cssn)
+    cysq = arg4**2 / (arg2 * cs2 + arg3 * sn2 - 2.0 * arg1 * cssn)
+    return tilt, cxsq, cysq
+
+
+def kick_envelope(V, Q, length):
+    """Apply the space charge kick of a slice to the envelope.
+
+    This is `_KickEnvelope`.
+
+    Parameters
+    ----------
+    V : ndarray, shape (..., 8)
+        Envelope parameters.
+    Q : float or ndarray, shape (...)
+        Dimensionless space charge perveance.
+    length : float
+        Length of the slice [m].
+
+    Returns
+    -------
+    ndarray, shape (..., 8)
+        The kicked envelope parameters.
+    """
+    V = np.array(V, dtype=float)
+    V[..., [2, 3, 6, 7]] += length * _sc_accel(V, Q)
+    return V
+
+
+def _sc_accel(V, Q):
+    """Space charge part of [a'', b'', e'', f'']."""
+    tilt, cxsq, cysq = ellipse_params(V)
+    cs, sn = np.cos(tilt), np.sin(tilt)
+    cs2, sn2, cssn = cs * cs, sn * sn, cs * sn
+    cx, cy = np.sqrt(cxsq), np.sqrt(cysq)
+    mult = 2.0 * np.asarray(Q) / (cx + cy)
+    a, b, e, f = V[..., 0], V[..., 1], V[..., 4], V[..., 5]
+    return mult[..., None] * np.stack([
+        (a * cs2 - e * cssn) / cx + (a * sn2 + e * cssn) / cy,
+        (b * cs2 - f * cssn) / cx + (b * sn2 + f * cssn) / cy,
+        (e * sn2 - a * cssn) / cx + (e * cs2 + a * cssn) / cy,
+        (f * sn2 - b * cssn) / cx + (f * cs2 + b * cssn) / cy,
+    ], axis=-1)
+
+
+def derivs(V, Q, k0xx, k0yy, k0xy):
+    """Derivative of the envelope parameters in constant focusing.
+
+    The focusing strengths follow `chernin.derivs`. Useful as a reference
+    for the thin-kick tracking in `track`.
+
+    Parameters
+    ----------
+    V : ndarray, shape (..., 8)
+        Envelope parameters.
+    Q : float or ndarray, shape (...)
+        Dimensionless space charge perveance.
+    k0xx, k0yy, k0xy : float
+        External focusing strengths.
+
+    Returns
+    -------
+    ndarray, shape (..., 8)
+    """
+    V = np.asarray(V, dtype=float)
+    a, b, ap, bp, e, f, ep, fp = np.moveaxis(V, -1, 0)
+    sc = _sc_accel(V, Q)
+    out = np.empty_like(V)
+    out[..., 0], out[..., 1] = ap, bp
+    out[..., 4], out[..., 5] = ep, fp
+    out[..., 2] = -k0xx * a + k0xy * e + sc[..., 0]
+    out[..., 3] = -k0xx * b + k0xy * f + sc[..., 1]
+    out[..., 6] = k0xy * a - k0yy * e + sc[..., 2]
+    out[..., 7] = k0xy * b - k0yy * f + sc[..., 3]
+    return out
+
+
+# Fields
+#------------------------------------------------------------------------------
+def _frame(V):
+    """Return the ellipse semi-axes and the map to the ellipse frame.
+
+    In the frame w' = rot * (x + iy) the ellipse is upright with the long
+    semi-axis a along x'. Following the C++ code, the coordinates are
+    rotated by the tilt angle and then by -90 degrees if cy > cx.
+
+    Returns
+    -------
+    a, b, c2 : ndarray
+        Long and short semi-axes and the squared focal distance.
+    rot : complex ndarray
+    """
+    tilt, cxsq, cysq = ellipse_params(V)
+    swap = cysq > cxsq
+    a = np.sqrt(np.where(swap, cysq, cxsq))
+    b = np.sqrt(np.where(swap, cxsq, cysq))
+    rot = np.exp(1j * tilt) * np.where(swap, -1j, 1.0)
+    return a, b, (a + b) * (a - b), rot
+
+
+def _outer_root(w, c2):
+    """Return w + sqrt(w^2 - c^2) with the branch that grows like 2 w."""
+    c = np.sqrt(c2)
+    return w + np.sqrt(w - c) * np.sqrt(w + c)
+
+
+def ellipse_field(x, y, V):
+    """Field of a uniform ellipse with unit perveance.
+
+    Inside the ellipse the field is linear; outside it falls off as 1/r.
+    The particle kick in a slice is Q * length * field. This is the first
+    part of `_ApplyForce`.
+
+    Parameters
+    ----------
+    x, y : ndarray, shape (..., n)
+        Particle coordinates.
+    V : ndarray, shape (..., 8)
+        Envelope parameters; the leading dimensions broadcast with x.
+
+    Returns
+    -------
+    Ex, Ey : ndarray, shape (..., n)
+    """
+    a, b, c2, rot = [np.asarray(p)[..., None] for p in _frame(V)]
+    w = rot * (np.asarray(x) + 1j * np.asarray(y))
+    inside = (w.real / a)**2 + (w.imag / b)**2 <= 1.0
+    E_in = 2.0 * (w.real / a + 1j * w.imag / b) / (a + b)
+    E_out = np.conj(2.0 / _outer_root(np.where(inside, a + 1.0, w), c2))
+    E = np.where(inside, E_in, E_out) * np.conj(rot)
+    return E.real, E.imag
+
+
+def _ellipse_potential(x, y, V):
+    """Potential outside the ellipse (up to a constant) for `Boundary`."""
+    a, b, c2, rot = [np.asarray(p)[..., None] for p in _frame(V)]
+    w = rot * (np.asarray(x) + 1j * np.asarray(y))
+    inside = (w.real / a)**2 + (w.imag / b)**2 < 1.0
+    z = _outer_root(w, c2)
+    return -np.real(np.log(z) + 0.5 * c2 / z**2), inside
+
+
+class Boundary:
+    """Conducting wall for the test particle kicks.
+
+    The potential of the charges induced on the wall is a sum of harmonic
+    functions Re(z^m), Im(z^m) (m = 0, ..., n_modes) with z = (x + iy) /
+    r_norm. The coefficients are fitted so that the total potential is
+    constant on the wall points (`_BoundaryCoeffs`); the wall field is
+    added to the particle kicks (`_ApplyForce`).
+
+    Parameters
+    ----------
+    x, y : ndarray, shape (n_points,)
+        Points on the wall.
+    n_modes : int
+        Number of harmonics.
+    r_norm : float (optional)
+        Normalization radius. Defaults to the largest radius of the points.
+    """
+    def __init__(self, x, y, n_modes=10, r_norm=None):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.n_modes = n_modes
+        if r_norm is None:
+            r_norm = np.max(np.sqrt(self.x**2 + self.y**2))
+        self.r_norm = r_norm
+        z = (self.x + 1j * self.y) / r_norm
+        H = np.ones((len(z), 2 * n_modes + 1))
+        for m in range(1, n_modes + 1):
+            H[:, 2 * m - 1] = np.real(z**m)
+            H[:, 2 * m] = np.imag(z**m)
+        self.H = H
+        self.Hinv = np.linalg.pinv(H)
+
+    @classmethod
+    def circle(cls, radius, n_points=128, **kws):
+        """Circular wall."""
+        theta = np.linspace(0.0, 2.0 * np.pi, n_points, endpoint=False)
+        return cls(radius * np.cos(theta), radius * np.sin(theta), **kws)
+
+    def coeffs(self, V):
+        """Return the harmonic coefficients for each envelope.
+
+        Parameters
+        ----------
+        V : ndarray, shape (..., 8)
+
+        Returns
+        -------
+        ndarray, shape (..., 2 * n_modes + 1)
+            The coefficients are zero for envelopes that cross the wall, in
+            which case the wall term is skipped as in the C++ code. A 
+            warning is issued (once, with the default warning filters).
+        """
+        phi, inside = _ellipse_potential(self.x, self.y, V)
+        coeffs = -np.matmul(phi, self.Hinv.T)
+        crosses = np.any(inside, axis=-1)
+        if np.any(crosses):
+            warnings.warn('Beam crosses boundary; the wall term is skipped '
+                          'for those envelopes.', RuntimeWarning)
+            coeffs[crosses] = 0.0
+        return coeffs
+
+    def field(self, x, y, coeffs):
+        """Field of the wall charges at (x, y).
+
+        Parameters
+        ----------
+        x, y : ndarray, shape (..., n)
+        coeffs : ndarray, shape (..., 2 * n_modes + 1)
+            From `coeffs`.
+
+        Returns
+        -------
+        Ex, Ey : ndarray, shape (..., n)
+        """
+        z = (np.asarray(x) + 1j * np.asarray(y)) / self.r_norm
+        C = coeffs[..., 1::2] - 1j * coeffs[..., 2::2]
+        # d/dw sum_m C_m z^m, evaluated with Horner's rule.
+        dF = np.zeros(z.shape, dtype=complex)
+        for m in range(self.n_modes, 0, -1):
+            dF = dF * z + m * C[..., m - 1, None]
+        E = -np.conj(dF) / self.r_norm
+        return E.real, E.imag
+
+
+def kick_particles(X, V, Q, length, boundary=None):
+    """Apply the space charge kick of a slice to test particles.
+
+    This is `_ApplyForce`.
+
+    Parameters
+    ----------
+    X : ndarray, shape (..., n, 4)
+        Particle coordinates [x, x', y, y'].
+    V : ndarray, shape (..., 8)
+        Envelope parameters.
+    Q : float or ndarray, shape (...)
+        Dimensionless space charge perveance.
+    length : float
+        Length of the slice [m].
+    boundary : Boundary (optional)
+        Conducting wall.
+
+    Returns
+    -------
+    ndarray, shape (..., n, 4)
+        The kicked coordinates.
+    """
+    X = np.array(X, dtype=float)
+    x, y = X[..., 0], X[..., 2]
+    Ex, Ey = ellipse_field(x, y, V)
+    if boundary is not None:
+        Ex_wall, Ey_wall = boundary.field(x, y, boundary.coeffs(V))
+        Ex, Ey = Ex + Ex_wall, Ey + Ey_wall
+    factor = np.asarray(Q)[..., None] * length
+    X[..., 1] += factor * Ex
+    X[..., 3] += factor * Ey
+    return X
+
+
+# Tracking
+#------------------------------------------------------------------------------
+def _element_steps(lattice, ds):
+    """Yield (M_in, M_half, n_steps, h, M_out) for each element."""
+    for kind, L, k in lattice.elements:
+        n_steps = max(1, int(np.ceil(L / ds)))
+        h = L / n_steps
+        yield (lt.fringe_matrix(kind, k, entrance=True),
+               lt.body_matrix(kind, 0.5 * h, k), n_steps, h,
+               lt.fringe_matrix(kind, k, entrance=False))
+
+
+def track(V0, Q, lattice, ds=0.01, n_periods=1, X=None, boundary=None):
+    """Track envelopes (and test particles) through a lattice.
+
+    Parameters
+    ----------
+    V0 : ndarray, shape (n_beams, 8) or (8,)
+        Initial envelope parameters.
+    Q : float or ndarray, shape (n_beams,)
+        Dimensionless space charge perveance of each beam.
+    lattice : lattice.Lattice
+        One period.
+    ds : float
+        Maximum step (distance between kicks) [m].
+    n_periods : int
+        Number of periods to track.
+    X : ndarray, shape (n_beams, n, 4) or (n, 4) (optional)
+        Test particle coordinates [x, x', y, y'].
+    boundary : Boundary (optional)
+        Conducting wall for the test particle kicks.
+
+    Returns
+    -------
+    positions : ndarray, shape (n_points,)
+        Step boundaries [m] (see `lattice.Lattice.positions`).
+    envelopes : ndarray, shape (n_beams, n_points, 8) or (n_points, 8)
+        Envelope parameters at each position.
+    X : ndarray
+        Final test particle coordinates, if `X` was given.
+    """
+    single = np.ndim(V0) == 1
+    P = to_mat(np.array(np.atleast_2d(V0), dtype=float))
+    n_beams = len(P)
+    Q = np.broadcast_to(np.asarray(Q, dtype=float), (n_beams,))
+    space_charge = np.any(Q != 0)
+    if X is not None:
+        X = np.array(X, dtype=float)
+        if X.ndim == 2:
+            X = np.broadcast_to(X, (n_beams,) + X.shape).copy()
+    steps = list(_element_steps(lattice, ds))
+    envelopes = [to_vec(P)]
+
+    def transport(M):
+        nonlocal P, X
+        P = np.matmul(M, P)
+        if X is not None:
+            X = np.matmul(X, M.T)
+
+    for _ in range(n_periods):
+        for M_in, M_half, n_steps, h, M_out in steps:
+            transport(M_in)
+            for _ in range(n_steps):
+                transport(M_half)
+                if space_charge:
+                    V = to_vec(P)
+                    if X is not None:
+                        X = kick_particles(X, V, Q, h, boundary)
+                    P = to_mat(kick_envelope(V, Q, h))
+                transport(M_half)
+                envelopes.append(to_vec(P))
+            transport(M_out)
+            envelopes[-1] = to_vec(P)
+
+    positions = lattice.positions(ds)
+    positions = np.concatenate(
+        [positions[:1]]
+        + [i * lattice.length + positions[1:] for i in range(n_periods)])
+    envelopes = np.stack(envelopes, axis=1)
+    if single:
+        envelopes = envelopes[0]
+        X = None if X is None else X[0]
+    if X is None:
+        return positions, envelopes
+    return positions, envelopes, X
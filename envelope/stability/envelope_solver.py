@@ -5,7 +5,7 @@ Note: this is old and needs to be updated.
 """
 import numpy as np
 from scipy.integrate import odeint
-import envelope_analysis as ea
+import danilov
 
 
 def chernin_derivs(s, v, perveance, focusing_strength, deriv_calc='matrix'):
@@ -102,28 +102,8 @@ def danilov_derivs(s, v, perveance, focusing_strength):
     w : NumPy array
         Derivative of v with respect to s.
     """
-    a, b, ap, bp, e, f, ep, fp = v
-        
-    phi = ea.tilt_angle(v)
-    cos, sin = np.cos(phi), np.sin(phi)
-    cos2, sin2 = cos**2, sin**2
-    a2b2, e2f2 = a**2 + b**2, e**2 + f**2
-    
-    cx, cy = ea.cxcy(v)
-    T = 2 * perveance / (cx + cy)
-    
     k0x = focusing_strength(s)
-    k0y = -k0x
-    
-    w = np.zeros(8)
-    w[0] = ap
-    w[1] = bp
-    w[2] = -k0x*a + T*((a*cos2 - e*sin*cos)/cx + (a*sin2 + e*sin*cos)/cy)
-    w[3] = -k0x*b + T*((e*sin2 - a*sin*cos)/cx + (e*cos2 + a*sin*cos)/cy)
-    w[4] = ep
-    w[5] = fp
-    w[6] = -k0y*e + T*((b*cos2 - f*sin*cos)/cx + (b*sin2 + f*sin*cos)/cy)
-    w[7] = -k0y*f + T*((f*sin2 - b*sin*cos)/cx + (f*cos2 + b*sin*cos)/cy)
+    w = danilov.derivs(v, perveance, k0x, -k0x, 0.0)
     return w
     
 
@@ -0,0 +1,308 @@
+"""
+This module describes a periodic lattice as a sequence of hard-edge
+elements for the envelope solvers.
+
+Within each element the external focusing is constant, so the linear
+transfer matrix over any part of it is known in closed form. Integrators
+step exactly to the element boundaries: they never straddle a
+discontinuity in the focusing and never call a Python function to look up
+the focusing strength. Without space charge the moments are transported
+with the closed-form matrices; with space charge the moment equations are
+integrated with RK4 inside each element.
+
+Element strengths follow `chernin.derivs`: in a quadrupole with strength
+k, x'' = -k x and y'' = k y; in a skew quadrupole x'' = k y and y'' = k x;
+in a solenoid with strength k = B / (2 B rho), x'' = 2 k y' and
+y'' = -2 k x', with thin fringe kicks at both ends.
+"""
+import numpy as np
+
+import chernin as ch
+
+
+element_kinds = ['drift', 'quad', 'skew_quad', 'solenoid']
+
+
+# Transfer matrices
+#------------------------------------------------------------------------------
+def _focusing_block(L, k):
+    """2 x 2 transfer matrix for u'' = -k u."""
+    if k > 0:
+        w = np.sqrt(k)
+        return np.array([[np.cos(w * L), np.sin(w * L) / w],
+                         [-w * np.sin(w * L), np.cos(w * L)]])
+    elif k < 0:
+        w = np.sqrt(-k)
+        return np.array([[np.cosh(w * L), np.sinh(w * L) / w],
+                         [w * np.sinh(w * L), np.cosh(w * L)]])
+    return np.array([[1.0, L], [0.0, 1.0]])
+
+
+def body_matrix(kind, L, k):
+    """Transfer matrix of the body of an element (no fringe kicks).
+
+    L can be any part of the element length.
+    """
+    M = np.zeros((4, 4))
+    if kind == 'drift':
+        M[:2, :2] = M[2:, 2:] = _focusing_block(L, 0.0)
+    elif kind == 'quad':
+        M[:2, :2] = _focusing_block(L, k)
+        M[2:, 2:] = _focusing_block(L, -k)
+    elif kind == 'skew_quad':
+        # u = (x + y) / sqrt(2) is defocused, v = (x - y) / sqrt(2) is focused.
+        Mu, Mv = _focusing_block(L, -k), _focusing_block(L, k)
+        M[:2, :2] = M[2:, 2:] = 0.5 * (Mu + Mv)
+        M[:2, 2:] = M[2:, :2] = 0.5 * (Mu - Mv)
+    elif kind == 'solenoid':
+        if k == 0:
+            return body_matrix('drift', L, 0.0)
+        C, S = np.cos(2 * k * L), np.sin(2 * k * L)
+        M[0] = [1.0, S / (2 * k), 0.0, (1 - C) / (2 * k)]
+        M[1] = [0.0, C, 0.0, S]
+        M[2] = [0.0, -(1 - C) / (2 * k), 1.0, S / (2 * k)]
+        M[3] = [0.0, -S, 0.0, C]
+    else:
+        raise ValueError("Invalid element kind '{}'".format(kind))
+    return M
+
+
+def fringe_matrix(kind, k, entrance=True):
+    """Thin fringe-field kick at the entrance or exit of an element."""
+    M = np.identity(4)
+    if kind == 'solenoid':
+        sign = 1.0 if entrance else -1.0
+        M[1, 2] = sign * k
+        M[3, 0] = -sign * k
+    return M
+
+
+def element_matrix(kind, L, k):
+    """Transfer matrix of a full element including fringe kicks."""
+    return np.linalg.multi_dot([fringe_matrix(kind, k, entrance=False),
+                                body_matrix(kind, L, k),
+                                fringe_matrix(kind, k, entrance=True)])
+
+
+def generator(kind, k):
+    """Return A such that d[x, x', y, y']/ds = A [x, x', y, y'] in the body."""
+    A = np.zeros((4, 4))
+    A[0, 1] = A[2, 3] = 1.0
+    if kind == 'quad':
+        A[1, 0], A[3, 2] = -k, k
+    elif kind == 'skew_quad':
+        A[1, 2] = A[3, 0] = k
+    elif kind == 'solenoid':
+        A[1, 3], A[3, 1] = 2 * k, -2 * k
+    elif kind != 'drift':
+        raise ValueError("Invalid element kind '{}'".format(kind))
+    return A
+
+
+def moment_matrix(M):
+    """Return T such that mat2vec(M Sigma M^T) = T mat2vec(Sigma)."""
+    E = ch.vec2mat(np.identity(10))
+    return ch.mat2vec(np.matmul(np.matmul(M, E), M.T)).T
+
+
+def moment_generator(A):
+    """Return G such that mat2vec(A Sigma + Sigma A^T) = G mat2vec(Sigma)."""
+    E = ch.vec2mat(np.identity(10))
+    AE = np.matmul(A, E)
+    return ch.mat2vec(AE + np.swapaxes(AE, -1, -2)).T
+
+
+# Lattice
+#------------------------------------------------------------------------------
+class Lattice:
+    """Periodic sequence of hard-edge elements.
+
+    Attributes
+    ----------
+    elements : list[tuple]
+        (kind, length, strength) of each element.
+    """
+    def __init__(self):
+        self.elements = []
+
+    @property
+    def length(self):
+        return sum(L for kind, L, k in self.elements)
+
+    def add(self, kind, length, k=0.0):
+        """Add an element to the end of the lattice."""
+        if kind not in element_kinds:
+            raise ValueError("Invalid element kind '{}'".format(kind))
+        self.elements.append((kind, float(length), float(k)))
+
+    def add_drift(self, length):
+        self.add('drift', length)
+
+    def add_quad(self, length, k):
+        self.add('quad', length, k)
+
+    def add_skew_quad(self, length, k):
+        self.add('skew_quad', length, k)
+
+    def add_solenoid(self, length, k):
+        self.add('solenoid', length, k)
+
+    def scaled(self, factor):
+        """Return a copy with every strength multiplied by `factor`."""
+        lattice = Lattice()
+        lattice.elements = [(kind, L, factor * k)
+                            for kind, L, k in self.elements]
+        return lattice
+
+    def transfer_matrix(self):
+        """Zero-current 4 x 4 transfer matrix of one period."""
+        M = np.identity(4)
+        for kind, L, k in self.elements:
+            M = np.matmul(element_matrix(kind, L, k), M)
+        return M
+
+    def positions(self, ds):
+        """Positions reached by `track` in one period.
+
+        Each element is split into ceil(L / ds) equal steps.
+        """
+        positions = [0.0]
+        for kind, L, k in self.elements:
+            n_steps = max(1, int(np.ceil(L / ds)))
+            steps = L * np.arange(1, n_steps + 1) / n_steps
+            positions.extend(positions[-1] + steps)
+        return np.array(positions)
+
+    def _steps(self, ds):
+        """Yield (T_in, T_step, G, h, n_steps, T_out) for each element.
+
+        T_in, T_out and T_step are moment transfer matrices of the fringe
+        kicks and of one step without space charge. G is the generator of
+        the external focusing, without the drift part that is already in
+        `chernin.derivs_ensemble`.
+        """
+        A_drift = generator('drift', 0.0)
+        for kind, L, k in self.elements:
+            n_steps = max(1, int(np.ceil(L / ds)))
+            h = L / n_steps
+            yield (moment_matrix(fringe_matrix(kind, k, entrance=True)),
+                   moment_matrix(body_matrix(kind, h, k)),
+                   moment_generator(generator(kind, k) - A_drift),
+                   h, n_steps,
+                   moment_matrix(fringe_matrix(kind, k, entrance=False)))
+
+    def track(self, Y0, Q, ds=0.01, n_periods=1):
+        """Track moment vectors through the lattice.
+
+        Parameters
+        ----------
+        Y0 : ndarray, shape (n_beams, 10)
+            Initial moment vectors (see `chernin.derivs`).
+        Q : float or ndarray, shape (n_beams,)
+            Dimensionless space charge perveance of each beam. If all are
+            zero, the closed-form transfer matrices are used.
+        ds : float
+            Maximum step size [m].
+        n_periods : int
+            Number of periods to track.
+
+        Returns
+        -------
+        positions : ndarray, shape (n_points,)
+            Step boundaries [m].
+        moments : ndarray, shape (n_beams, n_points, 10)
+            Moment vectors at each position. At element boundaries they are
+            taken between the two elements' fringe kicks.
+        """
+        Y = np.array(np.atleast_2d(Y0), dtype=float)
+        Q = np.broadcast_to(Q, (len(Y),))
+        space_charge = np.any(Q != 0)
+        steps = list(self._steps(ds))
+        moments = [Y.copy()]
+        for _ in range(n_periods):
+            for T_in, T_step, G, h, n_steps, T_out in steps:
+                Y = np.matmul(Y, T_in.T)
+                for _ in range(n_steps):
+                    if space_charge:
+                        Y = self._rk4_step(Y, Q, G, h)
+                    else:
+                        Y = np.matmul(Y, T_step.T)
+                    moments.append(Y)
+                Y = np.matmul(Y, T_out.T)
+                moments[-1] = Y
+        positions = self.positions(ds)
+        positions = np.concatenate(
+            [positions[:1]]
+            + [i * self.length + positions[1:] for i in range(n_periods)])
+        return positions, np.stack(moments, axis=1)
+
+    @staticmethod
+    def _rk4_step(Y, Q, G, h):
+        def f(Y):
+            return ch.derivs_ensemble(Y, Q, 0.0, 0.0, 0.0) + np.matmul(Y, G.T)
+        k1 = f(Y)
+        k2 = f(Y + 0.5 * h * k1)
+        k3 = f(Y + 0.5 * h * k2)
+        k4 = f(Y + h * k3)
+        return Y + (h / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+
+    def period_map(self, Y0, Q, ds=0.01):
+        """Track over one period together with the perturbation matrix.
+
+        This is `chernin.period_map` for the lattice. Without space charge
+        the closed-form period map is returned.
+
+        Returns
+        -------
+        Y : ndarray, shape (n_beams, 10)
+        Phi : ndarray, shape (n_beams, 10, 10)
+        """
+        Y = np.array(np.atleast_2d(Y0), dtype=float)
+        n_beams = len(Y)
+        Q = np.broadcast_to(Q, (n_beams,))
+        if not np.any(Q != 0):
+            T = moment_matrix(self.transfer_matrix())
+            return np.matmul(Y, T.T), np.broadcast_to(T, (n_beams, 10, 10)).copy()
+
+        Phi = np.broadcast_to(np.identity(10), (n_beams, 10, 10)).copy()
+
+        def rhs(Y, Phi, G):
+            J = ch.jacobian_ensemble(Y, Q, 0.0, 0.0, 0.0) + G
+            return (ch.derivs_ensemble(Y, Q, 0.0, 0.0, 0.0) + np.matmul(Y, G.T),
+                    np.matmul(J, Phi))
+
+        for T_in, T_step, G, h, n_steps, T_out in self._steps(ds):
+            Y, Phi = np.matmul(Y, T_in.T), np.matmul(T_in, Phi)
+            for _ in range(n_steps):
+                k1, l1 = rhs(Y, Phi, G)
+                k2, l2 = rhs(Y + 0.5 * h * k1, Phi + 0.5 * h * l1, G)
+                k3, l3 = rhs(Y + 0.5 * h * k2, Phi + 0.5 * h * l2, G)
+                k4, l4 = rhs(Y + h * k3, Phi + h * l3, G)
+                Y = Y + (h / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+                Phi = Phi + (h / 6.0) * (l1 + 2.0 * l2 + 2.0 * l3 + l4)
+            Y, Phi = np.matmul(Y, T_out.T), np.matmul(T_out, Phi)
+        return Y, Phi
+
+
+def fodo(k1, k2, L, fill_fac=0.5, start='quad'):
+    """Create a FODO lattice (see `tools.matrix_lattice.fodo`).
+
+    k1 and k2 are the magnitudes of the focusing and defocusing quadrupole
+    strengths.
+    """
+    Lquad = fill_fac * L / 2
+    Ldrift = (1 - fill_fac) * L / 2
+    lattice = Lattice()
+    if start == 'quad':
+        lattice.add_quad(0.5 * Lquad, k1)
+        lattice.add_drift(Ldrift)
+        lattice.add_quad(Lquad, -k2)
+        lattice.add_drift(Ldrift)
+        lattice.add_quad(0.5 * Lquad, k1)
+    elif start == 'drift':
+        lattice.add_drift(0.5 * Ldrift)
+        lattice.add_quad(Lquad, k1)
+        lattice.add_drift(Ldrift)
+        lattice.add_quad(Lquad, -k2)
+        lattice.add_drift(0.5 * Ldrift)
+    return lattice
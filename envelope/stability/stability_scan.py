@@ -0,0 +1,366 @@
+"""
+This module maps envelope instabilities over a grid of zero-current phase
+advances and perveances.
+
+At each grid point the matched moments are found with `chernin.match` and
+the 10 x 10 perturbation transfer matrix is integrated over one period.
+Envelope perturbations grow if any of its eigenvalues has magnitude larger
+than one. Rows of the grid (one phase advance, all perveances) are solved in
+parallel; within a row the matched solution is continued along the
+perveance with `chernin.match_ramp`. Each finished row is saved to its own
+file, so an interrupted scan picks up where it stopped.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+import numpy as np
+from scipy import optimize as opt
+
+import chernin as ch
+
+
+class _ScaledFocusing:
+    """Focusing strength looked up from samples at the RK4 stage positions.
+
+    `chernin.period_map` only evaluates the focusing at s = j * h / 2. The
+    samples are taken once in the parent process, so the user's `ext_foc`
+    does not need to be picklable. They cover the steps of both maps in
+    `chernin.period_map_error`. `scaled` and `transfer_matrix` mirror
+    `lattice.Lattice`.
+    """
+    def __init__(self, table, samples, h, scale=1.0):
+        self.table = table
+        self.samples = samples
+        self.h = h
+        self.scale = scale
+
+    def __call__(self, s):
+        return self.scale * self.table[s]
+
+    def scaled(self, factor):
+        return _ScaledFocusing(self.table, self.samples, self.h,
+                               self.scale * factor)
+
+    def transfer_matrix(self):
+        return transfer_matrix(self.scale * self.samples, self.h)
+
+
+def _stage_positions(length, ds):
+    """Positions where `chernin.period_map` evaluates the focusing."""
+    n_steps = max(1, int(np.ceil(length / ds)))
+    h = length / n_steps
+    return 0.5 * h * np.arange(2 * n_steps + 1), h
+
+
+def _sample_focusing(ext_foc, length, ds):
+    table = dict()
+    for step in [0.5 * ds, ds]:
+        positions, h = _stage_positions(length, step)
+        for s in positions:
+            if s not in table:
+                table[s] = np.array(ext_foc(s), dtype=float)
+    samples = np.array([table[s] for s in positions])
+    return _ScaledFocusing(table, samples, h)
+
+
+def transfer_matrix(samples, h):
+    """Return the zero-current 4 x 4 transfer matrix of one period.
+
+    Parameters
+    ----------
+    samples : ndarray, shape (2 * n_steps + 1, 3)
+        Focusing strengths [k0xx, k0yy, k0xy] at s = j * h / 2.
+    h : float
+        Step size [m].
+    """
+    def A(k0xx, k0yy, k0xy):
+        return np.array([[0.0, 1.0, 0.0, 0.0],
+                         [-k0xx, 0.0, k0xy, 0.0],
+                         [0.0, 0.0, 0.0, 1.0],
+                         [k0xy, 0.0, -k0yy, 0.0]])
+
+    M = np.identity(4)
+    for j in range(0, len(samples) - 1, 2):
+        A0, A_half, A1 = A(*samples[j]), A(*samples[j + 1]), A(*samples[j + 2])
+        k1 = np.matmul(A0, M)
+        k2 = np.matmul(A_half, M + 0.5 * h * k1)
+        k3 = np.matmul(A_half, M + 0.5 * h * k2)
+        k4 = np.matmul(A1, M + h * k3)
+        M = M + (h / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+    return M
+
+
+def focusing_scale(focusing, phase_advance, max_scale=1e6):
+    """Return the factor by which to scale the focusing to get a phase advance.
+
+    The phase advance is computed from the horizontal 2 x 2 block of the
+    transfer matrix. The first (lowest) solution is returned.
+
+    Parameters
+    ----------
+    focusing : lattice.Lattice
+        Anything with `scaled` and `transfer_matrix` methods.
+    phase_advance : float
+        Horizontal zero-current phase advance per period [deg].
+    max_scale : float
+        Give up if no solution is found below this factor.
+    """
+    cos_mu = np.cos(np.radians(phase_advance))
+
+    def residual(scale):
+        M = focusing.scaled(scale).transfer_matrix()
+        return 0.5 * (M[0, 0] + M[1, 1]) - cos_mu
+
+    hi = 1e-3
+    while residual(hi) > 0.0:
+        hi *= 1.25
+        if hi > max_scale:
+            raise ValueError('No focusing scale found for phase advance {}.'
+                             .format(phase_advance))
+    return opt.brentq(residual, hi / 1.25, hi, xtol=1e-14, rtol=1e-12)
+
+
+def matched_moments_zero_current(M, eps1, eps2):
+    """Return zero-current matched moments from the period transfer matrix.
+
+    The moment matrix is Sigma = c1 Re(v1 v1^H) + c2 Re(v2 v2^H), where
+    v1 and v2 are eigenvectors of M and c1, c2 are chosen to give
+    intrinsic emittances eps1 and eps2. Mode 1 is the one with the larger
+    horizontal component.
+
+    Parameters
+    ----------
+    M : ndarray, shape (4, 4)
+        Stable transfer matrix.
+    eps1, eps2 : float
+        Intrinsic emittances (in the units of the moments).
+
+    Returns
+    -------
+    ndarray, shape (10,)
+    """
+    eigvals, eigvecs = np.linalg.eig(M)
+    idx = np.where(eigvals.imag > 0.0)[0]
+    if len(idx) != 2:
+        raise ValueError('The transfer matrix is not stable.')
+    V = eigvecs[:, idx]
+    idx = np.argsort(-np.sum(np.abs(V[:2, :])**2, axis=0))
+    Sigma = np.zeros((4, 4))
+    for v, eps in zip(V[:, idx].T, [eps1, eps2]):
+        Sigma_mode = np.real(np.outer(v, np.conj(v)))
+        e = np.sqrt(ch.invariants(ch.mat2vec(Sigma_mode))[1])
+        Sigma += (eps / e) * Sigma_mode
+    return ch.mat2vec(Sigma)
+
+
+def _row_filename(path, i):
+    return os.path.join(path, 'row_{:04d}.npz'.format(i))
+
+
+def _scan_row(i, phase_advance, focusing, length, perveances, eps1, eps2,
+              ds, path, match_kws):
+    """Solve one row of the grid and save it if `path` is given."""
+    scale = focusing_scale(focusing, phase_advance)
+    ext_foc = focusing.scaled(scale)
+    Y0 = matched_moments_zero_current(ext_foc.transfer_matrix(), eps1, eps2)
+    # Continue from zero current in increasing perveance.
+    order = np.argsort(perveances)
+    Q_values = np.asarray(perveances, dtype=float)[order]
+    start = 0 if Q_values[0] == 0.0 else 1
+    Q_values = np.concatenate([[0.0], Q_values]) if start else Q_values
+    match_kws = dict(match_kws)
+    if 'floor' not in match_kws:
+        # The discrete period map only has approximate fixed points.
+        error = ch.period_map_error(np.tile(Y0, (len(Q_values), 1)), Q_values,
+                                    ext_foc, length, ds=ds)
+        match_kws['floor'] = 10.0 * np.max(error)
+    Y, converged = ch.match_ramp(Y0, Q_values, ext_foc, length, ds=ds,
+                                 **match_kws)
+    # The zero-current solution is known in closed form.
+    Y[0], converged[0] = Y0, True
+    # Reject unphysical solutions and solutions whose emittances drifted.
+    drift = np.max(np.abs(ch.invariants(Y) / ch.invariants(Y0) - 1.0), axis=1)
+    max_drift = 10.0 * max(match_kws.get('tol', 0.0), match_kws['floor'])
+    positive = np.all(np.linalg.eigvalsh(ch.vec2mat(Y)) > 0.0, axis=1)
+    converged &= positive & (drift <= max_drift)
+    Y, converged = Y[start:], converged[start:]
+    Q_values = Q_values[start:]
+
+    n = len(Q_values)
+    eigvals = np.full((n, 10), np.nan, dtype=complex)
+    if np.any(converged):
+        _, Phi = ch.period_map(Y[converged], Q_values[converged], ext_foc,
+                               length, ds=ds)
+        eigvals[converged] = np.linalg.eigvals(Phi)
+    Y[~converged] = np.nan
+
+    # Undo the sort.
+    inverse = np.argsort(order)
+    row = dict(
+        phase_advance=phase_advance,
+        perveances=np.asarray(perveances, dtype=float),
+        scale=scale,
+        moments=Y[inverse],
+        eigvals=eigvals[inverse],
+        converged=converged[inverse],
+    )
+    if path is not None:
+        temp_filename = os.path.join(path, 'row_{:04d}_temp.npz'.format(i))
+        np.savez(temp_filename, **row)
+        os.replace(temp_filename, _row_filename(path, i))
+    return i, row
+
+
+def load_scan(path):
+    """Collect the rows of a (possibly unfinished) scan saved by `scan`.
+
+    Rows that have not been computed are filled with NaN.
+
+    Returns
+    -------
+    dict
+        'phase_advances' : ndarray, shape (n,)
+            Zero-current phase advances [deg].
+        'perveances' : ndarray, shape (m,)
+            Perveances.
+        'scale' : ndarray, shape (n,)
+            Factor multiplying `ext_foc` for each phase advance.
+        'moments' : ndarray, shape (n, m, 10)
+            Matched moments.
+        'eigvals' : ndarray, shape (n, m, 10)
+            Eigenvalues of the perturbation transfer matrix.
+        'growth' : ndarray, shape (n, m)
+            Largest eigenvalue magnitude; perturbations grow by this factor
+            per period.
+        'converged' : ndarray, shape (n, m)
+            Whether the matched solution was found.
+        'done' : ndarray, shape (n,)
+            Whether each row has been computed.
+    """
+    grid = np.load(os.path.join(path, 'grid.npz'))
+    phase_advances, perveances = grid['phase_advances'], grid['perveances']
+    n, m = len(phase_advances), len(perveances)
+    data = dict(
+        phase_advances=phase_advances,
+        perveances=perveances,
+        scale=np.full(n, np.nan),
+        moments=np.full((n, m, 10), np.nan),
+        eigvals=np.full((n, m, 10), np.nan, dtype=complex),
+        converged=np.zeros((n, m), dtype=bool),
+        done=np.zeros(n, dtype=bool),
+    )
+    for i in range(n):
+        filename = _row_filename(path, i)
+        if not os.path.exists(filename):
+            continue
+        row = np.load(filename)
+        for key in ['scale', 'moments', 'eigvals', 'converged']:
+            data[key][i] = row[key]
+        data['done'][i] = True
+    data['growth'] = np.max(np.abs(data['eigvals']), axis=-1)
+    return data
+
+
+def scan(ext_foc, length, phase_advances, perveances, eps1, eps2, ds=0.01,
+         tol=1e-8, path=None, n_workers=1, verbose=True, **match_kws):
+    """Map envelope instabilities over phase advance and perveance.
+
+    Parameters
+    ----------
+    ext_foc : callable or `lattice.Lattice`
+        Focusing over one period; see `chernin.period_map`. It is scaled by
+        a constant factor to set the zero-current phase advance.
+    length : float
+        Period length [m]. Ignored if `ext_foc` is a `Lattice`.
+    phase_advances : ndarray, shape (n,)
+        Horizontal zero-current phase advances per period [deg].
+    perveances : ndarray, shape (m,)
+        Dimensionless space charge perveances.
+    eps1, eps2 : float
+        Intrinsic emittances of the matched beam (in the units of the
+        moments). They are kept fixed at nonzero perveance.
+    ds : float
+        Maximum step size [m].
+    tol : float
+        Convergence tolerance for `chernin.match`. Unless `floor` is passed
+        in `match_kws`, it is raised to ten times the integration error 
+        over one period (`chernin.period_map_error`) in each row. Solutions
+        that are not positive definite, or whose invariants differ from 
+        those at zero current by more than ten times the tolerance, are 
+        marked as not converged. The zero-current solution is computed in
+        closed form.
+    path : str (optional)
+        Folder for the results. Each finished row is saved there, and rows
+        that already exist are not recomputed.
+    n_workers : int
+        Number of processes. If 1, everything runs in this process.
+    verbose : bool
+        Whether to print a line when each row is finished.
+    **match_kws
+        Key word arguments for `chernin.match`.
+
+    Returns
+    -------
+    dict
+        See `load_scan`.
+    """
+    phase_advances = np.asarray(phase_advances, dtype=float)
+    perveances = np.asarray(perveances, dtype=float)
+    if hasattr(ext_foc, 'period_map'):
+        focusing, length = ext_foc, ext_foc.length
+    else:
+        focusing = _sample_focusing(ext_foc, length, ds)
+    match_kws['tol'] = tol
+
+    todo = list(range(len(phase_advances)))
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        grid_filename = os.path.join(path, 'grid.npz')
+        if os.path.exists(grid_filename):
+            grid = np.load(grid_filename)
+            if not (np.array_equal(grid['phase_advances'], phase_advances)
+                    and np.array_equal(grid['perveances'], perveances)):
+                raise ValueError('{} holds a scan over a different grid.'
+                                 .format(path))
+        else:
+            np.savez(grid_filename, phase_advances=phase_advances,
+                     perveances=perveances)
+        todo = [i for i in todo if not os.path.exists(_row_filename(path, i))]
+        if verbose and len(todo) < len(phase_advances):
+            print('Resuming: {} of {} rows left.'.format(len(todo),
+                                                         len(phase_advances)))
+
+    rows = dict()
+    args = [(i, phase_advances[i], focusing, length, perveances, eps1, eps2,
+             ds, path, match_kws) for i in todo]
+
+    def report(i, row):
+        rows[i] = row
+        if verbose:
+            converged = row['converged']
+            growth = np.nan
+            if np.any(converged):
+                growth = np.max(np.abs(row['eigvals'][converged]))
+            print('phase advance = {:.2f} deg: {}/{} converged, max growth = {:.4f}'
+                  .format(row['phase_advance'], np.count_nonzero(converged),
+                          len(perveances), growth))
+
+    if n_workers == 1:
+        for _args in args:
+            report(*_scan_row(*_args))
+    else:
+        with ProcessPoolExecutor(n_workers) as executor:
+            futures = [executor.submit(_scan_row, *_args) for _args in args]
+            for future in as_completed(futures):
+                report(*future.result())
+
+    if path is not None:
+        return load_scan(path)
+    n = len(phase_advances)
+    data = dict(phase_advances=phase_advances, perveances=perveances)
+    for key in ['scale', 'moments', 'eigvals', 'converged']:
+        data[key] = np.array([rows[i][key] for i in range(n)])
+    data['growth'] = np.max(np.abs(data['eigvals']), axis=-1)
+    data['done'] = np.ones(n, dtype=bool)
+    return data
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import chernin as ch
+import lattice as lt
+import stability_scan as ss
+
+
+def _check_matched(Y, Y0, rtol):
+    """Matched moments keep the emittances of Y0 and are positive definite."""
+    I, I0 = ch.invariants(Y), ch.invariants(Y0)
+    assert np.all(np.abs(I / I0 - 1.0) < rtol)
+    assert np.all(np.linalg.eigvalsh(ch.vec2mat(Y)) > 0.0)
+
+
+def test_match_keeps_emittances_lattice():
+    lattice = lt.fodo(0.15, 0.15, 5.0)
+    Q_values = np.linspace(0.0, 3e-6, 7)
+    for eps2 in [16e-6, 8e-6]:
+        Y0 = ss.matched_moments_zero_current(lattice.transfer_matrix(),
+                                             16e-6, eps2)
+        floor = 10.0 * ch.period_map_error(Y0, Q_values[-1], lattice, None,
+                                           ds=0.05)
+        Y, converged = ch.match_ramp(Y0, Q_values, lattice, None, ds=0.05,
+                                     floor=floor)
+        assert np.all(converged)
+        _check_matched(Y, Y0, 1e-4)
+        # Space charge increases the beam size.
+        assert np.all(np.diff(Y[:, 0]) > 0)
+        assert np.all(np.diff(Y[:, 7]) > 0)
+
+
+def test_match_keeps_emittances_callable():
+    length = 5.0
+
+    def ext_foc(s):
+        k = 0.6 * np.sin(2 * np.pi * s / length)
+        return k, -k, 0.02
+
+    n_steps = 500
+    h = length / n_steps
+    samples = np.array([ext_foc(s) for s in 0.5 * h * np.arange(2 * n_steps + 1)])
+    M = ss.transfer_matrix(samples, h)
+    Y0 = ss.matched_moments_zero_current(M, 4e-6, 4e-6)
+    Q_values = np.linspace(0.0, 2e-6, 3)
+    floor = 10.0 * ch.period_map_error(Y0, Q_values[-1], ext_foc, length,
+                                       ds=0.05)
+    Y, converged = ch.match_ramp(Y0, Q_values, ext_foc, length, ds=0.05,
+                                 floor=floor)
+    assert np.all(converged)
+    _check_matched(Y, Y0, 1e-4)
+
+
+def test_match_never_returns_unphysical_moments():
+    lattice = lt.fodo(0.15, 0.15, 5.0)
+    Y0 = ss.matched_moments_zero_current(lattice.transfer_matrix(),
+                                         16e-6, 16e-6)
+    Y, converged = ch.match(np.tile(Y0, (3, 1)), [3e-6, 1e-5, 3e-5], lattice,
+                            None, ds=0.05, floor=1e-6)
+    if np.any(converged):
+        _check_matched(Y[converged], Y0, 1e-4)
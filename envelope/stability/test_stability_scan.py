@@ -0,0 +1,43 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import chernin as ch
+import lattice as lt
+import stability_scan as ss
+
+
+def _check_physical(data, eps1, eps2):
+    """Converged moments are positive definite and keep the emittances."""
+    converged = data['converged']
+    Y = data['moments'][converged]
+    assert np.all(np.linalg.eigvalsh(ch.vec2mat(Y)) > 0.0)
+    I = ch.invariants(Y)
+    I0 = np.array([eps1 * eps2, eps1**2 + eps2**2])
+    assert np.all(np.abs(I / I0 - 1.0) < 1e-5)
+    assert np.all(np.isfinite(data['growth'][converged]))
+    assert np.all(np.isnan(data['growth'][~converged]))
+
+
+def test_scan_lattice():
+    perveances = [0.0, 1e-7, 2e-7, 3e-7, 4e-7]
+    data = ss.scan(lt.fodo(0.5, 0.5, 5.0), None, [60.0], perveances,
+                   16e-6, 16e-6, ds=0.05, verbose=False)
+    assert np.all(data['converged'])
+    _check_physical(data, 16e-6, 16e-6)
+
+
+def test_scan_callable_zero_current():
+    length = 5.0
+
+    def ext_foc(s):
+        k = np.sin(2 * np.pi * s / length)
+        return k, -k, 0.0
+
+    data = ss.scan(ext_foc, length, [60.0, 100.0], [0.0, 1e-6], 16e-6, 8e-6,
+                   ds=0.01, tol=1e-8, verbose=False)
+    assert np.all(data['converged'][:, 0])
+    assert np.allclose(data['growth'][:, 0], 1.0)
+    _check_physical(data, 16e-6, 8e-6)
@@ -0,0 +1,74 @@
+"""Compare memory and time of the stored and matrix-free `art4D` paths.
+
+A Gaussian distribution in x-x'-y-y' is projected onto the screen by a set of
+random uncoupled phase advances. The distribution is then reconstructed with
+the CSR projection matrix and with `ScreenProjector`. Peak memory is measured
+with `tracemalloc`, which tracks NumPy allocations.
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.append('../../../')
+from measurement.tomography import reconstruct as rec
+
+
+# Settings
+#------------------------------------------------------------------------------
+grid_sizes = [30, 50]
+n_proj = 10
+n_parts = 1000000
+xmax = 4.0
+iter_lim = 25
+seed = 0
+
+
+# Benchmark
+#------------------------------------------------------------------------------
+def phase_adv_matrix(mu1, mu2):
+    R = np.zeros((4, 4))
+    for i, mu in zip((0, 2), (mu1, mu2)):
+        c, s = np.cos(mu), np.sin(mu)
+        R[i:i+2, i:i+2] = [[c, s], [-s, c]]
+    return R
+
+
+def run(func, *args, **kws):
+    tracemalloc.start()
+    start_time = time.time()
+    result = func(*args, **kws)
+    runtime = time.time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, runtime, peak / 1e6
+
+
+rng = np.random.default_rng(seed)
+X = rng.normal(size=(n_parts, 4))
+tmats = [phase_adv_matrix(*rng.uniform(0.0, np.pi, size=2)) 
+         for _ in range(n_proj)]
+lsqr_kws = dict(show=False, iter_lim=iter_lim)
+
+print('N    method       time [s]   peak [MB]   rel. diff')
+for N in grid_sizes:
+    edges = np.linspace(-xmax, xmax, N + 1)
+    rec_centers = 4 * [rec.get_bin_centers(edges)]
+    screen_centers = 2 * [rec.get_bin_centers(edges)]
+    projections = []
+    for M in tmats:
+        U = rec.apply(M, X)
+        projection, _, _ = np.histogram2d(U[:, 0], U[:, 2], [edges, edges])
+        projections.append(projection / n_parts)
+    projections = np.array(projections)
+    
+    Z_csr, t_csr, m_csr = run(rec.art4D, projections, tmats, rec_centers, 
+                              screen_centers, lsqr_kws=lsqr_kws)
+    Z_op, t_op, m_op = run(rec.art4D, projections, tmats, rec_centers, 
+                           screen_centers, matrix_free=True, 
+                           lsqr_kws=lsqr_kws)
+    diff = np.abs(Z_op - Z_csr).max() / np.abs(Z_csr).max()
+    print('{:<4} {:<12} {:<10.2f} {:<11.1f}'.format(N, 'csr', t_csr, m_csr))
+    print('{:<4} {:<12} {:<10.2f} {:<11.1f} {:.2e}'.format(N, 'matrix-free', 
+                                                           t_op, m_op, diff))
@@ -0,0 +1,67 @@
+"""Compare skimage SART with the stored-matrix `art2D` kernel.
+
+A batch of 2D distributions (Gaussians with random offsets and correlations)
+is measured with a fixed set of 2x2 transfer matrices, as for the slices in
+`hock4D`. Each method reconstructs the whole batch through `rec2D_batch`. We
+report the throughput and the mean relative error with respect to the binned
+true distribution.
+"""
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('../../../')
+from measurement.tomography import reconstruct as rec
+
+
+# Settings
+#------------------------------------------------------------------------------
+n_bins = 64
+n_proj = 12
+batch_size = 256
+n_parts = 200000
+iterations = 5
+xmax = 5.0
+seed = 0
+
+
+# Benchmark
+#------------------------------------------------------------------------------
+rng = np.random.default_rng(seed)
+edges = np.linspace(-xmax, xmax, n_bins + 1)
+centers = rec.get_bin_centers(edges)
+tmats = []
+for mu in np.linspace(0.0, np.pi, n_proj, endpoint=False):
+    c, s = np.cos(mu), np.sin(mu)
+    tmats.append([[c, s], [-s, c]])
+tmats = np.array(tmats)
+
+Z_true = np.zeros((batch_size, n_bins, n_bins))
+projections = np.zeros((batch_size, n_proj, n_bins))
+for i in range(batch_size):
+    Sigma = np.array([[1.0, 0.0], [0.0, 1.0]])
+    Sigma[0, 1] = Sigma[1, 0] = rng.uniform(-0.8, 0.8)
+    X = rng.multivariate_normal(rng.uniform(-1.0, 1.0, size=2), Sigma, n_parts)
+    Z_true[i], _, _ = np.histogram2d(X[:, 0], X[:, 1], [edges, edges])
+    for k, M in enumerate(tmats):
+        projections[i, k], _ = np.histogram(np.matmul(X, M.T)[:, 0], edges)
+
+
+def error(Z):
+    Z = Z / np.sum(Z, axis=(1, 2))[:, None, None]
+    Zt = Z_true / np.sum(Z_true, axis=(1, 2))[:, None, None]
+    return np.mean(np.sum(np.abs(Z - Zt), axis=(1, 2)))
+
+
+print('method            time [s]   images/s   L1 error')
+for label, kws in [('skimage SART', dict(method='SART')),
+                   ('ART (SART)', dict(method='ART', algorithm='SART')),
+                   ('ART (MART)', dict(method='ART', algorithm='MART'))]:
+    start_time = time.time()
+    Z = rec.rec2D_batch(projections, tmats, centers, centers, 
+                        iterations=iterations, **kws)
+    runtime = time.time() - start_time
+    Z = np.clip(Z, 0.0, None)
+    print('{:<17} {:<10.2f} {:<10.1f} {:.3f}'.format(
+        label, runtime, batch_size / runtime, error(Z)))
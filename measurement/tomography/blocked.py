@@ -0,0 +1,43 @@
+"""Blocked matrix application without dependencies beyond NumPy.
+
+This is the same kernel as `tools.utils.apply`. It is kept here so that the
+tomography code does not depend on the `tools` package.
+"""
+import numpy as np
+
+
+def apply(M, X, out=None, block_size=100000):
+    """Apply M to each row of X.
+    
+    The rows are processed in blocks of `block_size`, with one matrix 
+    multiplication per block, so temporary memory stays bounded.
+    
+    Parameters
+    ----------
+    M : ndarray, shape (m, n)
+        The matrix.
+    X : ndarray, shape (k, n)
+        The points.
+    out : ndarray, shape (k, m) (optional)
+        Array in which to place the result. This may be `X` itself if M is
+        square, in which case the points are transformed in place.
+    block_size : int
+        Number of rows per block.
+        
+    Returns
+    -------
+    ndarray, shape (k, m)
+        Each row is M times the corresponding row of X.
+    """
+    M = np.asarray(M)
+    X = np.asarray(X)
+    if out is None:
+        out = np.empty((X.shape[0], M.shape[0]), dtype=np.result_type(M, X))
+    in_place = np.shares_memory(X, out)
+    for lo in range(0, X.shape[0], block_size):
+        hi = lo + block_size
+        if in_place:
+            out[lo:hi] = np.matmul(X[lo:hi], M.T)
+        else:
+            np.matmul(X[lo:hi], M.T, out=out[lo:hi])
+    return out
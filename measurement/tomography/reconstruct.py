@@ -6,19 +6,19 @@ the angles to skimage.
 import sys
 import os
 import time
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from scipy import sparse
-from scipy import interpolate
+from scipy import ndimage
 from skimage.transform import iradon
 from skimage.transform import iradon_sart
 from tqdm import trange
 from tqdm import tqdm
 
-
-def apply(M, X):
-    """Apply matrix M to each row of X."""
-    return np.apply_along_axis(lambda row: np.matmul(M, row), 1, X)
+from blocked import apply
 
 
 def get_bin_centers(bin_edges):
@@ -87,6 +87,98 @@ def process(Z, keep_positive=False, density=False, limits=None):
     return Z
 
 
+class Histogram:
+    """N-dimensional distribution on a regular grid with cached projections.
+
+    Projections are stored the first time they are computed. A projection is
+    formed from the smallest cached projection that contains its axes, e.g.,
+    x-y is summed from x-x'-y if that is available instead of from the full
+    distribution; the first projection taken from the full distribution also
+    caches an (n - 1)-dimensional projection for this purpose. The cache is
+    cleared whenever the distribution changes through `Z`, `process` or 
+    `normalize`. Call `invalidate` after modifying `Z` in place.
+
+    Attributes
+    ----------
+    grid : list[ndarray], shape (n,)
+        Bin center coordinates along each axis.
+    bin_volume : float
+        The bin volume.
+    """
+    def __init__(self, Z, grid=None, bin_volume=None):
+        if grid is None:
+            grid = [np.arange(n) for n in np.shape(Z)]
+        self.grid = grid
+        if bin_volume is None:
+            bin_volume = np.prod([np.diff(c)[0] if len(c) > 1 else 1.0
+                                  for c in grid])
+        self.bin_volume = bin_volume
+        self._cache = dict()
+        self.Z = Z
+
+    @property
+    def Z(self):
+        """The distribution."""
+        return self._Z
+
+    @Z.setter
+    def Z(self, Z):
+        self._Z = np.asarray(Z)
+        self.invalidate()
+
+    @property
+    def ndim(self):
+        return self._Z.ndim
+
+    def invalidate(self):
+        """Clear the projection cache."""
+        self._cache = dict()
+
+    def project(self, indices):
+        """Return the projection onto `indices` (see `project`).
+
+        The returned array is read-only since it is shared with the cache.
+        """
+        if type(indices) is int:
+            indices = [indices]
+        key = tuple(sorted(set(indices)))
+        if len(key) == self.ndim:
+            return self._Z
+        if key in self._cache:
+            return self._cache[key]
+        # Start from the smallest cached projection that contains the axes.
+        source_key, source = tuple(range(self.ndim)), self._Z
+        for cached_key, cached in self._cache.items():
+            if set(key) <= set(cached_key) and cached.size < source.size:
+                source_key, source = cached_key, cached
+        # Otherwise go through an (n - 1)-dimensional projection, which 
+        # costs about the same and can be reused for other projections.
+        if source is self._Z and len(key) < self.ndim - 1:
+            drop = max([i for i in range(self.ndim) if i not in key])
+            source_key = tuple([i for i in range(self.ndim) if i != drop])
+            source = self.project(source_key)
+        axis = tuple([k for k, i in enumerate(source_key) if i not in key])
+        projection = np.sum(source, axis=axis)
+        projection.flags.writeable = False
+        self._cache[key] = projection
+        return projection
+
+    def process(self, **kws):
+        """Apply `process` to the distribution.
+
+        The `limits` key word argument is not needed; `density` uses
+        `bin_volume`.
+        """
+        density = kws.pop('density', False)
+        self.Z = process(self._Z, **kws)
+        if density:
+            self.normalize()
+
+    def normalize(self):
+        """Normalize the distribution to unit integral."""
+        self.Z = normalize(self._Z, self.bin_volume)
+
+
 def get_projection_angle(M):
     """Return projection angle from 2x2 transfer matrix.
     
@@ -124,17 +216,20 @@ def get_grid_coords(*xi, indexing='ij'):
     return np.vstack([X.ravel() for X in np.meshgrid(*xi, indexing='ij')]).T
     
 
-def transform(Z, V, grid, new_grid=None):
+def transform(Z, V, grid, new_grid=None, chunk_size=1000000):
     """Apply a linear transformation to a distribution.
     
-    Note: this takes a while for high-dimensional distributions. Maybe
-    there is a better way.
+    Each point y on the new grid is mapped back to x = V^-1 y, and the 
+    distribution is evaluated there by multilinear interpolation on the 
+    original grid (`scipy.ndimage.map_coordinates` with order=1). Points 
+    outside the original grid are set to zero. The new grid is processed in 
+    chunks along its first axis. The grids must be evenly spaced.
     
     Parameters
     ----------
     Z : ndarray, shape (len(x1), ..., len(xn))
          The distribution function in the original space.
-    V : ndarray, shape (len(xi),)
+    V : ndarray, shape (n, n)
         Matrix to transform the coordinates.
     grid : list[ndarray], shape (n,)
         List of 1D arrays [x1, x2, ...] representing the bin centers in the 
@@ -143,6 +238,8 @@ def transform(Z, V, grid, new_grid=None):
         List of 1D arrays [x1, x2, ...] representing the bin centers in the 
         transformed space. If none are provided, we use the min/max coordinates
         of the transformed grid and keep the same number of bins.
+    chunk_size : int
+        Approximate number of new grid points interpolated at once.
         
     Returns
     -------
@@ -152,37 +249,93 @@ def transform(Z, V, grid, new_grid=None):
     new_grid : list[ndarray], shape (n,)
         List of 1D arrays [x1, x2, ...] representing the bin centers in the 
         transformed space.
-    """        
-    # Transform the grid coordinates.
-    coords_new = apply(V, get_grid_coords(*grid))
-        
-    # Define the interpolation coordinates.
+    """
+    n = Z.ndim
+    V = np.asarray(V, dtype=np.float64)
+    
+    # Define the interpolation coordinates. The transformed grid is a 
+    # parallelotope, so its extent is set by its corners.
     if new_grid is None:
-        mins = np.min(coords_new, axis=0)
-        maxs = np.max(coords_new, axis=0)
+        corners = get_grid_coords(*[[xi[0], xi[-1]] for xi in grid])
+        corners = np.matmul(corners, V.T)
+        mins = np.min(corners, axis=0)
+        maxs = np.max(corners, axis=0)
         new_grid = [np.linspace(mins[i], maxs[i], Z.shape[i]) 
-                    for i in range(Z.ndim)]    
-    coords_int = get_grid_coords(*new_grid)
+                    for i in range(n)]
+    new_shape = tuple([len(xi) for xi in new_grid])
+        
+    # The index coordinates in the original grid are an affine function of
+    # the new grid coordinates: idx_i = sum_j W_ij y_j - x_i[0] / dx_i.
+    Vinv = np.linalg.inv(V)
+    spacing = np.array([xi[1] - xi[0] for xi in grid])
+    offset = np.array([xi[0] for xi in grid]) / spacing
+    W = Vinv / spacing[:, None]
     
-    # Interpolate.
-    Z = interpolate.griddata(coords_new, Z.ravel(), coords_int, 
-                             method='linear', fill_value=0.0)
-    Z = Z.reshape([len(xi) for xi in new_grid])
-    return Z, new_grid
+    Z_new = np.zeros(new_shape)
+    slice_size = int(np.prod(new_shape[1:]))
+    rows_per_chunk = max(1, chunk_size // slice_size)
+    for lo in range(0, new_shape[0], rows_per_chunk):
+        hi = min(lo + rows_per_chunk, new_shape[0])
+        chunk_shape = (hi - lo,) + new_shape[1:]
+        coords = np.zeros((n,) + chunk_shape)
+        for j, yj in enumerate(new_grid):
+            yj = yj[lo:hi] if j == 0 else yj
+            bshape = [1] * n
+            bshape[j] = len(yj)
+            yj = np.reshape(yj, bshape)
+            for i in range(n):
+                coords[i] += W[i, j] * yj
+        coords -= offset.reshape((n,) + n * (1,))
+        Z_new[lo:hi] = ndimage.map_coordinates(Z, coords, order=1, 
+                                               mode='constant', cval=0.0)
+    return Z_new, new_grid
 
 
 # 2D reconstruction
 #------------------------------------------------------------------------------
+def linear_interp_weights(xp, x):
+    """Return indices and weights for linear interpolation from xp to x.
+    
+    The interpolated values are `(1 - w) * fp[..., lo] + w * fp[..., lo + 1]`,
+    where `fp` holds the function values at `xp`. Points outside `xp` get 
+    zero weight on both neighbors, which matches `interp1d` with 
+    `bounds_error=False` and `fill_value=0.0`.
+    
+    Parameters
+    ----------
+    xp : ndarray, shape (N,)
+        Increasing sample coordinates.
+    x : ndarray, shape (..., M)
+        Interpolation coordinates.
+    
+    Returns
+    -------
+    lo : ndarray, shape (..., M)
+        Index of the left neighbor in `xp`.
+    w_lo, w_hi : ndarray, shape (..., M)
+        Weights of the left and right neighbors.
+    """
+    lo = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    w = (x - xp[lo]) / (xp[lo + 1] - xp[lo])
+    inside = np.logical_and(x >= xp[0], x <= xp[-1])
+    w_hi = np.where(inside, w, 0.0)
+    w_lo = np.where(inside, 1.0 - w, 0.0)
+    return lo, w_lo, w_hi
+
+
 def scale_projections(projections, tmats, centers_meas, centers_rec):
     """Given the projections at B and the linear transfer matrices from A to B, 
     return the projections at A.
     
-    See `get_projection_scaling` and `get_projection_angle`. 
+    See `get_projection_scaling` and `get_projection_angle`. The 
+    interpolation weights depend only on the transfer matrices, so they are
+    computed once and applied to any number of projection sets at once.
     
     Parameters
     ----------
-    projections : ndarray, shape (n_proj, N)
-        Measured 1D projections of the distribution.
+    projections : ndarray, shape (..., n_proj, N)
+        Measured 1D projections of the distribution. Leading dimensions are 
+        treated as independent sets of projections.
     tmats: ndarray, shape (n_proj, 2, 2)
         Transfer matrices from A to B.
     centers_meas : ndarray, shape (N,)
@@ -192,25 +345,36 @@ def scale_projections(projections, tmats, centers_meas, centers_rec):
     
     Returns
     -------
-    scaled_projections : ndarray, shape (n_proj, M)
+    scaled_projections : ndarray, shape (..., n_proj, M)
         Scaled projections in the phase space at A.
     proj_angles : ndarray, shape (n_proj,)
         Angles of the projections at A.
     """
-    n_proj, n_bins = np.shape(projections)
-    scaled_projections = np.zeros((n_proj, n_bins))
-    proj_angles = np.zeros(n_proj)
-    scale_factors = np.zeros(n_proj)
-    for k, (M, projection) in enumerate(zip(tmats, projections)):
-        r = get_projection_scaling(M)
-        interp = interpolate.interp1d(centers_meas, projection, kind='linear', 
-                                      bounds_error=False, fill_value=0.0)
-        scaled_projections[k, :] = r * interp(r * centers_rec)
-        scale_factors[k] = r
-        proj_angles[k] = get_projection_angle(M)
+    projections = np.asarray(projections)
+    scale_factors = np.array([get_projection_scaling(M) for M in tmats])
+    proj_angles = np.array([get_projection_angle(M) for M in tmats])
+    x = scale_factors[:, None] * np.asarray(centers_rec)[None, :]
+    lo, w_lo, w_hi = linear_interp_weights(np.asarray(centers_meas), x)
+    proj_index = np.arange(len(tmats))[:, None]
+    scaled_projections = (w_lo * projections[..., proj_index, lo]
+                          + w_hi * projections[..., proj_index, lo + 1])
+    scaled_projections *= scale_factors[:, None]
     return scaled_projections, proj_angles
 
 
+def _get_rec2D_func(method):
+    """Return the 2D reconstruction function for `method`."""
+    if method == 'SART':
+        return sart
+    elif method == 'FBP':
+        return fbp
+    elif method == 'MENT':
+        return ment
+    elif method == 'ART':
+        return art2D
+    raise ValueError("Invalid reconstruction method.")
+
+
 def rec2D(projections, tmats, centers_meas, centers_rec, 
           method='SART', proc_kws=None, **kws):
     """Reconstruct the x-x' or y-y' distribution from 1D projections.
@@ -225,8 +389,9 @@ def rec2D(projections, tmats, centers_meas, centers_rec,
         Bin center coordinates at the measurement point.
     centers_rec : ndarray, shape (M,)
         Bin center coordinates at the reconstruction point.
-    method : {'SART', 'FBP', 'MENT'}
-        The reconstruction method to use.
+    method : {'SART', 'FBP', 'MENT', 'ART'}
+        The reconstruction method to use. 'SART' and 'FBP' use skimage; 
+        'ART' uses `art2D`, which stores the system matrix.
     proc_kws : dict
         Key word arguments for `process`.
     **kws
@@ -238,15 +403,7 @@ def rec2D(projections, tmats, centers_meas, centers_rec,
         Reconstructed phase space distribution. The horizontal and vertical
         grid coordinates are the same: `xx_rec`. 
     """
-    rfunc = None
-    if method == 'SART':
-        rfunc = sart
-    elif method == 'FBP':
-        rfunc = fbp
-    elif method == 'MENT':
-        rfunc = ment
-    else:
-        raise ValueError("Invalid reconstruction method.")
+    rfunc = _get_rec2D_func(method)
     if proc_kws is None:
         proc_kws = dict()
     projections, angles = scale_projections(projections, tmats, 
@@ -255,6 +412,64 @@ def rec2D(projections, tmats, centers_meas, centers_rec,
     Z = rfunc(projections, angles, **kws).T
     Z = process(Z, **proc_kws)
     return Z
+
+
+def _rec2D_scaled(projections, angles, method, kws, verbose=False):
+    """Reconstruct a stack of scaled projection sets (see `rec2D_batch`)."""
+    if method == 'ART':
+        return art2D_batch(projections, np.radians(angles), **kws)
+    rfunc = _get_rec2D_func(method)
+    if verbose:
+        projections = tqdm(projections)
+    return np.array([rfunc(_projections, angles, **kws).T 
+                     for _projections in projections])
+
+
+def rec2D_batch(projections, tmats, centers_meas, centers_rec, 
+                method='SART', n_workers=1, chunk_size=None, **kws):
+    """Run `rec2D` on many sets of projections sharing the same optics.
+    
+    The projections are scaled once with `scale_projections`, then the 
+    independent reconstructions are split into chunks and distributed over a 
+    process pool. No processing is applied to the reconstructions.
+    
+    Parameters
+    ----------
+    projections : ndarray, shape (..., n_proj, N)
+        Sets of measured 1D projections. Each set shares the transfer matrices
+        in `tmats`.
+    tmats, centers_meas, centers_rec, method, **kws
+        See `rec2D`.
+    n_workers : int
+        Number of worker processes. Reconstructions are done serially if 
+        `n_workers` is 1.
+    chunk_size : int (optional)
+        Number of reconstructions sent to a worker at once. By default the
+        sets are divided into four chunks per worker.
+        
+    Returns
+    -------
+    Z : ndarray, shape (..., M, M)
+        Reconstructed phase space distributions.
+    """
+    projections = np.asarray(projections)
+    batch_shape = projections.shape[:-2]
+    projections, angles = scale_projections(projections, tmats, 
+                                            centers_meas, centers_rec)
+    angles = np.degrees(angles)
+    projections = projections.reshape((-1,) + projections.shape[-2:])
+    n = len(projections)
+    if n_workers == 1:
+        Z = _rec2D_scaled(projections, angles, method, kws, verbose=True)
+    else:
+        if chunk_size is None:
+            chunk_size = max(1, int(np.ceil(n / (4 * n_workers))))
+        chunks = [projections[i: i + chunk_size] for i in range(0, n, chunk_size)]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_rec2D_scaled, chunk, angles, method, kws)
+                       for chunk in chunks]
+            Z = np.concatenate([future.result() for future in tqdm(futures)])
+    return Z.reshape(batch_shape + Z.shape[-2:])
     
 
 def fbp(projections, angles, **kws):
@@ -272,16 +487,236 @@ def sart(projections, angles, iterations=1, **kws):
     return Z
 
 
-def ment(projections, angles, proc_kws=None):
-    """Maximum Entropy (MENT)."""
-    raise NotImplementedError
+def ray_matrix(angles, n_bins):
+    """Return the 2D ray-sum matrix for a square grid.
+    
+    The image Z[i, j] lives on an n_bins x n_bins grid with the same bin 
+    centers u along both axes, measured in bin widths from the grid center. 
+    Projection k bins s = u_i * cos(angles[k]) + u_j * sin(angles[k]) onto the
+    same centers using linear interpolation weights. This is the geometry 
+    assumed by `scale_projections`.
+    
+    Parameters
+    ----------
+    angles : ndarray, shape (n_proj,)
+        Projection angles [rad].
+    n_bins : int
+        Number of bins along each axis of the image and projections.
+    
+    Returns
+    -------
+    A : scipy.sparse.csr_matrix, shape (n_proj * n_bins, n_bins**2)
+        Maps Z.ravel() to the stacked projections. The most recently used
+        matrices are cached.
+    """
+    angles = np.ascontiguousarray(angles, dtype=np.float64)
+    return _ray_matrix(angles.tobytes(), int(n_bins))
+
+
+@lru_cache(maxsize=16)
+def _ray_matrix(angles_bytes, n_bins):
+    angles = np.frombuffer(angles_bytes, dtype=np.float64)
+    u = np.arange(n_bins) - 0.5 * (n_bins - 1)
+    U1, U2 = np.meshgrid(u, u, indexing='ij')
+    cols = np.arange(n_bins**2)
+    rows, cols_, data = [], [], []
+    for k, angle in enumerate(angles):
+        s = U1.ravel() * np.cos(angle) + U2.ravel() * np.sin(angle)
+        lo, w_lo, w_hi = linear_interp_weights(u, s)
+        for idx, w in [(lo, w_lo), (lo + 1, w_hi)]:
+            nonzero = w > 0.0
+            rows.append(idx[nonzero] + k * n_bins)
+            cols_.append(cols[nonzero])
+            data.append(w[nonzero])
+    A = sparse.csr_matrix(
+        (np.hstack(data), (np.hstack(rows), np.hstack(cols_))), 
+        shape=(len(angles) * n_bins, n_bins**2)
+    )
+    return A
+
+
+def _safe_inverse(a):
+    """Return 1 / a, or 0 where a is 0."""
+    a = np.asarray(a).ravel()
+    inv = np.zeros(len(a))
+    inv[a != 0.0] = 1.0 / a[a != 0.0]
+    return inv
+
+
+def art2D_batch(projections, angles, iterations=1, algorithm='SART', 
+                relaxation=0.5, keep_positive=True, image=None):
+    """Algebraic reconstruction of many 2D images with the same angles.
+    
+    The system matrix from `ray_matrix` is computed once (and cached), then
+    each iteration loops over the projection angles and updates all images 
+    at once with sparse matrix-matrix products.
+    
+    Parameters
+    ----------
+    projections : ndarray, shape (n_proj, N) or (batch, n_proj, N)
+        Scaled projections; see `scale_projections`.
+    angles : ndarray, shape (n_proj,)
+        Projection angles [rad].
+    iterations : int
+        Number of passes over all angles.
+    algorithm : {'SART', 'MART'}
+        Additive (SART) or multiplicative (MART) update. MART keeps the 
+        image positive.
+    relaxation : float
+        Relaxation parameter. Note that the skimage default of 0.15 converges
+        much more slowly here.
+    keep_positive : bool
+        Whether to clip negative values after each SART update. This acts as
+        a regularizer when there are few projections.
+    image : ndarray, shape (N, N) or (batch, N, N) (optional)
+        Initial guess. SART starts from zero and MART from a uniform image 
+        by default.
+        
+    Returns
+    -------
+    Z : ndarray, shape (N, N) or (batch, N, N)
+        Reconstructed images. Z[..., i, j] is the density at (u_i, u_j).
+    """
+    projections = np.asarray(projections, dtype=np.float64)
+    single = projections.ndim == 2
+    if single:
+        projections = projections[None, ...]
+    batch_size, n_proj, n_bins = projections.shape
+        
+    A = ray_matrix(angles, n_bins)
+    blocks, blocks_T, row_inv, col_inv = [], [], [], []
+    for k in range(n_proj):
+        A_k = A[k * n_bins: (k + 1) * n_bins]
+        blocks.append(A_k)
+        blocks_T.append(A_k.T.tocsr())
+        row_inv.append(_safe_inverse(A_k.sum(axis=1))[:, None])
+        col_inv.append(_safe_inverse(A_k.sum(axis=0))[:, None])
+    # Columns of P and X are the individual reconstructions.
+    P = np.transpose(projections, (1, 2, 0))
+    if image is not None:
+        X = np.reshape(image, (-1, n_bins**2)).T.copy()
+    elif algorithm == 'MART':
+        totals = np.sum(projections, axis=2).mean(axis=1)
+        X = np.tile(totals / n_bins**2, (n_bins**2, 1))
+    else:
+        X = np.zeros((n_bins**2, batch_size))
+        
+    if algorithm == 'SART':
+        for _ in range(iterations):
+            for k in range(n_proj):
+                residual = (P[k] - blocks[k] @ X) * row_inv[k]
+                X += relaxation * col_inv[k] * (blocks_T[k] @ residual)
+                if keep_positive:
+                    np.clip(X, 0.0, None, out=X)
+    elif algorithm == 'MART':
+        eps = 1e-12 * max(np.max(projections), 1e-300)
+        for _ in range(iterations):
+            for k in range(n_proj):
+                ratio = np.log((P[k] + eps) / (blocks[k] @ X + eps))
+                X *= np.exp(relaxation * col_inv[k] * (blocks_T[k] @ ratio))
+    else:
+        raise ValueError("Invalid algorithm.")
+    Z = X.T.reshape((batch_size, n_bins, n_bins))
+    return Z[0] if single else Z
+
+
+def art2D(projections, angles, **kws):
+    """Algebraic reconstruction (SART/MART) with a stored system matrix.
+    
+    Same call signature as `sart`; see `art2D_batch`.
+    """
+    return art2D_batch(projections, np.radians(angles), **kws).T
+
+
+def ment2D(projections, angles, iterations=10, relaxation=1.0, tol=None, 
+           verbose=False):
+    """Maximum entropy (MENT) reconstruction of a 2D image.
+    
+    The MENT solution has the form Z(x, x') = prod_k h_k(s_k), where s_k is
+    the coordinate along the kth projection axis and h_k is sampled on the 
+    projection bins. Each h_k is evaluated on the grid by linear 
+    interpolation, i.e., h_k(s_k) = A_k^T h_k with A_k the kth block of 
+    `ray_matrix`. The h_k are found by Gauss-Seidel iteration; the update 
+    of h_k is applied to all of its bins at once:
+    
+        h_k <- h_k * (p_k / A_k Z)**relaxation.
+    
+    Parameters
+    ----------
+    projections : ndarray, shape (n_proj, N)
+        Scaled projections; see `scale_projections`.
+    angles : ndarray, shape (n_proj,)
+        Projection angles [rad].
+    iterations : int
+        Maximum number of Gauss-Seidel sweeps over the projections.
+    relaxation : float
+        Exponent applied to the update factor.
+    tol : float (optional)
+        Stop when the relative L1 discrepancy between the measured and 
+        simulated projections falls below this value.
+    verbose : bool
+        Whether to print the discrepancy and time after each sweep.
+        
+    Returns
+    -------
+    Z : ndarray, shape (N, N)
+        Reconstructed image. Z[i, j] is the density at (u_i, u_j); see 
+        `ray_matrix`.
+    history : dict
+        'error': relative L1 discrepancy after each sweep; 'time': 
+        cumulative time [s] after each sweep.
+    """
+    projections = np.asarray(projections, dtype=np.float64)
+    n_proj, n_bins = projections.shape
+    A = ray_matrix(angles, n_bins)
+    blocks = [A[k * n_bins: (k + 1) * n_bins] for k in range(n_proj)]
+    # Interpolating h_k onto the grid is the transpose of projecting onto s_k.
+    interp = [block.T.tocsr() for block in blocks]
+    h = np.ones((n_proj, n_bins))
+    G = np.array([interp[k] @ h[k] for k in range(n_proj)])
+    norm = np.sum(projections)
+    history = {'error': [], 'time': []}
+    
+    start_time = time.time()
+    for iteration in range(iterations):
+        for k in range(n_proj):
+            Z = np.prod(G, axis=0)
+            simulated = blocks[k] @ Z
+            ratio = np.zeros(n_bins)
+            valid = simulated > 0.0
+            ratio[valid] = projections[k, valid] / simulated[valid]
+            h[k] *= ratio**relaxation
+            G[k] = interp[k] @ h[k]
+        Z = np.prod(G, axis=0)
+        error = np.sum(np.abs((A @ Z).reshape(n_proj, n_bins) - projections))
+        error /= norm
+        history['error'].append(error)
+        history['time'].append(time.time() - start_time)
+        if verbose:
+            print('iteration {}: error = {:.3e}, t = {:.3f} s'.format(
+                iteration, error, history['time'][-1]))
+        if tol is not None and error < tol:
+            break
+    return Z.reshape((n_bins, n_bins)), history
+
+
+def ment(projections, angles, **kws):
+    """Maximum Entropy (MENT).
+    
+    Same call signature as `sart`; see `ment2D`.
+    """
+    Z, _ = ment2D(projections, np.radians(angles), **kws)
+    return Z.T
     
     
 # 4D reconstruction
 #------------------------------------------------------------------------------
 def hock4D(S, centers_meas, centers_rec, tmats_x, tmats_y, 
-           method='SART', proc_kws=None, **kws):
+           method='SART', proc_kws=None, n_workers=1, **kws):
     """4D reconstruction using method from Hock (2013).
+    
+    Each of the two passes is a batch of independent 2D reconstructions with
+    the same optics, so they are handed to `rec2D_batch`.
 
     Parameters
     ----------
@@ -294,10 +729,12 @@ def hock4D(S, centers_meas, centers_rec, tmats_x, tmats_y,
         Coordinates of x and y bin centers on the reconstruction grid.
     tmats_x{y} : ndarray, shape (n_proj, 2, 2)
         List of 2 x 2 transfer matrices for x-x'{y-y'}.
-    method : {'SART', 'FBP', 'MENT'}
+    method : {'SART', 'FBP', 'MENT', 'ART'}
         The 2D reconstruction method.
     proc_kws : dict
         Key word arguments for `process`.
+    n_workers : int
+        Number of worker processes for the 2D reconstructions.
     **kws
         Key word arguments for `rec2D`.
         
@@ -309,31 +746,225 @@ def hock4D(S, centers_meas, centers_rec, tmats_x, tmats_y,
     """        
     if proc_kws is None:
         proc_kws = dict()
-    K = len(tmats_x)
-    L = len(tmats_y)
-    n_bins = n_bins = S.shape[0] # assume same number of x/y bins.
-    xcenters_meas, ycenters_meas = centers_meas
-    xcenters_rec, ycenters_rec = centers_rec
-    
-    D = np.zeros((n_bins, L, n_bins, n_bins))
-    for j in trange(n_bins):
-        for l in range(L):
-            projections = S[:, j, :, l].T
-            D[j, l, :, :] = rec2D(projections, tmats_x, 
-                                  centers_meas[0], centers_rec[0],
-                                  method=method, **kws)
-    Z = np.zeros((n_bins, n_bins, n_bins, n_bins))
-    for r in trange(n_bins):
-        for s in range(n_bins):
-            projections = D[:, :, r, s].T
-            Z[r, s, :, :] = rec2D(projections, tmats_y, 
-                                  centers_meas[1], centers_rec[1],
-                                  method=method, **kws)
+        
+    # D[j, l, :, :] is the x-x' distribution from the projections S[:, j, :, l].
+    D = rec2D_batch(np.transpose(S, (1, 3, 2, 0)), tmats_x, 
+                    centers_meas[0], centers_rec[0],
+                    method=method, n_workers=n_workers, **kws)
+    # Z[r, s, :, :] is the y-y' distribution from the projections D[:, :, r, s].
+    Z = rec2D_batch(np.transpose(D, (2, 3, 1, 0)), tmats_y, 
+                    centers_meas[1], centers_rec[1],
+                    method=method, n_workers=n_workers, **kws)
     Z = process(Z, **proc_kws)
     return Z
 
 
-def art4D(projections, tmats, rec_centers, screen_centers):
+class ScreenProjector:
+    """Matrix-free projection operator for direct 4D reconstruction.
+    
+    The operator P maps the phase space density psi on the reconstruction grid
+    to the density rho on the screen for each transfer matrix; see `art4D`. 
+    Instead of storing P, the screen bin of each grid point is recomputed on
+    the fly in each product. The grid is processed in chunks along the first
+    axis, so memory scales with `chunk_size` rather than with the number of
+    nonzero elements of P.
+    
+    Attributes
+    ----------
+    tmats : ndarray, shape (n, 4, 4)
+        Transfer matrices from the reconstruction location to the screen.
+    rec_centers : list[ndarray], shape (4,)
+        Grid center coordinates in [x, x', y, y'].
+    screen_edges : list[ndarray], shape (2,)
+        Coordinates of bin edges on the screen in [x, y].
+    chunk_size : int
+        Approximate number of grid points processed at once.
+    """
+    def __init__(self, tmats, rec_centers, screen_centers, chunk_size=1000000):
+        self.tmats = np.asarray(tmats)
+        self.rec_centers = [np.asarray(c) for c in rec_centers]
+        self.screen_edges = [get_bin_edges(c) for c in screen_centers]
+        self.chunk_size = chunk_size
+        self.n_proj = len(self.tmats)
+        self.rec_shape = tuple([len(c) for c in self.rec_centers])
+        self.screen_shape = tuple([len(e) - 1 for e in self.screen_edges])
+        self.row_block_size = int(np.prod(self.screen_shape))
+        self.shape = (self.n_proj * self.row_block_size, 
+                      int(np.prod(self.rec_shape)))
+        # Number of slices along the first grid axis per chunk.
+        slice_size = int(np.prod(self.rec_shape[1:]))
+        self._rows_per_chunk = max(1, chunk_size // slice_size)
+        self._slice_size = slice_size
+        
+    def chunks(self):
+        """Yield (lo, hi) index ranges along the first grid axis."""
+        n = self.rec_shape[0]
+        for lo in range(0, n, self._rows_per_chunk):
+            yield lo, min(lo + self._rows_per_chunk, n)
+        
+    def screen_indices(self, proj_index, lo, hi):
+        """Return flattened screen bin indices of grid points in a chunk.
+        
+        Parameters
+        ----------
+        proj_index : int
+            Index of the transfer matrix.
+        lo, hi : int
+            The chunk contains grid points with first index in [lo, hi).
+        
+        Returns
+        -------
+        ndarray, shape ((hi - lo) * Nr**3,)
+            The bin index on the flattened screen for each grid point in the 
+            chunk, in the same order as `get_grid_coords`. Points that miss 
+            the screen are assigned the index `row_block_size`.
+        """
+        M = self.tmats[proj_index]
+        idx = []
+        for row, edges in zip((0, 2), self.screen_edges):
+            # The grid is separable, so the screen coordinate is a sum of 
+            # one-dimensional terms that can be broadcast over the chunk.
+            u = M[row, 0] * self.rec_centers[0][lo:hi, None, None, None]
+            u = u + M[row, 1] * self.rec_centers[1][None, :, None, None]
+            u = u + M[row, 2] * self.rec_centers[2][None, None, :, None]
+            u = u + M[row, 3] * self.rec_centers[3][None, None, None, :]
+            idx.append(np.digitize(u.ravel(), edges) - 1)
+        xidx, yidx = idx
+        n_bins_x_screen, n_bins_y_screen = self.screen_shape
+        on_screen = np.logical_and(
+            np.logical_and(xidx >= 0, xidx < n_bins_x_screen), 
+            np.logical_and(yidx >= 0, yidx < n_bins_y_screen)
+        )
+        screen_idx = xidx * n_bins_y_screen + yidx
+        screen_idx[~on_screen] = self.row_block_size
+        return screen_idx
+        
+    def matvec(self, psi):
+        """Return rho = P psi."""
+        psi = np.ravel(psi)
+        rho = np.zeros(self.shape[0])
+        for k in range(self.n_proj):
+            i_offset = k * self.row_block_size
+            rho_k = rho[i_offset: i_offset + self.row_block_size]
+            for lo, hi in self.chunks():
+                screen_idx = self.screen_indices(k, lo, hi)
+                psi_chunk = psi[lo * self._slice_size: hi * self._slice_size]
+                rho_k += np.bincount(screen_idx, weights=psi_chunk, 
+                                     minlength=self.row_block_size + 1)[:-1]
+        return rho
+    
+    def rmatvec(self, rho):
+        """Return psi = P^T rho."""
+        rho = np.ravel(rho)
+        psi = np.zeros(self.shape[1])
+        for k in range(self.n_proj):
+            i_offset = k * self.row_block_size
+            # Pad with a zero so that off-screen points pick up nothing.
+            rho_k = np.append(rho[i_offset: i_offset + self.row_block_size], 0.0)
+            for lo, hi in self.chunks():
+                screen_idx = self.screen_indices(k, lo, hi)
+                psi[lo * self._slice_size: hi * self._slice_size] += rho_k[screen_idx]
+        return psi
+    
+    def as_linear_operator(self):
+        """Return a `scipy.sparse.linalg.LinearOperator` wrapping P."""
+        return sparse.linalg.LinearOperator(self.shape, matvec=self.matvec, 
+                                            rmatvec=self.rmatvec, 
+                                            dtype=np.float64)
+    
+
+def _projection_cache_key(tmats, rec_centers, screen_centers):
+    """Return hash of the arrays that define the projection matrix."""
+    h = hashlib.sha1()
+    for array in [tmats, *rec_centers, *screen_centers]:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def projection_matrix(tmats, rec_centers, screen_centers, cache_dir=None,
+                      return_indices=False, chunk_size=1000000):
+    """Return the projection matrix P used in `art4D` as a CSR matrix.
+    
+    The nonzero elements are found with `ScreenProjector.screen_indices`, 
+    one chunk of the reconstruction grid at a time. If `cache_dir` is 
+    provided, P and the screen bin indices are saved there under a hash of 
+    `tmats`, `rec_centers` and `screen_centers`, and are loaded instead of 
+    rebuilt on later calls with the same arrays.
+    
+    Parameters
+    ----------
+    tmats : ndarray, shape (n, 4, 4)
+        List of transfer matrices from the reconstruction location to the 
+        measurement location.
+    rec_centers : ndarray, shape (4, Nr)
+        Grid center coordinates in [x, x', y, y'].
+    screen_centers : ndarray, shape (2, Ns)        
+        Coordinates of bin centers on the screen in [x, y].
+    cache_dir : str (optional)
+        Directory in which to cache the arrays.
+    return_indices : bool
+        Whether to also return the screen bin indices.
+    chunk_size : int
+        Approximate number of grid points processed at once.
+        
+    Returns
+    -------
+    P : scipy.sparse.csr_matrix, shape (n * Ns**2, Nr**4)
+        P[i, j] = 1.0 if the jth bin center in the reconstruction grid ends 
+        up in the ith bin on the screen, or 0.0 otherwise.
+    screen_idx : ndarray, shape (n, Nr**4)
+        screen_idx[k, j] is the index of the bin on the flattened screen in 
+        which the jth bin center lands for the kth transfer matrix, or -1 if
+        it misses the screen. Only returned if `return_indices`.
+    """
+    if cache_dir is not None:
+        key = _projection_cache_key(tmats, rec_centers, screen_centers)
+        P_file = os.path.join(cache_dir, 'P_{}.npz'.format(key))
+        idx_file = os.path.join(cache_dir, 'screen_idx_{}.npy'.format(key))
+        if os.path.isfile(P_file) and os.path.isfile(idx_file):
+            print('Loading cached projection matrix {}.'.format(key))
+            P = sparse.load_npz(P_file).tocsr()
+            if return_indices:
+                return P, np.load(idx_file, mmap_mode='r')
+            return P
+    
+    projector = ScreenProjector(tmats, rec_centers, screen_centers, 
+                                chunk_size=chunk_size)
+    n_rows, n_cols = projector.shape
+    row_block_size = projector.row_block_size
+    index_dtype = np.int32 if max(n_rows, n_cols) < 2**31 else np.int64
+    screen_idx = np.empty((projector.n_proj, n_cols), dtype=index_dtype)
+    for proj_index in trange(projector.n_proj):
+        for lo, hi in projector.chunks():
+            col_lo = lo * projector._slice_size
+            col_hi = hi * projector._slice_size
+            screen_idx[proj_index, col_lo:col_hi] = projector.screen_indices(
+                proj_index, lo, hi)
+    on_screen = screen_idx < row_block_size
+    
+    # P[i, j] = 1 if particle j landed in bin i on the screen, 0 otherwise.
+    print('Creating sparse matrix P.')
+    t = time.time()
+    proj_indices, cols = np.nonzero(on_screen)
+    rows = screen_idx[proj_indices, cols] + proj_indices * row_block_size
+    P = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), 
+                          shape=(n_rows, n_cols))
+    screen_idx[~on_screen] = -1
+    print('Done. t = {}'.format(time.time() - t))
+    
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        sparse.save_npz(P_file, P)
+        np.save(idx_file, screen_idx)
+    if return_indices:
+        return P, screen_idx
+    return P
+
+
+def art4D(projections, tmats, rec_centers, screen_centers, matrix_free=False,
+          chunk_size=1000000, cache_dir=None, lsqr_kws=None):
     """Direct four-dimensional algebraic reconstruction (ART).
     
     We set up the linear system rho = P psi. Assume the x-x'-y-y' grid at the
@@ -345,7 +976,10 @@ def art4D(projections, tmats, rec_centers, screen_centers):
     
     P is a very sparse matrix. Currently, scipy.sparse.linalg.lsqr is used. A 
     grid size of N = 50 has used successfuly, but N = 75 lead to an 'out of 
-    memory' error.
+    memory' error when P is stored. With `matrix_free=True`, P is never 
+    formed; the products P psi and P^T rho are computed on the fly by 
+    `ScreenProjector`, which keeps the memory bounded at the cost of 
+    recomputing the screen bins in every iteration.
     
     Parameters
     ----------
@@ -356,8 +990,17 @@ def art4D(projections, tmats, rec_centers, screen_centers):
         measurement location.
     rec_centers : ndarray, shape (4, Nr)
         Grid center coordinates in [x, x', y, y'].
-    screen_edges : ndarray, shape (2, Ns)        
-        Coordinates of bin edges on the screen in [x, y].
+    screen_centers : ndarray, shape (2, Ns)        
+        Coordinates of bin centers on the screen in [x, y].
+    matrix_free : bool
+        Whether to use a `ScreenProjector` instead of the stored matrix.
+    chunk_size : int
+        Number of grid points processed at once.
+    cache_dir : str (optional)
+        Directory in which to cache P; see `projection_matrix`. Ignored if
+        `matrix_free`.
+    lsqr_kws : dict
+        Key word arguments for `scipy.sparse.linalg.lsqr`.
         
     Returns
     -------
@@ -368,59 +1011,24 @@ def art4D(projections, tmats, rec_centers, screen_centers):
         y = rec_centers[2][k], 
         y' = rec_centers[3][l].
     """
+    if lsqr_kws is None:
+        lsqr_kws = dict()
+    lsqr_kws.setdefault('show', True)
+    lsqr_kws.setdefault('iter_lim', 1000)
+    
     print('Forming arrays.')
-
-    # Treat each reconstruction bin center as a particle. 
-    rec_grid_coords = get_grid_coords(*rec_centers)
     n_bins_rec = [len(c) for c in rec_centers]
-    rec_grid_size = np.prod(n_bins_rec)
-    col_indices = np.arange(rec_grid_size)
-    
-    screen_edges = [get_bin_edges(_centers) for _centers in screen_centers]
-    screen_xedges, screen_yedges = screen_edges
-    n_bins_x_screen = len(screen_xedges) - 1
-    n_bins_y_screen = len(screen_yedges) - 1
-    row_block_size = n_bins_x_screen * n_bins_y_screen
-    n_proj = len(projections)
-    rho = np.zeros(n_proj * row_block_size) # measured density on the screen.
-    rows, cols = [], [] # nonzero row and column indices of P
-
-    for proj_index in trange(n_proj):
-        # Transport the reconstruction grid to the screen.
-        M = tmats[proj_index]
-        screen_grid_coords = apply(M, rec_grid_coords)
-
-        # For each particle, record the indices of the bin it landed in. So we
-        # want (k, l) such that the particle landed in the bin with x = x[k] 
-        # and y = y[l] on the screen. One of the indices will be -1 or n_bins 
-        # if the particle landed outside the screen.
-        xidx = np.digitize(screen_grid_coords[:, 0], screen_xedges) - 1
-        yidx = np.digitize(screen_grid_coords[:, 2], screen_yedges) - 1
-        on_screen = np.logical_and(
-            np.logical_and(xidx >= 0, xidx < n_bins_x_screen), 
-            np.logical_and(yidx >= 0, yidx < n_bins_y_screen)
-        )
-        # Get the indices for the flattened array.
-        projection = projections[proj_index]
-        screen_idx = np.ravel_multi_index((xidx, yidx), projection.shape, mode='clip')
-
-        # P[i, j] = 1 if particle j landed in bin i on the screen, 0 otherwise.
-        i_offset = proj_index * row_block_size
-        for j in tqdm(col_indices[on_screen]):
-            i = screen_idx[j] + i_offset
-            rows.append(i)
-            cols.append(j)
-        rho[i_offset: i_offset + row_block_size] = projection.flat
-
-    print('Creating sparse matrix P.')
-    t = time.time()
-    P = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), 
-                          shape=(n_proj * row_block_size, rec_grid_size))
-    print('Done. t = {}'.format(time.time() - t))
+    rho = np.hstack([np.ravel(projection) for projection in projections])
+    if matrix_free:
+        P = ScreenProjector(tmats, rec_centers, screen_centers, 
+                            chunk_size=chunk_size).as_linear_operator()
+    else:
+        P = projection_matrix(tmats, rec_centers, screen_centers, 
+                              cache_dir=cache_dir, chunk_size=chunk_size)
 
     print('Solving linear system.')
     start_time = time.time()
-    psi = sparse.linalg.lsqr(P, rho, show=True, iter_lim=1000)[0]
+    psi = sparse.linalg.lsqr(P, rho, **lsqr_kws)[0]
     print()
     print('Done. t = {}'.format(time.time() - start_time))
 
@@ -429,96 +1037,271 @@ def art4D(projections, tmats, rec_centers, screen_centers):
     return Z
 
 
-def pic4D(projections, tmats, rec_centers, meas_centers, max_iters=15):
-    """Four-dimensional reconstruction using particle tracking 
-    (not currently working).
-    
-    The method is described in Wang et al. (2019). 
+def pic4D(projections, tmats, rec_centers, meas_centers, max_iters=15,
+          n_parts=1000000, tol=None, seed=None, verbose=True):
+    """Four-dimensional reconstruction using particle tracking.
+
+    The method is described in Wang et al. (2019). Particles are tracked to
+    each screen and given the weight sum_k p_k / q_k, where p_k and q_k are
+    the measured and simulated densities in the bin they land in. Particles
+    that miss any screen get zero weight. A new bunch with the same number
+    of particles is then drawn from the weighted bunch, and each particle is
+    smeared uniformly within one reconstruction bin.
+
+    Parameters
+    ----------
+    projections : ndarray, shape (n, Nsx, Nsy)
+        List of measured projections on the x-y plane.
+    tmats : ndarray, shape (n, 4, 4)
+        List of transfer matrices from the reconstruction location to the
+        measurement location.
+    rec_centers : ndarray, shape (4, Nr)
+        Grid center coordinates in [x, x', y, y'].
+    meas_centers : ndarray, shape (2, Ns)
+        Coordinates of bin centers on the screen in [x, y].
+    max_iters : int
+        Maximum number of iterations.
+    n_parts : int
+        Number of particles, fixed across iterations.
+    tol : float (optional)
+        Stop when the relative change in the projection error between two
+        iterations is smaller than this value.
+    seed : int (optional)
+        Seed for the random number generator.
+    verbose : bool
+        Whether to print the projection error and time after each iteration.
+
+    Returns
+    -------
+    Z : ndarray, shape (Nr, Nr, Nr, Nr)
+        Histogram of the final bunch on the reconstruction grid. (Earlier
+        versions returned the `np.histogramdd` tuple (Z, edges) and the 
+        simulated projections instead of Z and `history`.)
+    history : dict
+        'error': sum of squared differences between the measured and
+        simulated projections; 'time': time [s] of each iteration.
+        
+    Raises
+    ------
+    ValueError
+        If no particle lands inside every screen with nonzero weight.
     """
+    rng = np.random.default_rng(seed)
     n_dims = 4
-    n_proj = len(projections)
-    n_parts = 1000000
-    rec_bin_widths = np.diff(rec_centers)[:, 0]
+    rec_bin_widths = np.array([c[1] - c[0] for c in rec_centers])
     rec_edges = [get_bin_edges(_centers) for _centers in rec_centers]
-    rec_limits = [(min(_edges), max(_edges)) for _edges in rec_edges]
-    projections_meas = np.copy(projections)
     meas_edges = [get_bin_edges(_centers) for _centers in meas_centers]
-    meas_edges[0], meas_edges[1] = meas_edges
-    
-    # Generate initial coordinates uniformly within the reconstruction grid. 
-    # The distribution should be large to ensure that a significant number of 
-    # particles land on the screen.     
-    mins = np.min(rec_limits, axis=1)
-    maxs = np.max(rec_limits, axis=1)
-    scale = 1.0
-    lo = scale * mins
-    hi = scale * maxs
-    X = np.random.uniform(scale * mins, scale * maxs, size=(n_parts, n_dims))
+    n_bins_x_meas = len(meas_edges[0]) - 1
+    n_bins_y_meas = len(meas_edges[1]) - 1
+    n_meas = n_bins_x_meas * n_bins_y_meas
+    projections_meas = np.array([np.ravel(p) / np.sum(p) for p in projections])
 
+    # Generate initial coordinates uniformly within the reconstruction grid.
+    mins = np.array([e[0] for e in rec_edges])
+    maxs = np.array([e[-1] for e in rec_edges])
+    X = rng.uniform(mins, maxs, size=(n_parts, n_dims))
+
+    history = {'error': [], 'time': []}
     for iteration in range(max_iters):
-        # Simulate the measurements.
-        projections, coords_meas = [], []
-        for M in tqdm(tmats):
-            X_meas = apply(M, X)
-            projection, _, _ = np.histogram2d(X_meas[:, 0], X_meas[:, 2], meas_edges)
-            projection /= np.sum(projection)
-            projections.append(projection)
-            coords_meas.append(X_meas)
-        projections = np.array(projections)
-        coords_meas = np.array(coords_meas)
-
-        # Weight particles.
-        weights = np.zeros((n_proj, X.shape[0]))
-        for k, X_meas in enumerate(coords_meas):
-            xidx = np.digitize(X_meas[:, 0], meas_edges[0]) - 1
-            yidx = np.digitize(X_meas[:, 2], meas_edges[1]) - 1
-            on_meas_x = np.logical_and(xidx >= 0, xidx < len(meas_edges[0]) - 1)
-            on_meas_y = np.logical_and(yidx >= 0, yidx < len(meas_edges[1]) - 1)
-            on_meas = np.logical_and(on_meas_x, on_meas_y)
-            weights[k, on_meas] = projections_meas[k, xidx[on_meas], yidx[on_meas]] 
-            weights[k, on_meas] /= projections[k, xidx[on_meas], yidx[on_meas]]
-
-        # Only keep particles that hit every meas.
-        keep_idx = [np.all(weights[:, i] > 0.) for i in range(weights.shape[1])]
-        weights[:, np.logical_not(keep_idx)] = 0.
-        weights = np.sum(weights, axis=0)    
-        weights /= np.sum(weights)
-
-        # Convert the weights to counts.
-        counts = weights * n_parts
-        counts = np.round(counts).astype(int)
-        
+        start_time = time.time()
+        weights = np.zeros(n_parts)
+        keep = np.ones(n_parts, dtype=bool)
+        proj_error = 0.0
+        for k, M in enumerate(tmats):
+            # Simulate the measurement.
+            U = apply(np.asarray(M)[[0, 2], :], X)
+            xidx = np.digitize(U[:, 0], meas_edges[0]) - 1
+            yidx = np.digitize(U[:, 1], meas_edges[1]) - 1
+            on_meas = np.logical_and(
+                np.logical_and(xidx >= 0, xidx < n_bins_x_meas),
+                np.logical_and(yidx >= 0, yidx < n_bins_y_meas)
+            )
+            keep &= on_meas
+            idx = xidx * n_bins_y_meas + yidx
+            idx[~on_meas] = n_meas
+            projection = np.bincount(idx, minlength=n_meas + 1)[:-1]
+            projection = projection / max(np.sum(projection), 1)
+            proj_error += np.sum((projections_meas[k] - projection)**2)
+
+            # Weight particles by the ratio of measured to simulated density.
+            ratio = np.zeros(n_meas + 1)
+            valid = projection > 0.0
+            ratio[:-1][valid] = projections_meas[k, valid] / projection[valid]
+            weights += ratio[idx]
+
+        # Only keep particles that hit every screen.
+        weights[~keep] = 0.0
+        weight_sum = np.sum(weights)
+        if weight_sum == 0.0:
+            raise ValueError(
+                'No particle reached every screen with nonzero weight on '
+                'iteration {}; check that the reconstruction grid, screen '
+                'bins and transfer matrices are consistent.'.format(iteration)
+            )
+        weights /= weight_sum
+
         # Generate a new bunch.
-        add_idx = counts > 0
-        lo = np.repeat(X[add_idx] - 0.5 * rec_bin_widths, counts[add_idx], axis=0)
-        hi = np.repeat(X[add_idx] + 0.5 * rec_bin_widths, counts[add_idx], axis=0)
-        X = np.random.uniform(lo, hi)
-        
-        proj_error = np.sum((projections_meas - projections)**2)
-        print('proj_error = {}'.format(proj_error))
-        print('New bunch has {} particles'.format(X.shape[0]))
-        print('Iteration {} complete'.format(iteration))
-        
-#         # Plot current iteration.
-#         Z, _ = np.histogramdd(X, rec_edges)
-#         Z /= np.sum(Z)
-#         plot_kws = dict(ec='None', cmap='mono_r')
-#         labels = ["x", "x'", "y", "y'"]
-#         indices = [(0, 1), (2, 3), (0, 2), (0, 3), (2, 1), (1, 3)]
-#         fig, axes = pplt.subplots(nrows=1, ncols=6, figwidth=8.5, 
-#                                   sharex=False, sharey=False, space=0.2)
-#         for ax, (i, j) in zip(axes, indices):
-#             _Z = project(Z, [i, j])
-#             ax.pcolormesh(rec_edges[i], rec_edges[j], _Z.T, **plot_kws)
-#             ax.annotate('{}-{}'.format(labels[i], labels[j]),
-#                         xy=(0.02, 0.92), xycoords='axes fraction', 
-#                         color='white', fontsize='medium')
-#         axes.format(xticks=[], yticks=[])
-#         plt.show()
-        
-    Z = np.histogramdd(X, rec_edges)
-    return Z, projections
+        counts = rng.multinomial(n_parts, weights)
+        X = np.repeat(X, counts, axis=0)
+        X += rec_bin_widths * rng.uniform(-0.5, 0.5, size=X.shape)
+
+        history['error'].append(proj_error)
+        history['time'].append(time.time() - start_time)
+        if verbose:
+            print('iteration {}: proj_error = {:.3e}, t = {:.3f} s'.format(
+                iteration, proj_error, history['time'][-1]))
+        if tol is not None and iteration > 0:
+            prev_error = history['error'][-2]
+            if abs(prev_error - proj_error) < tol * prev_error:
+                break
+
+    Z, _ = np.histogramdd(X, rec_edges)
+    return Z, history
+
+
+def _ment4D_screen_indices(tmats, screen_edges, rec_limits, n_samples,
+                           chunk_size, seed):
+    """Yield the flattened screen bin indices of sampled particles.
+
+    Particles are drawn uniformly within `rec_limits`, one chunk at a time.
+    Each chunk has its own seed, so every pass over the chunks sees the same
+    particles without storing them. Particles that miss a screen get the
+    index Nsx * Nsy.
+    """
+    lo, hi = np.array(rec_limits).T
+    n_bins_x_screen = len(screen_edges[0]) - 1
+    n_bins_y_screen = len(screen_edges[1]) - 1
+    for chunk_index, start in enumerate(range(0, n_samples, chunk_size)):
+        rng = np.random.default_rng([seed, chunk_index])
+        size = min(chunk_size, n_samples - start)
+        X = lo + (hi - lo) * rng.random((size, 4))
+        screen_idx = np.empty((len(tmats), size), dtype=np.int64)
+        for k, M in enumerate(tmats):
+            U = apply(M[[0, 2], :], X)
+            xidx = np.digitize(U[:, 0], screen_edges[0]) - 1
+            yidx = np.digitize(U[:, 1], screen_edges[1]) - 1
+            on_screen = np.logical_and(
+                np.logical_and(xidx >= 0, xidx < n_bins_x_screen),
+                np.logical_and(yidx >= 0, yidx < n_bins_y_screen)
+            )
+            screen_idx[k] = xidx * n_bins_y_screen + yidx
+            screen_idx[k, ~on_screen] = n_bins_x_screen * n_bins_y_screen
+        yield screen_idx
+
+
+def ment4D(projections, tmats, rec_centers, screen_centers, iterations=10,
+           n_samples=1000000, chunk_size=100000, relaxation=1.0, tol=None,
+           seed=None, cache_indices=False, chunk_size_grid=1000000, 
+           verbose=True):
+    """Four-dimensional maximum entropy (MENT) reconstruction.
+
+    The MENT solution is Z(X) = prod_k h_k(x_k, y_k), where (x_k, y_k) are
+    the screen coordinates of X for the kth transfer matrix and h_k is
+    constant on each screen bin. The h_k are found by Gauss-Seidel iteration
+    as in `ment2D`. The simulated projections are computed by sampling
+    particles uniformly within the reconstruction grid, weighting them by Z,
+    and histogramming them on each screen. The particles are generated in
+    chunks, so memory does not depend on the grid size or `n_samples`, and
+    the system matrix of `art4D` is never formed.
+
+    Parameters
+    ----------
+    projections : ndarray, shape (n, Nsx, Nsy)
+        List of measured projections on the x-y plane.
+    tmats : ndarray, shape (n, 4, 4)
+        List of transfer matrices from the reconstruction location to the
+        measurement location.
+    rec_centers : ndarray, shape (4, Nr)
+        Grid center coordinates in [x, x', y, y'].
+    screen_centers : ndarray, shape (2, Ns)
+        Coordinates of bin centers on the screen in [x, y].
+    iterations : int
+        Maximum number of Gauss-Seidel sweeps over the projections.
+    n_samples : int
+        Number of particles used to simulate the projections.
+    chunk_size : int
+        Number of particles generated at once.
+    relaxation : float
+        Exponent applied to the update factor.
+    tol : float (optional)
+        Stop when the mean relative L1 discrepancy between the measured and
+        simulated projections falls below this value.
+    seed : int (optional)
+        Seed for the particle coordinates.
+    cache_indices : bool
+        Whether to keep the screen bin indices of all particles in memory
+        (n * n_samples integers) instead of regenerating them in each pass.
+    chunk_size_grid : int
+        Number of grid points evaluated at once when forming Z on the
+        reconstruction grid.
+    verbose : bool
+        Whether to print the discrepancy and time after each sweep.
 
+    Returns
+    -------
+    Z : ndarray, shape (Nr, Nr, Nr, Nr)
+        The MENT density evaluated at the grid centers (not normalized).
+    history : dict
+        'error': mean relative L1 discrepancy after each sweep; 'time':
+        cumulative time [s] after each sweep.
+    """
+    tmats = np.asarray(tmats)
+    n_proj = len(tmats)
+    projections = np.array([np.ravel(p) / np.sum(p) for p in projections])
+    n_screen = projections.shape[1]
+    screen_edges = [get_bin_edges(c) for c in screen_centers]
+    rec_edges = [get_bin_edges(c) for c in rec_centers]
+    rec_limits = [(e[0], e[-1]) for e in rec_edges]
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    chunks = lambda: _ment4D_screen_indices(tmats, screen_edges, rec_limits,
+                                            n_samples, chunk_size, seed)
+    if cache_indices:
+        cached_chunks = list(chunks())
+        chunks = lambda: cached_chunks
+
+    def simulate(H, indices):
+        """Return the weighted histograms on the screens in `indices`."""
+        simulated = np.zeros((len(indices), n_screen + 1))
+        total = 0.0
+        for screen_idx in chunks():
+            weights = np.prod(H[np.arange(n_proj)[:, None], screen_idx], axis=0)
+            total += np.sum(weights)
+            for i, k in enumerate(indices):
+                simulated[i] += np.bincount(screen_idx[k], weights=weights,
+                                            minlength=n_screen + 1)
+        if total > 0.0:
+            simulated /= total
+        return simulated[:, :-1]
+
+    # The last column of H is the value off the screen.
+    H = np.ones((n_proj, n_screen + 1))
+    H[:, -1] = 0.0
+    history = {'error': [], 'time': []}
+    start_time = time.time()
+    for iteration in range(iterations):
+        for k in range(n_proj):
+            simulated = simulate(H, [k])[0]
+            ratio = np.zeros(n_screen)
+            valid = simulated > 0.0
+            ratio[valid] = projections[k, valid] / simulated[valid]
+            H[k, :-1] *= ratio**relaxation
+        simulated = simulate(H, range(n_proj))
+        error = np.mean(np.sum(np.abs(simulated - projections), axis=1))
+        history['error'].append(error)
+        history['time'].append(time.time() - start_time)
+        if verbose:
+            print('iteration {}: error = {:.3e}, t = {:.3f} s'.format(
+                iteration, error, history['time'][-1]))
+        if tol is not None and error < tol:
+            break
 
-def ment4D():
-    raise NotImplementedError
\ No newline at end of file
+    # Evaluate Z at the grid centers.
+    projector = ScreenProjector(tmats, rec_centers, screen_centers,
+                                chunk_size=chunk_size_grid)
+    Z = np.ones(projector.shape[1])
+    for lo, hi in projector.chunks():
+        Z_chunk = Z[lo * projector._slice_size: hi * projector._slice_size]
+        for k in range(n_proj):
+            Z_chunk *= H[k, projector.screen_indices(k, lo, hi)]
+    return Z.reshape(projector.rec_shape), history
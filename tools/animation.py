@@ -25,6 +25,7 @@ from .plotting import vector
 from .plotting import var_indices
 from .utils import get_bin_centers
 from .utils import rand_rows
+from .utils import bunch_moments
 from . import plotting as myplt
 
 
@@ -319,7 +320,7 @@ def corner(
             )
             ARTISTS_LIST.append(env_lines)
         if rms_ellipse:
-            Sigma = np.cov(X.T)
+            Sigma = bunch_moments(X)['cov']
             if two_rms:
                 Sigma *= 4.0
             _, rms_artists = myplt.rms_ellipses(
@@ -1,8 +1,13 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import numpy.linalg as la
 import pandas as pd
 
-from .utils import cov2corr, symmetrize
+from .utils import cov2corr
+from .utils import bunch_moments_stack
 
 
 env_cols = ['a','b','ap','bp','e','f','ep','fp']
@@ -12,17 +17,22 @@ twiss4D_cols = ['alpha_x','alpha_y','beta_x','beta_y','u','nu','eps_1','eps_2','
 
 
 def mat2vec(Sigma):
-    """Return vector of independent elements in 4x4 symmetric matrix Sigma."""
-    return Sigma[np.triu_indices(4)]
+    """Return vector of independent elements in 4x4 symmetric matrix Sigma.
+    
+    Sigma can also be a stack of matrices with shape (..., 4, 4).
+    """
+    i, j = np.triu_indices(4)
+    return np.asarray(Sigma)[..., i, j]
                   
                   
 def vec2mat(moment_vec):
-    """Inverse of `mat2vec`."""
-    Sigma = np.zeros((4, 4))
-    indices = np.triu_indices(4)
-    for moment, (i, j) in zip(moment_vec, zip(*indices)):
-        Sigma[i, j] = moment
-    return symmetrize(Sigma)
+    """Inverse of `mat2vec`. Works on stacks of shape (..., 10)."""
+    moment_vec = np.asarray(moment_vec)
+    Sigma = np.zeros(moment_vec.shape[:-1] + (4, 4))
+    i, j = np.triu_indices(4)
+    Sigma[..., i, j] = moment_vec
+    Sigma[..., j, i] = moment_vec
+    return Sigma
 
 
 def get_ellipse_coords(env_params, npts=100):
@@ -63,10 +73,12 @@ def _rms_ellipse_dims(sig_xx, sig_yy, sig_xy):
 def rms_ellipse_dims(Sigma, x1='x', x2='y'):
     """Return (angle, c1, c2) of rms ellipse in x1-x2 plane, where angle is the
     clockwise tilt angle and c1/c2 are the semi-axes.
+    
+    Sigma can also be a stack of matrices with shape (..., 4, 4).
     """
     str_to_int = {'x':0, 'xp':1, 'y':2, 'yp':3}
     i, j = str_to_int[x1], str_to_int[x2]
-    sii, sjj, sij = Sigma[i, i], Sigma[j, j], Sigma[i, j]
+    sii, sjj, sij = Sigma[..., i, i], Sigma[..., j, j], Sigma[..., i, j]
     angle = -0.5 * np.arctan2(2*sij, sii-sjj)
     sin, cos = np.sin(angle), np.cos(angle)
     sin2, cos2 = sin**2, cos**2
@@ -76,9 +88,13 @@ def rms_ellipse_dims(Sigma, x1='x', x2='y'):
     
     
 def intrinsic_emittances(Sigma):
-    """Return intrinsic emittances from covariance matrix."""
+    """Return intrinsic emittances from covariance matrix.
+    
+    Sigma can also be a stack of matrices with shape (..., 4, 4).
+    """
     U = np.array([[0, 1, 0, 0], [-1, 0, 0, 0], [0, 0, 0, 1], [0, 0, -1, 0]])
-    trSU2 = np.trace(la.matrix_power(np.matmul(Sigma, U), 2))
+    SU = np.matmul(Sigma, U)
+    trSU2 = np.trace(np.matmul(SU, SU), axis1=-2, axis2=-1)
     detS = la.det(Sigma)
     eps_1 = 0.5 * np.sqrt(-trSU2 + np.sqrt(trSU2**2 - 16 * detS))
     eps_2 = 0.5 * np.sqrt(-trSU2 - np.sqrt(trSU2**2 - 16 * detS))
@@ -86,9 +102,9 @@ def intrinsic_emittances(Sigma):
     
     
 def apparent_emittances(Sigma):
-    """Return apparent emittances from covariance matrix."""
-    eps_x = np.sqrt(la.det(Sigma[:2, :2]))
-    eps_y = np.sqrt(la.det(Sigma[2:, 2:]))
+    """Return apparent emittances from covariance matrix (or stack)."""
+    eps_x = np.sqrt(la.det(Sigma[..., :2, :2]))
+    eps_y = np.sqrt(la.det(Sigma[..., 2:, 2:]))
     return eps_x, eps_y
 
 
@@ -107,12 +123,12 @@ def coupling_coefficient(Sigma):
     
     
 def twiss2D(Sigma):
-    """Return 2D Twiss parameters from covariance matrix."""
+    """Return 2D Twiss parameters from covariance matrix (or stack)."""
     eps_x, eps_y = apparent_emittances(Sigma)
-    beta_x = Sigma[0, 0] / eps_x
-    beta_y = Sigma[2, 2] / eps_y
-    alpha_x = -Sigma[0, 1] / eps_x
-    alpha_y = -Sigma[2, 3] / eps_y
+    beta_x = Sigma[..., 0, 0] / eps_x
+    beta_y = Sigma[..., 2, 2] / eps_y
+    alpha_x = -Sigma[..., 0, 1] / eps_x
+    alpha_y = -Sigma[..., 2, 3] / eps_y
     return np.array([alpha_x, alpha_y, beta_x, beta_y])
     
     
@@ -122,15 +138,17 @@ def twiss4D(Sigma, mode):
     This is technically only valid for the Danilov distribution. What we
     really need to do is compute V from the eigenvectors of Sigma U, then
     compute the Twiss parameters from V.
+    
+    Sigma can also be a stack of matrices with shape (..., 4, 4).
     """
     eps_1, eps_2 = intrinsic_emittances(Sigma)
     eps_x, eps_y = apparent_emittances(Sigma)
-    eps_l = max([eps_1, eps_2])
-    beta_lx = Sigma[0, 0] / eps_l
-    beta_ly = Sigma[2, 2] / eps_l
-    alpha_lx = -Sigma[0, 1] / eps_l
-    alpha_ly = -Sigma[2, 3] / eps_l
-    nu = np.arccos(Sigma[0, 2] / np.sqrt(Sigma[0, 0]*Sigma[2, 2]))
+    eps_l = np.fmax(eps_1, eps_2)
+    beta_lx = Sigma[..., 0, 0] / eps_l
+    beta_ly = Sigma[..., 2, 2] / eps_l
+    alpha_lx = -Sigma[..., 0, 1] / eps_l
+    alpha_ly = -Sigma[..., 2, 3] / eps_l
+    nu = np.arccos(Sigma[..., 0, 2] / np.sqrt(Sigma[..., 0, 0]*Sigma[..., 2, 2]))
     if mode == 1:
         u = eps_y / eps_l
     elif mode == 2:
@@ -222,48 +240,51 @@ class BeamStats:
         return self.read_moments(moments_list)
         
     def read_moments(self, moments_list):
+        """Compute all statistics from an (n, 10) array of moments.
+        
+        Every frame is processed at once with broadcasted NumPy operations
+        on the (n, 4, 4) stack of covariance matrices.
+        """
         if not self._initialized:
             self._create_empty_arrays(moments_list)
-        for i, moments in enumerate(moments_list):
-            Sigma = vec2mat(moments)
-            Corr = cov2corr(Sigma)
-            alpha_x, alpha_y, beta_x, beta_y = twiss2D(Sigma)
-            alpha_lx, alpha_ly, beta_lx, beta_ly, u, nu = twiss4D(Sigma, self.mode)
-            eps_x, eps_y = apparent_emittances(Sigma)
-            eps_1, eps_2 = intrinsic_emittances(Sigma)
-            eps_4D = eps_1 * eps_2
-            eps_4D_app = eps_x * eps_y
-            C = np.sqrt(eps_4D_app / eps_4D) if eps_4D > 0. else np.inf
-            self.moments_arr[i] = moments
-            self.corr_arr[i] = mat2vec(Corr)
-            self.twiss2D_arr[i] = [alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y]
-            self.twiss4D_arr[i] = [alpha_lx, alpha_ly, beta_lx, beta_ly, 
-                                   u, nu, eps_1, eps_2, eps_4D, eps_4D_app, C]
-            angle, cx, cy = rms_ellipse_dims(Sigma, 'x', 'y')
-            angle = np.degrees(angle)
-            area = np.pi * cx * cy
-            self.realspace_arr[i] = [angle, cx, cy, area]
+        moments = np.asarray(moments_list, dtype=float)
+        Sigma = vec2mat(moments)
+        alpha_x, alpha_y, beta_x, beta_y = twiss2D(Sigma)
+        alpha_lx, alpha_ly, beta_lx, beta_ly, u, nu = twiss4D(Sigma, self.mode)
+        eps_x, eps_y = apparent_emittances(Sigma)
+        eps_1, eps_2 = intrinsic_emittances(Sigma)
+        eps_4D = eps_1 * eps_2
+        eps_4D_app = eps_x * eps_y
+        C = np.full(len(moments), np.inf)
+        np.divide(eps_4D_app, eps_4D, out=C, where=eps_4D > 0.)
+        np.sqrt(C, out=C)
+        self.moments_arr[:] = moments
+        self.corr_arr[:] = mat2vec(cov2corr(Sigma))
+        self.twiss2D_arr[:] = np.stack([alpha_x, alpha_y, beta_x, beta_y, 
+                                        eps_x, eps_y], axis=-1)
+        self.twiss4D_arr[:] = np.stack([alpha_lx, alpha_ly, beta_lx, beta_ly, 
+                                        u, nu, eps_1, eps_2, eps_4D, 
+                                        eps_4D_app, C], axis=-1)
+        angle, cx, cy = rms_ellipse_dims(Sigma, 'x', 'y')
+        area = np.pi * cx * cy
+        self.realspace_arr[:] = np.stack([np.degrees(angle), cx, cy, area], 
+                                         axis=-1)
         self._create_dfs()
         
     def read_env(self, env_params_list):
         if not self._initialized:
             self._create_empty_arrays(env_params_list)
-        moments_list = []
-        for env_params in env_params_list:
-            a, b, ap, bp, e, f, ep, fp = env_params
-            P = np.array([[a, b], [ap, bp], [e, f], [ep, fp]])
-            Sigma = 0.25 * np.matmul(P, P.T)
-            moments_list.append(mat2vec(Sigma))
-        return self.read_moments(moments_list)
+        env_params = np.asarray(env_params_list, dtype=float)
+        self.env_params_arr[:] = env_params
+        # Rows of P are [a, b], [a', b'], [e, f], [e', f'].
+        P = env_params.reshape(-1, 4, 2)
+        Sigma = 0.25 * np.matmul(P, np.swapaxes(P, -1, -2))
+        return self.read_moments(mat2vec(Sigma))
     
-    def read_coords(self, coords):
-        moments_list = []
-        for X in coords:
-            Sigma = np.cov(X.T)
-            Sigma = Sigma[:4, :4]
-            moments = mat2vec(Sigma)
-            moments_list.append(moments)
-        self.read_moments(moments_list)
+    def read_coords(self, coords, weights=None, n_workers=1):
+        Sigmas = bunch_moments_stack(coords, weights=weights, 
+                                     n_workers=n_workers)['cov']
+        self.read_moments(mat2vec(Sigmas[:, :4, :4]))
 
     def _create_dfs(self):
         self.env_params = pd.DataFrame(self.env_params_arr, columns=env_cols)
@@ -276,8 +297,8 @@ class BeamStats:
         # Add/edit columns
         self.moments[['x_rms','y_rms']] = np.sqrt(self.moments[['x2','y2']])
         self.moments[['xp_rms','yp_rms']] = np.sqrt(self.moments[['xp2','yp2']])
-        self.realspace['area_rel'] = self.realspace['area'] / \
-                                     self.realspace.loc[0, 'area']
+        area0 = self.realspace['area'].iloc[0] if self.nframes else np.nan
+        self.realspace['area_rel'] = self.realspace['area'] / area0
         self.twiss4D['nu'] = np.degrees(self.twiss4D['nu'])
         eps = self.twiss2D['eps_x'] + self.twiss2D['eps_y']
         self.twiss2D['eps_x_frac'] = self.twiss2D['eps_x'] / eps
@@ -287,11 +308,154 @@ class BeamStats:
         return [self.twiss2D, self.twiss4D, self.moments, 
                 self.corr, self.realspace, self.env_params]
 
+
+
+class _ChunkedBuffer:
+    """Append-only buffer of fixed-width rows stored in fixed-size chunks."""
+    def __init__(self, n_cols, chunk_size=1024):
+        self.n_cols = n_cols
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.n_rows = 0
+
+    def append(self, row):
+        i = self.n_rows % self.chunk_size
+        if i == 0:
+            self.chunks.append(np.zeros((self.chunk_size, self.n_cols)))
+        self.chunks[-1][i] = row
+        self.n_rows += 1
+
+    def array(self):
+        """Return the filled rows as one (n_rows, n_cols) array."""
+        if self.n_rows == 0:
+            return np.zeros((0, self.n_cols))
+        return np.concatenate(self.chunks)[:self.n_rows]
+
+
+class BeamStatsAccumulator:
+    """Incremental version of `BeamStats` for turn-by-turn data.
+
+    Bunches are added one turn at a time. A turn can also be added in pieces
+    (e.g., one per MPI node) with `add_part` followed by `end_turn`; the
+    mean and covariance of the pieces are merged with the pairwise update
+    of Chan et al. The per-turn moments are appended to chunked buffers, and
+    the `BeamStats` DataFrames are only computed when they are accessed.
+
+    Attributes
+    ----------
+    mode : {1, 2}
+        See `BeamStats`.
+    n_turns : int
+        The number of completed turns.
+    """
+    def __init__(self, mode=None, chunk_size=1024):
+        self.mode = mode
+        self._moments = _ChunkedBuffer(10, chunk_size)
+        self._means = _ChunkedBuffer(4, chunk_size)
+        self._n_parts = _ChunkedBuffer(1, chunk_size)
+        self._stats = None
+        self._reset_turn()
+
+    def _reset_turn(self):
+        self._n = 0
+        self._mean = np.zeros(4)
+        self._M2 = np.zeros((4, 4))
+
+    @property
+    def n_turns(self):
+        return self._moments.n_rows
+
+    def add_part(self, X):
+        """Add part of the bunch on the current turn.
+
+        X : ndarray, shape (n, 4) or (n, 6)
+            Coordinates [x, x', y, y', ...]; only the first four columns are
+            used.
+        """
+        X = np.asarray(X)[:, :4]
+        n = X.shape[0]
+        if n == 0:
+            return
+        mean = np.mean(X, axis=0)
+        D = X - mean
+        M2 = np.matmul(D.T, D)
+        n_tot = self._n + n
+        delta = mean - self._mean
+        self._M2 += M2 + np.outer(delta, delta) * (self._n * n / n_tot)
+        self._mean += delta * (n / n_tot)
+        self._n = n_tot
+
+    def end_turn(self):
+        """Store the moments of the current turn and start a new one."""
+        Sigma = self._M2 / max(self._n - 1, 1)
+        self._moments.append(mat2vec(Sigma))
+        self._means.append(self._mean)
+        self._n_parts.append(self._n)
+        self._stats = None
+        self._reset_turn()
+
+    def add_bunch(self, X):
+        """Add the full bunch for one turn."""
+        self.add_part(X)
+        self.end_turn()
+
+    def add_moments(self, moments):
+        """Add the 10 moments for one turn directly."""
+        self._moments.append(moments)
+        self._means.append(np.full(4, np.nan))
+        self._n_parts.append(np.nan)
+        self._stats = None
+
+    @property
+    def stats(self):
+        """`BeamStats` computed from all turns added so far.
+        
+        The DataFrames are empty if no turn has been completed.
+        """
+        if self._stats is None:
+            self._stats = BeamStats(self.mode)
+            self._stats.read_moments(self._moments.array())
+        return self._stats
+
+    @property
+    def means(self):
+        """DataFrame of the bunch centroid and number of particles."""
+        df = pd.DataFrame(self._means.array(), columns=['x','xp','y','yp'])
+        df['n_parts'] = self._n_parts.array()[:, 0]
+        return df
+
+    @property
+    def twiss2D(self):
+        return self.stats.twiss2D
+
+    @property
+    def twiss4D(self):
+        return self.stats.twiss4D
+
+    @property
+    def moments(self):
+        return self.stats.moments
+
+    @property
+    def corr(self):
+        return self.stats.corr
+
+    @property
+    def realspace(self):
+        return self.stats.realspace
+
+    def dfs(self):
+        return self.stats.dfs()
+
     
 class TuneCalculator:
     """This is a workaround while the PyORBIT method is broken.
     
     Note: we normalize by the lattice Twiss parameters, not the beam Twiss parameters. 
+    
+    The methods accept arrays of shape (..., 6), e.g., a single bunch 
+    (n_parts, 6) or turn-by-turn data (n_turns, n_parts, 6). The dtype of
+    the input (float32 or float64) is kept.
     """
     def __init__(self, mass, kin_energy, alpha_x, alpha_y, beta_x, beta_y, eta_x=0., eta_px=0.):
         self.alpha_x = alpha_x
@@ -306,30 +470,39 @@ class TuneCalculator:
         self.gamma = self.energy / self.mass
         self.beta = 1 / np.sqrt(1 - (1 / self.gamma**2))
         
-    def normalize(self, X):
-        Xn = np.copy(X)
-        for i, (x, xp, y, yp, z, dE) in enumerate(X):
-            dpp = (1 / self.beta**2) * dE / self.energy
-            xn = (x - self.eta_x * dpp) / np.sqrt(self.beta_x)
-            xpn = (xp - self.eta_px * dpp) * np.sqrt(self.beta_x) + xn * self.alpha_x
-            yn = y / np.sqrt(self.beta_y)
-            ypn = (yp + y * self.alpha_y / self.beta_y) * np.sqrt(self.beta_y)
-            Xn[i, :] = [xn, xpn, yn, ypn, z, dE]
+    def normalize(self, X, inplace=False):
+        """Return Floquet-normalized coordinates.
+        
+        If `inplace`, X is overwritten and returned. 
+        """
+        Xn = X if inplace else np.copy(X)
+        dpp = (1 / self.beta**2) * Xn[..., 5] / self.energy
+        sqrt_beta_x = np.sqrt(self.beta_x)
+        sqrt_beta_y = np.sqrt(self.beta_y)
+        Xn[..., 0] -= self.eta_x * dpp
+        Xn[..., 0] /= sqrt_beta_x
+        Xn[..., 1] -= self.eta_px * dpp
+        Xn[..., 1] *= sqrt_beta_x
+        Xn[..., 1] += self.alpha_x * Xn[..., 0]
+        Xn[..., 2] /= sqrt_beta_y
+        Xn[..., 3] *= sqrt_beta_y
+        Xn[..., 3] += self.alpha_y * Xn[..., 2]
         return Xn
 
-    def get_phases(self, X): 
-        def _get_phases(u, up):
-            phases = np.arctan2(up, u)
-            phases[np.where(phases < 0.)] += (2 * np.pi)
-            return phases
-        X = self.normalize(X)
-        xphases = _get_phases(X[:, 0], X[:, 1])
-        yphases = _get_phases(X[:, 2], X[:, 3])
-        return np.vstack([xphases, yphases]).T
-    
-    def get_tunes(self, X0, X1):
-        phases0 = self.get_phases(X0)
-        phases1 = self.get_phases(X1)
+    def get_phases(self, X, inplace=False): 
+        """Return the x and y phases in the range [0, 2pi).
+        
+        If `inplace`, X is normalized in place.
+        """
+        X = self.normalize(X, inplace=inplace)
+        phases = np.arctan2(X[..., [1, 3]], X[..., [0, 2]])
+        phases[phases < 0.] += (2 * np.pi)
+        return phases
+    
+    def get_tunes(self, X0, X1, inplace=False):
+        """Return the tunes from the phase advance between two turns."""
+        phases0 = self.get_phases(X0, inplace=inplace)
+        phases1 = self.get_phases(X1, inplace=inplace)
         # The bunches could be different sizes.
         min_n_parts = min(len(phases0), len(phases1))
         phases0 = phases0[:min_n_parts, :]
@@ -338,10 +511,196 @@ class TuneCalculator:
         tunes[np.where(tunes < 0.)] += 1.
         return tunes
     
+    def get_tunes_multiturn(self, coords, method='naff', n_iters=3, 
+                            chunk_size=10000):
+        """Return the tunes from the turn-by-turn coordinates.
+        
+        The signal x_n - i * x'_n (normalized coordinates) of each particle 
+        is multiplied by a Hann window and Fourier transformed. The tune is
+        the peak frequency, refined by interpolation between the two largest
+        bins ('fft') and then, for 'naff', by Newton iterations that maximize 
+        the amplitude of the windowed Fourier integral.
+        
+        Parameters
+        ----------
+        coords : ndarray, shape (n_turns, n_parts, 6)
+            Turn-by-turn coordinates of the same particles.
+        method : {'fft', 'naff'}
+            The tune refinement method. 
+        n_iters : int
+            Number of Newton iterations for 'naff'.
+        chunk_size : int
+            Number of particles processed at once.
+            
+        Returns
+        -------
+        tunes : ndarray, shape (n_parts, 2)
+            The x and y tunes in the range [0, 1).
+        """
+        if method not in ['fft', 'naff']:
+            raise ValueError("method must be 'fft' or 'naff'.")
+        n_turns, n_parts = coords.shape[:2]
+        n = np.arange(n_turns)
+        window = np.sin(np.pi * n / n_turns)**2
+        tunes = np.zeros((n_parts, 2))
+        for lo in range(0, n_parts, chunk_size):
+            hi = min(lo + chunk_size, n_parts)
+            X = self.normalize(coords[:, lo:hi, :], inplace=False)
+            for plane, (i, j) in enumerate([(0, 1), (2, 3)]):
+                signal = (X[..., i] - 1j * X[..., j]) * window[:, None]
+                tunes[lo:hi, plane] = _peak_frequency(signal, method, n_iters)
+        return tunes
+    
+    
+def _peak_frequency(signal, method='naff', n_iters=3):
+    """Return the frequency of the largest peak in each column of `signal`.
+    
+    `signal` should already be multiplied by a Hann window. See 
+    `TuneCalculator.get_tunes_multiturn`.
+    """
+    N, n_signals = signal.shape
+    cols = np.arange(n_signals)
+    F = np.abs(np.fft.fft(signal, axis=0))
+    k = np.argmax(F, axis=0)
+    # Interpolate between the peak and its largest neighbor (Hann window).
+    F_peak = F[k, cols]
+    F_left = F[(k - 1) % N, cols]
+    F_right = F[(k + 1) % N, cols]
+    side = np.where(F_right > F_left, 1.0, -1.0)
+    ratio = np.fmax(F_right, F_left) / np.where(F_peak > 0., F_peak, 1.0)
+    delta = side * (2.0 * ratio - 1.0) / (ratio + 1.0)
+    freqs = (k + np.clip(delta, -0.5, 0.5)) / N
+    if method == 'naff':
+        # Newton's method for the maximum of |A|^2, where 
+        # A(theta) = sum_n signal_n * exp(-i * theta * n).
+        n = np.arange(N)[:, None]
+        theta = 2.0 * np.pi * freqs
+        max_step = np.pi / N
+        for _ in range(n_iters):
+            S = signal * np.exp(-1j * n * theta)
+            A = np.sum(S, axis=0)
+            S *= n
+            dA = -1j * np.sum(S, axis=0)
+            S *= n
+            d2A = -np.sum(S, axis=0)
+            df = 2.0 * np.real(np.conj(A) * dA)
+            d2f = 2.0 * (np.abs(dA)**2 + np.real(np.conj(A) * d2A))
+            step = np.where(d2f < 0., -df / np.where(d2f < 0., d2f, -1.0), 0.)
+            theta += np.clip(step, -max_step, max_step)
+        freqs = theta / (2.0 * np.pi)
+    return np.mod(freqs, 1.0)
+
+    
+pybunch_cols = ['x','xp','y','yp','z','dE', 'mux', 'muy', 'nux', 'nuy', 'Jx', 'Jy']
+
+
+def _parse_pybunch(filename, skiprows=15):
+    """Parse a PyORBIT bunch dump into a contiguous float array.
+    
+    Raises ValueError if a token is not a number or the rows have 
+    different lengths.
+    """
+    X = np.loadtxt(filename, skiprows=skiprows, ndmin=2)
+    if X.shape[0] == 0:
+        return np.zeros((0, 6))
+    X[:, :4] *= 1000. # convert from m-rad to mm-mrad
+    X[:, 5] *= 1000. # convert energy spread from [GeV] to [MeV]
+    return X
+
+
+def read_pybunch(filename, columns=None, rows=None, cache=True, skiprows=15):
+    """Read a PyORBIT bunch dump as an array.
+    
+    The text is parsed once and saved next to it as `filename + '.npy'`. 
+    Later calls memory-map the .npy file as long as it is newer than the 
+    text file, so only the requested columns and rows are read from disk.
     
-def load_pybunch(filename):
-    X = pd.read_table(filename, sep=' ', skiprows=15, index_col=False, 
-                      names=['x','xp','y','yp','z','dE', 'mux', 'muy', 'nux', 'nuy', 'Jx', 'Jy'])
-    X.iloc[:, :4] *= 1000. # convert from m-rad to mm-mrad
-    X.iloc[:, 5] *= 1000. # convert energy spread from [GeV] to [MeV]
-    return X
\ No newline at end of file
+    Parameters
+    ----------
+    filename : str
+        Path to the file written by `Bunch.dumpBunch`.
+    columns : list[int or str] (optional)
+        Column indices or names (see `pybunch_cols`). All columns are read 
+        if None.
+    rows : slice or ndarray (optional)
+        Row subset, e.g., `slice(0, None, 10)` for every 10th particle.
+    cache : bool
+        Whether to use and create the .npy file.
+    skiprows : int
+        Number of header lines.
+        
+    Returns
+    -------
+    ndarray, shape (n, k)
+        Coordinates in mm-mrad and MeV. If no subset is requested and the 
+        .npy file is used, this is a read-only memory map.
+    """
+    cache_filename = filename + '.npy'
+    if cache and (os.path.isfile(cache_filename) and 
+                  os.path.getmtime(cache_filename) >= os.path.getmtime(filename)):
+        X = np.load(cache_filename, mmap_mode='r')
+    else:
+        X = _parse_pybunch(filename, skiprows)
+        if cache:
+            np.save(cache_filename, X)
+    if rows is not None:
+        X = X[rows]
+    if columns is not None:
+        columns = [pybunch_cols.index(col) if type(col) is str else col 
+                   for col in columns]
+        X = X[:, columns]
+    return X
+    
+    
+def load_pybunch(filename, columns=None, rows=None, cache=True):
+    """Read a PyORBIT bunch dump as a DataFrame (see `read_pybunch`).
+    
+    If `columns` is None, the DataFrame has all the columns in 
+    `pybunch_cols`; those missing from the file are filled with NaN.
+    """
+    X = read_pybunch(filename, columns=columns, rows=rows, cache=cache)
+    if columns is None:
+        n_cols = len(pybunch_cols)
+        X = np.asarray(X)[:, :n_cols]
+        if X.shape[1] < n_cols:
+            pad = np.full((X.shape[0], n_cols - X.shape[1]), np.nan)
+            X = np.hstack([X, pad])
+        names = pybunch_cols
+    else:
+        names = [col if type(col) is str else pybunch_cols[col] 
+                 for col in columns]
+    return pd.DataFrame(np.array(X), columns=names)
+
+
+def load_pybunch_dir(path, ext='.dat', n_workers=4, **kws):
+    """Read all PyORBIT bunch dumps in a folder.
+    
+    The files are sorted by the integers in their names, e.g., 
+    'bunch_turn=2.dat' comes before 'bunch_turn=10.dat'.
+    
+    Parameters
+    ----------
+    path : str
+        The folder.
+    ext : str
+        Only read files with this extension.
+    n_workers : int
+        Number of threads used to read the files.
+    **kws
+        Key word arguments for `read_pybunch`.
+        
+    Returns
+    -------
+    filenames : list[str]
+        The sorted file names.
+    coords : list[ndarray]
+        The coordinate array from each file.
+    """
+    filenames = [os.path.join(path, f) for f in os.listdir(path)
+                 if f.endswith(ext)]
+    filenames = sorted(filenames, key=lambda f: [
+        int(s) if s.isdigit() else s for s in re.split(r'(\d+)', f)
+    ])
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        coords = list(executor.map(lambda f: read_pybunch(f, **kws), filenames))
+    return filenames, coords
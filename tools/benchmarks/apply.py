@@ -0,0 +1,39 @@
+"""Compare `utils.apply` with the old `np.apply_along_axis` implementation."""
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('../../')
+from tools import utils
+
+
+# Settings
+#------------------------------------------------------------------------------
+n_points_list = [int(1e4), int(1e6), int(1e7)]
+n_dims = 4
+seed = 0
+
+
+# Benchmark
+#------------------------------------------------------------------------------
+def apply_old(M, X):
+    return np.apply_along_axis(lambda x: np.matmul(M, x), 1, X)
+
+
+def timeit(func, *args, **kws):
+    start_time = time.time()
+    func(*args, **kws)
+    return time.time() - start_time
+
+
+rng = np.random.default_rng(seed)
+M = rng.normal(size=(n_dims, n_dims))
+print('n_points   old [s]    new [s]    in place [s]   speedup')
+for n_points in n_points_list:
+    X = rng.normal(size=(n_points, n_dims))
+    t_old = timeit(apply_old, M, X)
+    t_new = timeit(utils.apply, M, X)
+    t_inplace = timeit(utils.apply, M, X, out=X)
+    print('{:<10.0e} {:<10.3f} {:<10.4f} {:<14.4f} {:.0f}'.format(
+        n_points, t_old, t_new, t_inplace, t_old / t_new))
@@ -0,0 +1,57 @@
+"""Compare the batched `BeamStats.read_moments` with a per-frame loop.
+
+The loop calls the same functions on one covariance matrix at a time, as
+`read_moments` did before it was vectorised.
+"""
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.append('../../')
+from tools import beam_analysis as ba
+from tools.utils import cov2corr
+
+
+# Settings
+#------------------------------------------------------------------------------
+n_frames_list = [int(1e3), int(1e5), int(1e6)]
+max_frames_loop = int(1e5) # the loop is too slow beyond this
+seed = 0
+
+
+# Benchmark
+#------------------------------------------------------------------------------
+def read_moments_loop(moments_list, mode=1):
+    rows = []
+    for moments in moments_list:
+        Sigma = ba.vec2mat(moments)
+        corr = ba.mat2vec(cov2corr(Sigma))
+        twiss2D = ba.twiss2D(Sigma)
+        twiss4D = ba.twiss4D(Sigma, mode)
+        eps_x, eps_y = ba.apparent_emittances(Sigma)
+        eps_1, eps_2 = ba.intrinsic_emittances(Sigma)
+        angle, cx, cy = ba.rms_ellipse_dims(Sigma, 'x', 'y')
+        rows.append([corr, twiss2D, twiss4D, eps_x, eps_y, eps_1, eps_2, 
+                     angle, cx, cy])
+    return rows
+
+
+warnings.simplefilter('ignore') # sqrt of small negative numbers
+rng = np.random.default_rng(seed)
+print('n_frames   loop [s]   batched [s]   speedup')
+for n_frames in n_frames_list:
+    A = rng.normal(size=(n_frames, 4, 4))
+    moments = ba.mat2vec(np.matmul(A, np.swapaxes(A, 1, 2)))
+    t_loop = np.nan
+    if n_frames <= max_frames_loop:
+        start_time = time.time()
+        read_moments_loop(moments)
+        t_loop = time.time() - start_time
+    start_time = time.time()
+    stats = ba.BeamStats()
+    stats.read_moments(moments)
+    t_batch = time.time() - start_time
+    print('{:<10.0e} {:<10.3f} {:<13.3f} {:.0f}'.format(
+        n_frames, t_loop, t_batch, t_loop / t_batch))
@@ -0,0 +1,284 @@
+"""Compressed storage of bunch coordinates with a statistics index.
+
+A store is a folder containing 'chunks.bin', the compressed coordinates of
+each saved bunch (one chunk per bunch) written one after another, and
+'index.npz', which records the byte range of each chunk together with
+precomputed statistics and a small uncompressed random sample of the bunch.
+While a store is being written, the index is kept in append-only files
+and 'index.npz' is written when the writer is closed.
+Statistics and previews are read from the index alone; a chunk is only
+decompressed when its coordinates are requested.
+
+Chunks are compressed with blosc (zstd codec, byte shuffle) if it is
+installed and with zlib otherwise.
+"""
+import os
+import zlib
+
+import numpy as np
+
+from .beam_analysis import BeamStats
+from .beam_analysis import mat2vec
+from .utils import bunch_moments
+from .utils import load_stacked_arrays
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+def _compress(data, itemsize, compression, level):
+    if compression == 'blosc':
+        return blosc.compress(data, typesize=itemsize, clevel=level,
+                              shuffle=blosc.SHUFFLE, cname='zstd')
+    elif compression == 'zlib':
+        return zlib.compress(data, level)
+    elif compression == 'none':
+        return data
+    raise ValueError("Invalid compression '{}'".format(compression))
+
+
+def _decompress(data, compression):
+    if compression == 'blosc':
+        if blosc is None:
+            raise ImportError('This store was written with blosc.')
+        return blosc.decompress(data)
+    elif compression == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def _record_dtype(n_cols):
+    """Fixed-size record of one bunch in 'records.bin'."""
+    return np.dtype([
+        ('n_bytes', '<i8'), ('turn', '<i8'), ('n_parts', '<i8'),
+        ('n_preview', '<i8'), ('mean', '<f8', (n_cols,)),
+        ('cov', '<f8', (n_cols, n_cols)), ('min', '<f8', (n_cols,)),
+        ('max', '<f8', (n_cols,)),
+    ])
+
+
+def _index_from_records(path):
+    """Build the index from the files written while a store is open.
+
+    A record is written after its chunk and preview, so a record that was
+    only partly written when a run stopped is ignored.
+    """
+    meta = np.load(os.path.join(path, 'meta.npz'))
+    n_cols = int(meta['n_cols'])
+    dtype = np.dtype(str(meta['dtype']))
+    with open(os.path.join(path, 'records.bin'), 'rb') as file:
+        data = file.read()
+    record_dtype = _record_dtype(n_cols)
+    n = len(data) // record_dtype.itemsize
+    records = np.frombuffer(data[:n * record_dtype.itemsize], 
+                            dtype=record_dtype)
+    preview_offsets = np.concatenate([[0], np.cumsum(records['n_preview'])])
+    previews = np.fromfile(os.path.join(path, 'previews.bin'), dtype=dtype,
+                           count=preview_offsets[-1] * n_cols)
+    return dict(
+        byte_offsets=np.concatenate([[0], np.cumsum(records['n_bytes'])]),
+        turns=records['turn'],
+        n_parts=records['n_parts'],
+        means=records['mean'],
+        covs=records['cov'],
+        mins=records['min'],
+        maxs=records['max'],
+        previews=previews.reshape(-1, n_cols),
+        preview_offsets=preview_offsets,
+        n_cols=n_cols, dtype=dtype.str, compression=str(meta['compression']),
+    )
+
+
+class BunchHistoryWriter:
+    """Write bunches to a compressed store.
+
+    While the writer is open, the statistics and preview of each bunch are
+    appended to 'records.bin' and 'previews.bin', so the cost of `append`
+    does not grow with the number of stored bunches and the bunches can 
+    still be read if the writer is never closed. `close` merges them into 
+    'index.npz'.
+
+    Parameters
+    ----------
+    path : str
+        The store folder. It is created if it does not exist.
+    n_cols : int
+        Number of columns in each bunch.
+    dtype : data-type
+        The stored dtype.
+    compression : {'blosc', 'zlib', 'none'} (optional)
+        Defaults to 'blosc' if it is installed, otherwise 'zlib'.
+    level : int
+        Compression level.
+    n_preview : int
+        Number of randomly chosen particles kept uncompressed in the index.
+    seed : int (optional)
+        Seed for choosing the preview particles.
+    """
+    def __init__(self, path, n_cols=6, dtype=np.float64, compression=None,
+                 level=5, n_preview=1000, seed=None):
+        if compression is None:
+            compression = 'zlib' if blosc is None else 'blosc'
+        if compression == 'blosc' and blosc is None:
+            raise ImportError('blosc is not installed.')
+        self.path = path
+        self.n_cols = n_cols
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.level = level
+        self.n_preview = n_preview
+        self.rng = np.random.default_rng(seed)
+        self.n_bunches = 0
+        self.record_dtype = _record_dtype(n_cols)
+        os.makedirs(path, exist_ok=True)
+        index_filename = os.path.join(path, 'index.npz')
+        if os.path.exists(index_filename):
+            os.remove(index_filename)
+        np.savez(os.path.join(path, 'meta.npz'), n_cols=n_cols,
+                 dtype=self.dtype.str, compression=compression)
+        self.file = open(os.path.join(path, 'chunks.bin'), 'wb')
+        self.preview_file = open(os.path.join(path, 'previews.bin'), 'wb')
+        self.record_file = open(os.path.join(path, 'records.bin'), 'wb')
+
+    def append(self, X, turn=None):
+        """Compress and store one bunch.
+
+        X : ndarray, shape (n, n_cols)
+            The bunch coordinates.
+        turn : int
+            The turn number; defaults to the number of stored bunches.
+        """
+        X = np.ascontiguousarray(X, dtype=self.dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_cols:
+            raise ValueError('X must have shape (n, {}).'.format(self.n_cols))
+        n = X.shape[0]
+        data = _compress(X.tobytes(), self.dtype.itemsize, self.compression,
+                         self.level)
+        if n > self.n_preview:
+            idx = np.sort(self.rng.choice(n, self.n_preview, replace=False))
+            preview = X[idx]
+        else:
+            preview = X
+        record = np.zeros(1, dtype=self.record_dtype)
+        record['n_bytes'] = len(data)
+        record['turn'] = self.n_bunches if turn is None else turn
+        record['n_parts'] = n
+        record['n_preview'] = len(preview)
+        if n > 1:
+            moments = bunch_moments(X)
+            record['mean'] = moments['mean']
+            record['cov'] = moments['cov']
+        else:
+            record['mean'] = record['cov'] = np.nan
+        record['min'] = np.min(X, axis=0) if n else np.nan
+        record['max'] = np.max(X, axis=0) if n else np.nan
+        # The record goes last; it marks the bunch as complete.
+        for file, data in [(self.file, data), 
+                           (self.preview_file, preview.tobytes()),
+                           (self.record_file, record.tobytes())]:
+            file.write(data)
+            file.flush()
+        self.n_bunches += 1
+
+    def _write_index(self):
+        temp_filename = os.path.join(self.path, 'index_temp.npz')
+        np.savez(temp_filename, **_index_from_records(self.path))
+        os.replace(temp_filename, os.path.join(self.path, 'index.npz'))
+
+    def close(self):
+        for file in [self.file, self.preview_file, self.record_file]:
+            file.close()
+        self._write_index()
+        for filename in ['records.bin', 'previews.bin', 'meta.npz']:
+            os.remove(os.path.join(self.path, filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BunchHistory:
+    """Read a store written by `BunchHistoryWriter`.
+
+    `history[i]` decompresses and returns the ith bunch. Everything else
+    is read from the index.
+
+    Attributes
+    ----------
+    turns, n_parts : ndarray, shape (n,)
+        Turn number and number of particles of each bunch.
+    means, mins, maxs : ndarray, shape (n, n_cols)
+        Mean and extrema of each coordinate.
+    covs : ndarray, shape (n, n_cols, n_cols)
+        Covariance matrices.
+    """
+    def __init__(self, path):
+        self.path = path
+        index_filename = os.path.join(path, 'index.npz')
+        if os.path.exists(index_filename):
+            index = np.load(index_filename)
+        else:
+            # The writer is still open or was never closed.
+            index = _index_from_records(path)
+        self.n_cols = int(index['n_cols'])
+        self.dtype = np.dtype(str(index['dtype']))
+        self.compression = str(index['compression'])
+        self.byte_offsets = index['byte_offsets']
+        self.turns = index['turns']
+        self.n_parts = index['n_parts']
+        self.means = index['means']
+        self.covs = index['covs']
+        self.mins = index['mins']
+        self.maxs = index['maxs']
+        self._previews = index['previews']
+        self._preview_offsets = index['preview_offsets']
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        lo, hi = self.byte_offsets[i], self.byte_offsets[i + 1]
+        with open(os.path.join(self.path, 'chunks.bin'), 'rb') as file:
+            file.seek(lo)
+            data = _decompress(file.read(hi - lo), self.compression)
+        return np.frombuffer(data, dtype=self.dtype).reshape(-1, self.n_cols)
+
+    def preview(self, i):
+        """Return the random sample of the ith bunch stored in the index."""
+        lo, hi = self._preview_offsets[i], self._preview_offsets[i + 1]
+        return self._previews[lo:hi]
+
+    def beam_stats(self, mode=None):
+        """Return `BeamStats` computed from the stored covariance matrices."""
+        stats = BeamStats(mode)
+        stats.read_moments(mat2vec(self.covs[:, :4, :4]))
+        return stats
+
+
+def bunch_history_from_npz(filename, path, turns=None, **kws):
+    """Convert a file from `save_stacked_array` to a compressed store.
+
+    filename : str
+        The .npz file.
+    path : str
+        The store folder.
+    turns : list[int] (optional)
+        Turn number of each bunch, e.g., from 'turns_stored_inj.dat'.
+    **kws
+        Key word arguments for `BunchHistoryWriter`.
+    """
+    coords = load_stacked_arrays(filename)
+    if turns is None:
+        turns = range(len(coords))
+    n_cols = coords[0].shape[1]
+    with BunchHistoryWriter(path, n_cols=n_cols, **kws) as writer:
+        for X, turn in zip(coords, turns):
+            writer.append(X, turn=int(turn))
@@ -6,6 +6,8 @@ import numpy as np
 import numpy.linalg as la
 import scipy.optimize as opt
 from .ap_utils import rotation_matrix_4D
+from .utils import apply
+from .utils import normalize
 
 import sys
 sys.path.append('/Users/46h/Research/scdist/')
@@ -13,8 +15,21 @@ import coupling as BL
 
 
 def rotate_mat(M, phi):
-    R = rotation_matrix_4D(phi)
-    return np.linalg.multi_dot([np.linalg.inv(R), M, R])
+    """Rotate the transfer matrix M by `phi` radians in the x-y plane.
+    
+    M can also be a stack of matrices with shape (..., 4, 4), in which case
+    phi can be an array that broadcasts with the stack.
+    """
+    if np.ndim(M) == 2 and np.ndim(phi) == 0:
+        R = rotation_matrix_4D(phi)
+        return np.linalg.multi_dot([np.linalg.inv(R), M, R])
+    c, s = np.cos(phi), np.sin(phi)
+    R = np.zeros(np.shape(phi) + (4, 4))
+    R[..., 0, 0] = R[..., 1, 1] = R[..., 2, 2] = R[..., 3, 3] = c
+    R[..., 0, 2] = R[..., 1, 3] = s
+    R[..., 2, 0] = R[..., 3, 1] = -s
+    Rinv = np.swapaxes(R, -1, -2)
+    return np.matmul(np.matmul(Rinv, M), R)
     
 
 # Element definitions
@@ -26,23 +41,31 @@ def M_drift(L):
     
     
 def M_quad(L, k, kind='qf', tilt=0):
-    """Focusing quadrupole transfer matrix."""
+    """Focusing quadrupole transfer matrix.
+    
+    If `k` or `tilt` are arrays, a stack of matrices with shape 
+    np.broadcast(k, tilt).shape + (4, 4) is returned.
+    """
+    shape = np.broadcast(k, tilt).shape
     k = np.sqrt(np.abs(k))
     cos = np.cos(k*L)
     sin = np.sin(k*L)
     cosh = np.cosh(k*L)
     sinh = np.sinh(k*L)
+    M = np.zeros(shape + (4, 4))
     if kind == 'qf':
-        M = np.array([[cos, sin/k, 0, 0],
-                      [-k*sin, cos, 0, 0],
-                      [0, 0, cosh, sinh/k],
-                      [0, 0, k*sinh, cosh]])
+        Mf, Md = M[..., :2, :2], M[..., 2:, 2:]
     elif kind == 'qd':
-        M = np.array([[cosh, sinh/k, 0, 0],
-                      [k*sinh, cosh, 0, 0],
-                      [0, 0, cos, sin/k],
-                      [0, 0, -k*sin, cos]])
-    if tilt:
+        Mf, Md = M[..., 2:, 2:], M[..., :2, :2]
+    # The limit k -> 0 is a drift.
+    k_safe = np.where(k > 0, k, 1.0)
+    Mf[..., 0, 0] = Mf[..., 1, 1] = cos
+    Mf[..., 0, 1] = np.where(k > 0, sin / k_safe, L)
+    Mf[..., 1, 0] = -k * sin
+    Md[..., 0, 0] = Md[..., 1, 1] = cosh
+    Md[..., 0, 1] = np.where(k > 0, sinh / k_safe, L)
+    Md[..., 1, 0] = k * sinh
+    if np.any(tilt):
         M = rotate_mat(M, np.radians(tilt))
     return M
 
@@ -90,6 +113,178 @@ def upright_fodo(mux, muy, length, fill_fac=0.5, start='quad', **kws):
     result = opt.least_squares(cost, [0.5, 0.5], bounds=([0, 0], [np.inf, np.inf]), **kws)
     k1, k2 = result.x
     return fodo(k1, k2, length)
+
+
+def fodo_matrices(k1, k2, L, fill_fac=0.5, quad_tilt=0, start='quad'):
+    """Return the one-turn matrices of `fodo` lattices.
+    
+    k1, k2 and quad_tilt can be arrays, e.g., from `np.meshgrid`; the 
+    element matrices of all lattices are built at once.
+    
+    Returns
+    -------
+    ndarray, shape np.broadcast(k1, k2, quad_tilt).shape + (4, 4)
+    """
+    Lquad = fill_fac * L / 2
+    Ldrift = (1 - fill_fac) * L / 2
+    if start == 'quad':
+        elements = [
+            M_quad(0.5 * Lquad, k1, 'qf', quad_tilt),
+            M_drift(Ldrift),
+            M_quad(Lquad, k2, 'qd', np.negative(quad_tilt)),
+            M_drift(Ldrift),
+            M_quad(0.5 * Lquad, k1, 'qf', quad_tilt),
+        ]
+    elif start == 'drift':
+        elements = [
+            M_drift(0.5 * Ldrift),
+            M_quad(Lquad, k1, 'qf', quad_tilt),
+            M_drift(Ldrift),
+            M_quad(Lquad, k2, 'qd', np.negative(quad_tilt)),
+            M_drift(0.5 * Ldrift),
+        ]
+    shape = np.broadcast(k1, k2, quad_tilt).shape
+    M = np.broadcast_to(np.identity(4), shape + (4, 4))
+    for element in elements:
+        M = np.matmul(element, M)
+    return M
+
+
+def analyze_matrices(M, tol=1e-5):
+    """Compute the lattice parameters for a stack of one-turn matrices.
+    
+    The eigentunes are found from the traces of M and M^2: if 
+    a_i = 2 cos(mu_i), then a_1 + a_2 = tr(M) and 
+    a_1 * a_2 = (tr(M)^2 - tr(M^2) - 4) / 2 for a symplectic matrix. The 
+    lattice is stable if both a_i are real with |a_i| <= 2.
+    
+    Parameters
+    ----------
+    M : ndarray, shape (..., 4, 4)
+        The one-turn transfer matrices.
+    tol : float
+        Tolerance for the stability condition.
+        
+    Returns
+    -------
+    dict
+        'stable': boolean array; 'mu1', 'mu2' (mu1 <= mu2), 'nu1', 'nu2': 
+        eigentunes (NaN if unstable); and the keys of `twiss2D_from_matrix`.
+    """
+    M = np.asarray(M)
+    trM = np.trace(M, axis1=-2, axis2=-1)
+    trM2 = np.einsum('...ij,...ji->...', M, M)
+    disc = 2.0 * trM2 + 8.0 - trM**2
+    with np.errstate(invalid='ignore'):
+        root = np.sqrt(np.fmax(disc, 0.0))
+        cos_mu1 = 0.25 * (trM + root)
+        cos_mu2 = 0.25 * (trM - root)
+        stable = ((disc >= -tol) & (np.abs(cos_mu1) <= 1.0 + tol) 
+                  & (np.abs(cos_mu2) <= 1.0 + tol))
+        params = twiss2D_from_matrix(M)
+    params['stable'] = stable
+    params['mu1'] = np.where(stable, np.arccos(np.clip(cos_mu1, -1.0, 1.0)), np.nan)
+    params['mu2'] = np.where(stable, np.arccos(np.clip(cos_mu2, -1.0, 1.0)), np.nan)
+    params['nu1'] = params['mu1'] / (2 * np.pi)
+    params['nu2'] = params['mu2'] / (2 * np.pi)
+    return params
+
+
+def fodo_sweep(k1, k2, L, fill_fac=0.5, quad_tilt=0, start='quad', tol=1e-5):
+    """Return `analyze_matrices` for a grid of `fodo` lattices.
+    
+    Example: stability map over a 200 x 200 grid of quadrupole strengths.
+    
+    >>> K1, K2 = np.meshgrid(np.linspace(0, 2, 200), np.linspace(0, 2, 200))
+    >>> params = fodo_sweep(K1, K2, 5.0, quad_tilt=3.0)
+    >>> params['stable'].shape
+    (200, 200)
+    """
+    M = fodo_matrices(k1, k2, L, fill_fac, quad_tilt, start)
+    return analyze_matrices(M, tol)
+
+
+def upright_fodo_batch(mux, muy, length, fill_fac=0.5, start='quad', 
+                       max_iters=50, tol=1e-10, dk=1e-7):
+    """Find the quadrupole strengths of `fodo` for arrays of phase advances.
+    
+    This is the batch version of `upright_fodo`. All points are solved 
+    together by Newton's method with a finite-difference Jacobian; steps are
+    halved where they would leave the stable region or increase the error,
+    and k1, k2 are kept nonnegative.
+    
+    Returns
+    -------
+    k1, k2 : ndarray
+        The quadrupole strengths (same shape as np.broadcast(mux, muy)).
+    converged : ndarray
+        Whether the phase advances were matched to within `tol`.
+    """
+    mux, muy = np.broadcast_arrays(np.asarray(mux, dtype=float), 
+                                   np.asarray(muy, dtype=float))
+    
+    def residual(k1, k2):
+        with np.errstate(invalid='ignore'):
+            params = twiss2D_from_matrix(
+                fodo_matrices(k1, k2, length, fill_fac, 0, start)
+            )
+        return np.stack([mux - params['mux'], muy - params['muy']], axis=-1)
+    
+    k = np.full(mux.shape + (2,), 0.5)
+    f = residual(k[..., 0], k[..., 1])
+    for _ in range(max_iters):
+        err = np.max(np.abs(f), axis=-1)
+        active = ~(err < tol)
+        if not np.any(active):
+            break
+        J = np.empty(mux.shape + (2, 2))
+        for j in range(2):
+            k_step = k.copy()
+            k_step[..., j] += dk
+            J[..., j] = (residual(k_step[..., 0], k_step[..., 1]) - f) / dk
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = -np.linalg.solve(J, f[..., None])[..., 0]
+        step[~np.isfinite(step)] = 0.0
+        step[~active] = 0.0
+        # Backtracking line search.
+        alpha = np.ones(mux.shape)
+        for _ in range(10):
+            k_new = np.fmax(k + alpha[..., None] * step, 0.0)
+            f_new = residual(k_new[..., 0], k_new[..., 1])
+            err_new = np.max(np.abs(f_new), axis=-1)
+            bad = active & ~(err_new < err)
+            if not np.any(bad):
+                break
+            alpha[bad] *= 0.5
+        keep = active & (err_new < err)
+        k[keep] = k_new[keep]
+        f[keep] = f_new[keep]
+    converged = np.max(np.abs(f), axis=-1) < tol
+    return k[..., 0], k[..., 1], converged
+  
+    
+def twiss2D_from_matrix(M):
+    """Return the 2D Twiss parameters from the transfer matrix.
+    
+    M can also be a stack of matrices with shape (..., 4, 4).
+    """
+    M = np.asarray(M)
+    cos_phi_x = (M[..., 0, 0] + M[..., 1, 1]) / 2
+    cos_phi_y = (M[..., 2, 2] + M[..., 3, 3]) / 2
+    sign_x = np.where(M[..., 0, 1] < 0, -1., 1.)
+    sign_y = np.where(M[..., 2, 3] < 0, -1., 1.)
+    sin_phi_x = sign_x * np.sqrt(1 - cos_phi_x**2)
+    sin_phi_y = sign_y * np.sqrt(1 - cos_phi_y**2)
+    params = dict()
+    params['mux'] = sign_x * np.arccos(cos_phi_x)
+    params['muy'] = sign_y * np.arccos(cos_phi_y)
+    params['nux'] = params['mux'] / (2 * np.pi)
+    params['nuy'] = params['muy'] / (2 * np.pi)
+    params['bx'] = M[..., 0, 1] / sin_phi_x
+    params['by'] = M[..., 2, 3] / sin_phi_y
+    params['ax'] = (M[..., 0, 0] - M[..., 1, 1]) / (2 * sin_phi_x)
+    params['ay'] = (M[..., 2, 2] - M[..., 3, 3]) / (2 * sin_phi_y)
+    return params
   
     
 class MatrixLattice:
@@ -106,20 +301,56 @@ class MatrixLattice:
         self.v2 = None # eigenvector 2
         self.eig1 = None # eigenvalue 1
         self.eig2 = None # eigenvalue 2
+        self._prefix = [np.identity(4)] # [I, M1, M2.M1, ...]
+        self._prefix_arr = None
+        self._analyzed = False # whether the parameters are those of M
         
     def n_elements(self):
         """Return the number of elements in the lattice."""
         return len(self.matrices)
         
     def build(self):
-        """Create complete lattice transfer matrix."""
-        n_elements = self.n_elements()
-        if n_elements == 0:
-            return
-        if n_elements == 1:
-            self.M = self.matrices[0]
-        else:
-            self.M = la.multi_dot(list(reversed(self.matrices)))
+        """Create complete lattice transfer matrix.
+        
+        The products of the first j element matrices are recomputed for all
+        j; `add` and `set_element` update them incrementally instead.
+        """
+        self._update_prefix(0)
+        
+    def _update_prefix(self, start):
+        """Recompute the cumulative products from element `start` on."""
+        del self._prefix[start + 1:]
+        for mat in self.matrices[start:]:
+            self._prefix.append(np.matmul(mat, self._prefix[-1]))
+        self._prefix_arr = None
+        self._analyzed = False
+        if self.n_elements() > 0:
+            self.M = self._prefix[-1]
+            
+    def cumulative_matrices(self):
+        """Return the products of the element matrices.
+        
+        Returns
+        -------
+        ndarray, shape (n_elements + 1, 4, 4)
+            The jth matrix transports from the lattice start to the entrance 
+            of element j + 1, i.e., it is M_j...M_1. The first is the 
+            identity and the last is the one-turn matrix.
+        """
+        if self._prefix_arr is None:
+            self._prefix_arr = np.array(self._prefix)
+        return self._prefix_arr
+    
+    def transfer_matrix(self, i, j):
+        """Return the transfer matrix from position i to position j.
+        
+        Position i is the entrance of element i + 1 (0 is the lattice start
+        and n_elements is the end). If j < i, the inverse is returned.
+        """
+        P = self.cumulative_matrices()
+        if i == 0:
+            return P[j]
+        return np.matmul(P[j], la.inv(P[i]))
             
     def analyze(self):
         """Compute the lattice parameters."""
@@ -132,28 +363,12 @@ class MatrixLattice:
         self.Vinv = la.inv(self.V)
         self._get_twiss2D()
         self._get_twiss4D()
+        self._analyzed = True
         
     def _get_twiss2D(self):
         """Get the 2D Twiss parameters."""
-        M = self.M
-        self.params2D = {}
-        cos_phi_x = (M[0, 0] + M[1, 1]) / 2
-        cos_phi_y = (M[2, 2] + M[3, 3]) / 2
-        sign_x = sign_y = +1
-        if abs(M[0, 1]) != 0:
-            sign_x = M[0, 1] / abs(M[0, 1])
-        if abs(M[2, 3]) != 0:
-            sign_y = M[2, 3] / abs(M[2, 3])
-        sin_phi_x = sign_x * np.sqrt(1 - cos_phi_x**2)
-        sin_phi_y = sign_y * np.sqrt(1 - cos_phi_y**2)
-        self.params2D['mux'] = sign_x * np.arccos(cos_phi_x)
-        self.params2D['muy'] = sign_y * np.arccos(cos_phi_y)
-        self.params2D['nux'] = self.params2D['mux'] / (2 * np.pi)
-        self.params2D['nuy'] = self.params2D['muy'] / (2 * np.pi)
-        self.params2D['bx'] = M[0, 1] / sin_phi_x
-        self.params2D['by'] = M[2, 3] / sin_phi_y
-        self.params2D['ax'] = (M[0, 0] - M[1, 1]) / (2 * sin_phi_x)
-        self.params2D['ay'] = (M[2, 2] - M[3, 3]) / (2 * sin_phi_y)
+        self.params2D = {key: float(val) 
+                         for key, val in twiss2D_from_matrix(self.M).items()}
         
     def _get_twiss4D(self):
         """Get the 4D Twiss parameters."""
@@ -164,15 +379,82 @@ class MatrixLattice:
         self.params4D['mu1'] = np.arccos(self.eig1.real)
         self.params4D['mu2'] = np.arccos(self.eig2.real)
         
+    def optics(self, kind='2D'):
+        """Return the Twiss parameters at every position in the lattice.
+        
+        Positions are the entrance of each element and the lattice end. All 
+        positions are computed at once from the cumulative matrices.
+        
+        Parameters
+        ----------
+        kind : {'2D', '4D'}
+            '2D': the keys of `params2D`, computed from the one-turn matrix 
+            at each position, and the phase advances 'mux' and 'muy' from 
+            the start, computed by transporting the uncoupled normalization 
+            matrix. '4D': the keys of `params4D`, computed by transporting V;
+            'mu1' and 'mu2' are the phase advances of the two modes. The 
+            phase advances are zero at the lattice start.
+            
+        Returns
+        -------
+        dict[str, ndarray], each of shape (n_elements + 1,)
+        """
+        if not self._analyzed:
+            self.analyze()
+        P = self.cumulative_matrices()
+        if kind == '2D':
+            Ms = np.matmul(np.matmul(P, self.M), la.inv(P))
+            params = twiss2D_from_matrix(Ms)
+            V = np.zeros((4, 4))
+            for i, (a, b) in enumerate([('ax', 'bx'), ('ay', 'by')]):
+                alpha, beta = self.params2D[a], self.params2D[b]
+                V[2*i:2*i+2, 2*i:2*i+2] = np.array([[beta, 0], [-alpha, 1]]) / np.sqrt(beta)
+        elif kind == '4D':
+            V = self.V
+        Vs = np.matmul(P, V)
+        # Rotate each mode so that V[0, 1] = V[2, 3] = 0.
+        mu1 = np.unwrap(np.arctan2(Vs[:, 0, 1], Vs[:, 0, 0]))
+        mu2 = np.unwrap(np.arctan2(Vs[:, 2, 3], Vs[:, 2, 2]))
+        if kind == '2D':
+            params['mux'], params['muy'] = mu1 - mu1[0], mu2 - mu2[0]
+            return params
+        R = np.zeros((len(P), 4, 4))
+        for i, mu in enumerate([mu1, mu2]):
+            c, s = np.cos(mu), np.sin(mu)
+            R[:, 2*i, 2*i] = R[:, 2*i+1, 2*i+1] = c
+            R[:, 2*i, 2*i+1] = -s
+            R[:, 2*i+1, 2*i] = s
+        Vs = np.moveaxis(np.matmul(Vs, R), 0, -1)
+        names = ['a1x', 'a1y', 'a2x', 'a2y', 'b1x', 'b1y', 'b2x', 'b2y', 'u', 
+                 'nu1', 'nu2']
+        params = dict(zip(names, BL.extract_twiss(Vs)))
+        params['mu1'], params['mu2'] = mu1 - mu1[0], mu2 - mu2[0]
+        return params
+        
 
     def add(self, mat):
         """Add an element to the end of the lattice."""
         self.matrices.append(mat)
-        self.build()
+        self._update_prefix(self.n_elements() - 1)
+        
+    def set_element(self, i, mat):
+        """Replace the matrix of element i (zero-based).
+        
+        Only the cumulative products after the element are recomputed. Call
+        `analyze` to update the lattice parameters (`optics` does this 
+        itself).
+        """
+        self.matrices[i] = mat
+        self._update_prefix(i)
         
     def rotate(self, phi):
         """Apply transverse rotation to all elements."""
-        self.M = rotate_mat(self.M, np.radians(phi))
+        phi = np.radians(phi)
+        if self.n_elements() > 0:
+            self.matrices = list(rotate_mat(np.array(self.matrices), phi))
+            self._update_prefix(0)
+        else:
+            self.M = rotate_mat(self.M, phi)
         self.analyze()
 
     def is_stable(self):
@@ -207,38 +489,115 @@ class MatrixLattice:
         """
         X_n = np.random.normal(size=(nparts, 4))
         if kind == 'KV':
-            X_n = np.apply_along_axis(lambda row: row / np.linalg.norm(row), 1, X_n)
+            X_n = normalize(X_n)
         A = np.sqrt(np.diag([eps1, eps1, eps2, eps2]))
-        X = apply(np.matmul(self.V, A), X_n)
+        X = apply(np.matmul(self.V, A), X_n, out=X_n)
         return X
     
     def track_part(self, x, nturns=1, norm_coords=False, piecewise=False):
-        """Track a single particle."""
+        """Track a single particle.
+        
+        If `piecewise`, the initial coordinates followed by the coordinates
+        at the exit of every element on each turn are returned. They are 
+        computed from the turn-by-turn coordinates with the cumulative 
+        element matrices, which are formed once.
+        """
         if norm_coords:
             x = np.matmul(self.Vinv, x)
             M_oneturn = self.normal_form()
         else:
             M_oneturn = self.M
-        X = [x]
-        for _ in range(nturns):
-            if piecewise:
-                for M in self.matrices:
-                    X.append(np.matmul(M, X[-1]))
-            else:
-                X.append(np.matmul(M_oneturn, X[-1]))
-        return np.array(X)
+        X = np.empty((nturns + 1, 4))
+        X[0] = x
+        for i in range(nturns):
+            X[i + 1] = np.matmul(M_oneturn, X[i])
+        if not piecewise:
+            return X
+        C = self._exit_matrices(norm_coords)
+        X_el = np.einsum('kij,tj->tki', C, X[:-1]).reshape(-1, 4)
+        return np.concatenate([X[:1], X_el])
+    
+    def _exit_matrices(self, norm_coords=False):
+        """Return C[j] = M_j+1...M_1, the transfer matrix from the lattice 
+        start to the exit of element j + 1 (C[-1] is the one-turn matrix)."""
+        C = self.cumulative_matrices()[1:]
+        if norm_coords:
+            C = np.matmul(np.matmul(self.Vinv, C), self.V)
+        return C
 
-    def track_bunch(self, X, nturns=1, norm_coords=False):
-        """Track a particle bunch."""
+    def track_bunch(self, X, nturns=1, norm_coords=False, stride=1, 
+                    turns=None, piecewise=False, callback=None):
+        """Track a particle bunch.
+        
+        Only the stored turns are computed; the bunch jumps from one stored
+        turn to the next with a power of the transfer matrix.
+        
+        Parameters
+        ----------
+        X : ndarray, shape (n, 4)
+            Initial coordinates.
+        nturns : int
+            Number of turns.
+        norm_coords : bool
+            Whether to track in normalized coordinates.
+        stride : int
+            Store every `stride` turns: 0, stride, 2 * stride, ... <= nturns.
+        turns : list[int] (optional)
+            Increasing turn numbers to store. Overrides `nturns` and `stride`.
+        piecewise : bool
+            If True, store the coordinates at the exit of every element,
+            starting from the coordinates on each stored turn (as in 
+            `track_part`; in normalized coordinates, the element matrices 
+            are transformed by V). The exit of the last element is the 
+            start of the next turn.
+        callback : callable (optional)
+            If provided, `callback(turn, coords)` is called for each stored 
+            turn instead of storing the coordinates, and None is returned.
+            The array passed to the callback is reused.
+            
+        Returns
+        -------
+        ndarray, shape (n_stored, n, 4), or (n_stored, n_elements, n, 4) if 
+        `piecewise`.
+        """
         if norm_coords:
-            X = apply(Vinv, X)
+            X = apply(self.Vinv, X)
             M = self.normal_form()
         else:
             M = self.M
-        coords = [X]
-        for _ in range(nturns):
-            coords.append(apply(M, coords[-1]))
-        return np.array(coords)
+        if turns is None:
+            turns = np.arange(0, nturns + 1, stride)
+        X = np.array(X, dtype=float)
+        if piecewise:
+            C = self._exit_matrices(norm_coords)
+            shape = (len(C),) + X.shape
+        else:
+            shape = X.shape
+        coords = None
+        if callback is None:
+            coords = np.empty((len(turns),) + shape)
+        else:
+            buffer = np.empty(shape)
+        powers = dict()
+        last_turn = 0
+        for i, turn in enumerate(turns):
+            if turn < last_turn:
+                raise ValueError('turns must be increasing.')
+            step = turn - last_turn
+            if step > 0:
+                if step not in powers:
+                    powers[step] = la.matrix_power(M, step)
+                apply(powers[step], X, out=X)
+            last_turn = turn
+            out = buffer if callback is not None else coords[i]
+            if piecewise:
+                for j in range(len(C)):
+                    apply(C[j], X, out=out[j])
+            else:
+                out[:] = X
+            if callback is not None:
+                callback(turn, out)
+        return coords
     
     def print_params(self, kind='2D'):
         """Print the lattice parameters."""
@@ -430,7 +430,7 @@ def corner(
         rms_ellipse_kws = dict()
         rms_ellipse_kws.setdefault('zorder', int(1e9))
     if rms_ellipse:
-        Sigma = np.cov(X.T)
+        Sigma = utils.bunch_moments(X)['cov']
         rms_ellipse_kws.setdefault('2rms', True)
         if rms_ellipse_kws.pop('2rms'):
             Sigma *= 4.0
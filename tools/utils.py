@@ -1,5 +1,7 @@
 """General-purpose utility functions."""
 import os
+from math import comb
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -145,14 +147,46 @@ def play(anim, center=True):
     
 # Arrays
 #------------------------------------------------------------------------------
-def apply(M, X):
-    """Apply M to each row of X."""
-    return np.apply_along_axis(lambda x: np.matmul(M, x), 1, X)
+def apply(M, X, out=None, block_size=100000):
+    """Apply M to each row of X.
+    
+    The rows are processed in blocks of `block_size`, with one matrix 
+    multiplication per block, so temporary memory stays bounded.
+    
+    Parameters
+    ----------
+    M : ndarray, shape (m, n)
+        The matrix.
+    X : ndarray, shape (k, n)
+        The points.
+    out : ndarray, shape (k, m) (optional)
+        Array in which to place the result. This may be `X` itself if M is
+        square, in which case the points are transformed in place.
+    block_size : int
+        Number of rows per block.
+        
+    Returns
+    -------
+    ndarray, shape (k, m)
+        Each row is M times the corresponding row of X.
+    """
+    M = np.asarray(M)
+    X = np.asarray(X)
+    if out is None:
+        out = np.empty((X.shape[0], M.shape[0]), dtype=np.result_type(M, X))
+    in_place = np.shares_memory(X, out)
+    for lo in range(0, X.shape[0], block_size):
+        hi = lo + block_size
+        if in_place:
+            out[lo:hi] = np.matmul(X[lo:hi], M.T)
+        else:
+            np.matmul(X[lo:hi], M.T, out=out[lo:hi])
+    return out
 
 
 def normalize(X):
     """Normalize all rows of X to unit length."""
-    return np.apply_along_axis(lambda x: x/la.norm(x), 1, X)
+    return X / la.norm(X, axis=1)[:, None]
 
 
 def symmetrize(M):
@@ -224,15 +258,196 @@ def load_stacked_arrays(filename, axis=0):
     return np.split(stacked, idx, axis=axis)
 
 
+# The following classes store ragged turn-by-turn arrays on disk without
+# compression so that any turn can be memory-mapped. A store is a folder
+# containing 'coords.bin', the rows of all turns concatenated in one raw
+# array, and 'index.npz', which holds the row offsets of each turn and the
+# metadata (turn number, position, macro-particle size).
+class StackedArrayWriter:
+    """Append ragged arrays to a memory-mappable store.
+    
+    The index is rewritten after every append, so a `StackedArrayReader` 
+    can read the turns that have been written while the run continues.
+    
+    Parameters
+    ----------
+    path : str
+        The store folder. It is created if it does not exist. 
+    n_cols : int
+        Number of columns in each array.
+    dtype : data-type
+        The stored dtype.
+    append : bool
+        If True and the store exists, add to it instead of overwriting it.
+    """
+    def __init__(self, path, n_cols=6, dtype=np.float64, append=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.coords_filename = os.path.join(path, 'coords.bin')
+        self.index_filename = os.path.join(path, 'index.npz')
+        if append and os.path.isfile(self.index_filename):
+            index = np.load(self.index_filename)
+            self.n_cols = int(index['n_cols'])
+            self.dtype = np.dtype(str(index['dtype']))
+            self.offsets = list(index['offsets'])
+            self.turns = list(index['turns'])
+            self.positions = list(index['positions'])
+            self.macro_sizes = list(index['macro_sizes'])
+            # Drop rows written after the last index update.
+            with open(self.coords_filename, 'r+b') as file:
+                file.truncate(self.offsets[-1] * self.n_cols * self.dtype.itemsize)
+        else:
+            self.n_cols = n_cols
+            self.dtype = np.dtype(dtype)
+            self.offsets = [0]
+            self.turns, self.positions, self.macro_sizes = [], [], []
+            open(self.coords_filename, 'wb').close()
+            self._write_index()
+        self.file = open(self.coords_filename, 'ab')
+        
+    def _write_index(self):
+        temp_filename = os.path.join(self.path, 'index_temp.npz')
+        np.savez(temp_filename, offsets=np.array(self.offsets, dtype=np.int64),
+                 turns=np.array(self.turns, dtype=np.int64),
+                 positions=np.array(self.positions, dtype=float),
+                 macro_sizes=np.array(self.macro_sizes, dtype=float),
+                 n_cols=self.n_cols, dtype=self.dtype.str)
+        os.replace(temp_filename, self.index_filename)
+        
+    def append(self, X, turn=None, position=0., macro_size=1., sync=True):
+        """Append one array.
+        
+        X : ndarray, shape (n, n_cols)
+            The array.
+        turn : int
+            The turn number; defaults to the number of arrays already stored.
+        position : float
+            Position in the lattice.
+        macro_size : float
+            Macro-particle size.
+        sync : bool
+            Whether to rewrite the index now. Otherwise it is written when the
+            writer is closed.
+        """
+        X = np.ascontiguousarray(X, dtype=self.dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_cols:
+            raise ValueError('X must have shape (n, {}).'.format(self.n_cols))
+        self.file.write(X.tobytes())
+        self.file.flush()
+        self.offsets.append(self.offsets[-1] + X.shape[0])
+        self.turns.append(len(self.turns) if turn is None else turn)
+        self.positions.append(position)
+        self.macro_sizes.append(macro_size)
+        if sync:
+            self._write_index()
+        
+    def close(self):
+        self.file.close()
+        self._write_index()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+        
+        
+class StackedArrayReader:
+    """Memory-mapped access to a store written by `StackedArrayWriter`.
+    
+    `reader[i]` returns the array of the ith turn as a read-only view into 
+    the memory map; `reader[i:j]` returns a list of views. Call `refresh`
+    to see turns appended since the reader was created.
+    
+    Attributes
+    ----------
+    offsets : ndarray, shape (n_turns + 1,)
+        The ith array is rows offsets[i]:offsets[i + 1] of `coords`.
+    turns, positions, macro_sizes : ndarray, shape (n_turns,)
+        The metadata of each array.
+    coords : numpy.memmap, shape (offsets[-1], n_cols)
+        All stored rows.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+        
+    def refresh(self):
+        """Reload the index and memory map."""
+        index = np.load(os.path.join(self.path, 'index.npz'))
+        self.n_cols = int(index['n_cols'])
+        self.dtype = np.dtype(str(index['dtype']))
+        self.offsets = index['offsets']
+        self.turns = index['turns']
+        self.positions = index['positions']
+        self.macro_sizes = index['macro_sizes']
+        n_rows = int(self.offsets[-1])
+        if n_rows > 0:
+            self.coords = np.memmap(os.path.join(self.path, 'coords.bin'),
+                                    dtype=self.dtype, mode='r', 
+                                    shape=(n_rows, self.n_cols))
+        else:
+            self.coords = np.zeros((0, self.n_cols), dtype=self.dtype)
+        
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+    
+    def get_range(self, start, stop):
+        """Return turns start, ..., stop - 1 as one contiguous array.
+        
+        Returns
+        -------
+        X : ndarray, shape (n, n_cols)
+            The stacked rows (a view into the memory map).
+        offsets : ndarray, shape (stop - start + 1,)
+            Row offsets of each turn in X.
+        """
+        lo, hi = self.offsets[start], self.offsets[stop]
+        return self.coords[lo:hi], self.offsets[start:stop + 1] - lo
+    
+    def macro_particle_sizes(self):
+        """Return the macro-particle size of each row in `coords`."""
+        return np.repeat(self.macro_sizes, np.diff(self.offsets))
+        
+        
+def convert_stacked_npz(filename, path, turns=None, positions=None, 
+                        macro_sizes=None, dtype=np.float64):
+    """Convert a file from `save_stacked_array` to a `StackedArrayWriter` store."""
+    npz_file = np.load(filename)
+    stacked = npz_file['stacked_array']
+    idx = npz_file['stacked_index']
+    offsets = np.concatenate([[0], idx, [len(stacked)]]).astype(int)
+    n_turns = len(offsets) - 1
+    if turns is None:
+        turns = np.arange(n_turns)
+    if positions is None:
+        positions = np.zeros(n_turns)
+    if macro_sizes is None:
+        macro_sizes = np.ones(n_turns)
+    with StackedArrayWriter(path, n_cols=stacked.shape[1], dtype=dtype) as writer:
+        for i in range(n_turns):
+            writer.append(stacked[offsets[i]:offsets[i + 1]], turn=turns[i],
+                          position=positions[i], macro_size=macro_sizes[i],
+                          sync=False)
+
+
 
 # Math
 #------------------------------------------------------------------------------
 def cov2corr(cov_mat):
-    """Form correlation matrix from covariance matrix."""
-    D = np.sqrt(np.diag(cov_mat.diagonal()))
-    Dinv = la.inv(D)
-    corr_mat = la.multi_dot([Dinv, cov_mat, Dinv])
-    return corr_mat
+    """Form correlation matrix from covariance matrix.
+    
+    cov_mat can also be a stack of matrices with shape (..., n, n).
+    """
+    D = np.sqrt(np.diagonal(cov_mat, axis1=-2, axis2=-1))
+    return cov_mat / (D[..., :, None] * D[..., None, :])
 
 
 def is_positive_definite(cov_mat):
@@ -244,3 +459,192 @@ def rotation_matrix(theta):
     """2D rotation matrix (clockwise) by `theta` radians."""
     c, s = np.cos(theta), np.sin(theta)
     return np.array([[c, s], [-s, c]])
+
+
+# Statistics
+#------------------------------------------------------------------------------
+def _power_sums(U, w, max_order):
+    """Return sum_n w_n * U_n^k for k = 1, ..., max_order (shape (k, d))."""
+    sums = np.empty((max_order, U.shape[1]))
+    P = w[:, None] * U
+    for k in range(max_order):
+        sums[k] = np.sum(P, axis=0)
+        if k < max_order - 1:
+            P *= U
+    return sums
+
+
+def _pair_power_sums(u, v, w):
+    """Return S[i, j] = sum_n w_n * u_n^i * v_n^j for i + j <= 4."""
+    S = np.zeros((5, 5))
+    u_pows = [w]
+    for i in range(4):
+        u_pows.append(u_pows[-1] * u)
+    for i in range(5):
+        P = u_pows[i]
+        for j in range(5 - i):
+            S[i, j] = np.sum(P)
+            if j < 4 - i:
+                P = P * v
+    return S
+
+
+def _central_pair_moments(S, W, du, dv):
+    """Convert raw pair moments about a shift to central moments.
+    
+    S are the power sums from `_pair_power_sums`, W is the total weight, and
+    (du, dv) is the mean minus the shift.
+    """
+    R = S / W
+    C = np.zeros((5, 5))
+    for p in range(5):
+        for q in range(5 - p):
+            for i in range(p + 1):
+                for j in range(q + 1):
+                    C[p, q] += (comb(p, i) * comb(q, j) * (-du)**(p - i) 
+                                * (-dv)**(q - j) * R[i, j])
+    return C
+    
+    
+def halo_parameter(C):
+    """Allen-Wangler halo parameter of a 2D phase space distribution.
+    
+    C[i, j] is the central moment <u^i v^j> for i + j <= 4. The parameter
+    is zero for the KV distribution and one for the Gaussian distribution.
+    """
+    I2 = C[2, 0] * C[0, 2] - C[1, 1]**2
+    I4 = C[4, 0] * C[0, 4] + 3.0 * C[2, 2]**2 - 4.0 * C[1, 3] * C[3, 1]
+    return np.sqrt(3.0 * I4) / (2.0 * I2) - 2.0
+
+
+def _block_shift(X, weights, block_size):
+    """Return the shift used by `bunch_moments`."""
+    if len(X) == 0:
+        return np.zeros(X.shape[1])
+    if weights is not None:
+        for lo in range(0, len(X), block_size):
+            hi = min(lo + block_size, len(X))
+            w = np.asarray(weights[lo:hi], dtype=float)
+            if np.sum(w) != 0.0:
+                return np.average(X[lo:hi], axis=0, weights=w)
+    return np.mean(X[:block_size], axis=0)
+
+
+def bunch_moments(X, weights=None, order=2, ddof=1, block_size=100000):
+    """Compute the mean, covariance and higher-order moments of a bunch.
+    
+    The moments are accumulated in a single pass over blocks of rows. Each 
+    block is shifted by the (weighted) mean of the first block with nonzero
+    total weight before the power sums are formed, which avoids cancellation
+    without a copy of the full array. If no block has nonzero total weight,
+    the unweighted mean of the first block is used.
+    
+    Parameters
+    ----------
+    X : ndarray, shape (n, d)
+        The particle coordinates.
+    weights : ndarray, shape (n,) (optional)
+        Particle weights or macro-sizes. All particles have equal weight if
+        None.
+    order : {2, 4}
+        If 4, also compute the excess kurtosis of each coordinate and, if 
+        d >= 4, the halo parameters of the x-x' and y-y' planes.
+    ddof : int
+        As in `np.cov` with `aweights`; with equal weights the covariance is
+        divided by n - ddof.
+    block_size : int
+        Number of rows per block.
+        
+    Returns
+    -------
+    dict
+        'mean': ndarray, shape (d,)
+        'cov': ndarray, shape (d, d)
+        'weight': total weight.
+        If order == 4 -- 'kurtosis': ndarray, shape (d,); 'halo': ndarray,
+        shape (2,) (NaN if d < 4).
+    """
+    X = np.asarray(X)
+    n, d = X.shape
+    if order not in [2, 4]:
+        raise ValueError("order must be 2 or 4.")
+    shift = _block_shift(X, weights, block_size)
+    W = W2 = 0.0
+    S1 = np.zeros(d)
+    S2 = np.zeros((d, d))
+    if order == 4:
+        S4 = np.zeros((4, d))
+        pair_sums = [np.zeros((5, 5)), np.zeros((5, 5))]
+    for lo in range(0, n, block_size):
+        hi = min(lo + block_size, n)
+        if weights is None:
+            w = np.ones(hi - lo)
+            U = X[lo:hi] - shift
+            S1 += np.sum(U, axis=0)
+            S2 += np.matmul(U.T, U)
+        else:
+            w = np.asarray(weights[lo:hi], dtype=float)
+            U = X[lo:hi] - shift
+            S1 += np.matmul(w, U)
+            S2 += np.matmul(U.T * w, U)
+        W += np.sum(w)
+        W2 += np.sum(w**2)
+        if order == 4:
+            S4 += _power_sums(U, w, 4)
+            if d >= 4:
+                for k, (i, j) in enumerate([(0, 1), (2, 3)]):
+                    pair_sums[k] += _pair_power_sums(U[:, i], U[:, j], w)
+    delta = S1 / W
+    mean = shift + delta
+    Sigma = (S2 / W - np.outer(delta, delta)) * W / (W - ddof * W2 / W)
+    result = {'mean': mean, 'cov': Sigma, 'weight': W}
+    if order == 4:
+        # Central fourth moment from the raw moments about the shift.
+        R = S4 / W
+        m2 = R[1] - delta**2
+        m4 = R[3] - 4.0 * delta * R[2] + 6.0 * delta**2 * R[1] - 3.0 * delta**4
+        result['kurtosis'] = m4 / m2**2 - 3.0
+        halo = np.full(2, np.nan)
+        if d >= 4:
+            for k, (i, j) in enumerate([(0, 1), (2, 3)]):
+                C = _central_pair_moments(pair_sums[k], W, delta[i], delta[j])
+                halo[k] = halo_parameter(C)
+        result['halo'] = halo
+    return result
+
+
+def bunch_moments_stack(coords, weights=None, n_workers=1, **kws):
+    """Apply `bunch_moments` to each bunch in a list.
+    
+    Parameters
+    ----------
+    coords : list[ndarray] or ndarray, shape (n_turns, n_parts, d)
+        The bunches, e.g., from `load_stacked_arrays`. The number of 
+        particles may change from bunch to bunch.
+    weights : list[ndarray] (optional)
+        Particle weights for each bunch.
+    n_workers : int
+        Number of threads. The bunches are split between threads; NumPy 
+        releases the GIL during the matrix products.
+    **kws
+        Key word arguments for `bunch_moments`.
+        
+    Returns
+    -------
+    dict
+        The same keys as `bunch_moments`, with the results for each bunch 
+        stacked along the first axis.
+    """
+    if weights is None:
+        weights = [None] * len(coords)
+        
+    def _moments(i):
+        return bunch_moments(coords[i], weights=weights[i], **kws)
+    
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_moments, range(len(coords))))
+    else:
+        results = [_moments(i) for i in range(len(coords))]
+    return {key: np.array([result[key] for result in results]) 
+            for key in results[0]}